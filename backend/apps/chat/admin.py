@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Session, Message
+from .models import Session, Message, CodeBlob
 
 
 @admin.register(Session)
@@ -13,3 +13,9 @@ class MessageAdmin(admin.ModelAdmin):
     list_display = ["id", "session", "role", "created_at"]
     list_filter = ["role"]
     ordering = ["created_at"]
+
+
+@admin.register(CodeBlob)
+class CodeBlobAdmin(admin.ModelAdmin):
+    list_display = ["sha256", "size", "created_at"]
+    ordering = ["-created_at"]
@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import response_cache_stats, coalesce_stats
+from .prompts import SYSTEM_PROMPT, FEW_SHOT_EXAMPLES
+
+# Changes whenever the system prompt or few-shot set does, so edits never serve stale code
+PROMPT_FINGERPRINT = hashlib.sha256(
+    json.dumps([SYSTEM_PROMPT, FEW_SHOT_EXAMPLES], sort_keys=True).encode()
+).hexdigest()[:16]
+
+# The fields of a generation result worth storing
+_CACHED_FIELDS = ("content", "code_blocks", "token_count")
+
+
+def normalize_input(text: str) -> str:
+    """Casefold and collapse whitespace so trivially different phrasings share a key."""
+    return " ".join(text.split()).casefold()
+
+
+def response_cache_key(
+    model_name: str,
+    history: List[tuple],
+    user_input: str,
+) -> str:
+    """Hash (prompt version, model, trimmed history, normalized input) into a cache key."""
+    payload = json.dumps(
+        [
+            PROMPT_FINGERPRINT,
+            model_name,
+            [[role, content] for role, content, *_ in history],
+            normalize_input(user_input),
+        ],
+        ensure_ascii=False,
+    )
+    return "ai:response:" + hashlib.sha256(payload.encode()).hexdigest()
+
+
+def get_cached_response(key: str) -> Optional[Dict[str, Any]]:
+    """Return a stored generation tagged with "cached": True, or None on a miss."""
+    if not settings.AI_RESPONSE_CACHE_ENABLED:
+        return None
+    stored = caches[settings.AI_RESPONSE_CACHE_ALIAS].get(key)
+    response_cache_stats.record(hit=stored is not None)
+    if stored is None:
+        return None
+    return {**stored, "prompt_tokens": 0, "cached_prompt_tokens": 0, "cached": True}
+
+
+def store_response(key: str, result: Dict[str, Any]) -> None:
+    if not settings.AI_RESPONSE_CACHE_ENABLED:
+        return
+    caches[settings.AI_RESPONSE_CACHE_ALIAS].set(
+        key, {field: result[field] for field in _CACHED_FIELDS}
+    )
+
+
+class LeaderCancelled(Exception):
+    """The generation a follower joined was cancelled before it finished."""
+
+
+class InflightGenerations:
+    """Coalesces identical concurrent generations into one upstream call.
+
+    Keyed like the response cache. The first caller for a key leads and makes
+    the call; callers arriving while it is in flight follow, receiving its
+    result the way a cache hit would. Followers of a cancelled leader (e.g. a
+    discarded speculative run) should `join` again and may lead themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, "Future[Dict[str, Any]]"] = {}
+
+    def join(self, key: str) -> Tuple[bool, "Future[Dict[str, Any]]"]:
+        """Return (leads, future) for `key`."""
+        if not settings.AI_COALESCE_GENERATIONS:
+            return True, Future()
+        with self._lock:
+            pending = self._calls.get(key)
+            leads = pending is None
+            if leads:
+                pending = self._calls[key] = Future()
+        coalesce_stats.record(hit=not leads)
+        return leads, pending
+
+    def finish(
+        self,
+        key: str,
+        pending: "Future[Dict[str, Any]]",
+        result: Optional[Dict[str, Any]] = None,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        """Publish the leader's outcome to its followers."""
+        with self._lock:
+            if self._calls.get(key) is pending:
+                del self._calls[key]
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            error = LeaderCancelled()
+        if error is not None:
+            pending.set_exception(error)
+        else:
+            pending.set_result(result)
+
+    @staticmethod
+    def follow(pending: "Future[Dict[str, Any]]") -> Dict[str, Any]:
+        return _as_follower(pending.result())
+
+    @staticmethod
+    async def afollow(pending: "Future[Dict[str, Any]]") -> Dict[str, Any]:
+        # Shielded: a follower going away must not cancel the shared future
+        return _as_follower(await asyncio.shield(asyncio.wrap_future(pending)))
+
+
+def _as_follower(result: Dict[str, Any]) -> Dict[str, Any]:
+    # Served without a model call of its own, like a cache hit
+    return {**result, "prompt_tokens": 0, "cached_prompt_tokens": 0, "cached": True}
+
+
+inflight_generations = InflightGenerations()
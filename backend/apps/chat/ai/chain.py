@@ -1,97 +1,326 @@
-from typing import List, Tuple, Dict, Any
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from contextlib import aclosing
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple
 
 from django.conf import settings
-from langchain_openai import ChatOpenAI
+from langchain_core.language_models import BaseChatModel
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, BaseMessage
 
 from .prompts import SYSTEM_PROMPT, FEW_SHOT_EXAMPLES
-from .output_parser import parse_code_blocks
-from .token_manager import trim_history, count_tokens
-from .classifier import classify_request
+from .output_parser import parse_code_blocks, CodeBlockStreamParser
+from .token_manager import (
+    HistoryEntry,
+    MAX_PROMPT_TOKENS,
+    MAX_RESPONSE_TOKENS,
+    REPLY_OVERHEAD,
+    trim_history,
+    count_tokens,
+    entry_tokens,
+    message_tokens,
+)
+from .classifier import (
+    MAX_ASK_ROUNDS,
+    classify_request,
+    aclassify_request,
+    get_classifier_model,
+)
+from .cache import (
+    LeaderCancelled,
+    response_cache_key,
+    get_cached_response,
+    store_response,
+    inflight_generations,
+)
+from .clients import PooledChatModel, preconnect
+from .compaction import SUMMARY_ROLE
+from .retrieval import RECALL_ROLE
+from .context import collapse_superseded_files
+from .limiter import current_session_key, get_limiter
+from .metrics import speculation_stats
+from .semantic_cache import get_semantic_cache
+from .timing import cached_tokens, stage
+
+logger = logging.getLogger(__name__)
+
+# How "summary" and "recalled" history entries are introduced to the model
+_SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+_RECALL_HEADER = "Earlier exchanges that may be relevant to the next request:\n"
 
 
 class UIGeneratorChain:
     """LangChain chain that generates UI component code with multi-turn memory.
 
     Pipeline:
-        trim_history → ChatPromptTemplate → ChatOpenAI(gpt-4o) → parse_code_blocks
+        collapse_superseded_files → trim_history → ChatPromptTemplate
+            → ChatOpenAI(gpt-4o) → parse_code_blocks
+
+    Instances hold no per-request state; use `get_generator_chain()` to share
+    one (and its pooled connections) across the process.
     """
 
+    MODEL_NAME = "gpt-4o"
+
     def __init__(self):
-        self._llm = ChatOpenAI(
-            model="gpt-4o",
+        self._model = PooledChatModel(
+            model=self.MODEL_NAME,
             temperature=0.3,   # low temp → consistent, correct code
-            max_completion_tokens=4096,
-            api_key=settings.OPENAI_API_KEY,
+            max_completion_tokens=MAX_RESPONSE_TOKENS,
+            stream_usage=True,   # report token usage on streamed responses too
         )
 
-        # Build few-shot turns as pre-constructed message objects so that
-        # LangChain does NOT try to parse curly braces in code as template variables.
-        few_shot_messages: List[BaseMessage] = [SystemMessage(content=SYSTEM_PROMPT)]
-        for example in FEW_SHOT_EXAMPLES:
-            few_shot_messages.append(HumanMessage(content=example["user"]))
-            few_shot_messages.append(AIMessage(content=example["assistant"]))
-
+        prefix = _static_prefix()
         self._prompt = ChatPromptTemplate.from_messages(
             [
-                *few_shot_messages,
+                *prefix,
                 MessagesPlaceholder(variable_name="history"),
                 ("human", "{input}"),
             ]
         )
+        # Tokens every prompt spends besides history and input, measured once.
+        # The entry headers are reserved whether or not the history has them.
+        self._fixed_tokens = (
+            sum(message_tokens(message.content) for message in prefix)
+            + count_tokens(_SUMMARY_HEADER)
+            + count_tokens(_RECALL_HEADER)
+            + REPLY_OVERHEAD
+        )
+
+    def _runnable(self, model: BaseChatModel) -> Runnable:
+        """The prompt piped into `model`, tagged with the session's prompt_cache_key.
 
-        self._chain = self._prompt | self._llm
+        The provider routes requests sharing a key to the same cache, so a
+        session's growing history prefix keeps hitting it.
+        """
+        session = current_session_key()
+        if settings.AI_PROMPT_CACHE_KEY and session:
+            model = model.bind(prompt_cache_key=f"session:{session}")
+        return self._prompt | model
 
     def invoke(
         self,
         user_input: str,
-        history: List[Tuple[str, str]],
+        history: List[HistoryEntry],
     ) -> Dict[str, Any]:
         """Run the chain and return a structured result.
 
         Args:
             user_input: The current user message text.
-            history: Ordered list of (role, content) tuples from the DB,
-                     NOT including the current user_input.
+            history: Ordered list of (role, content[, token_count]) tuples from
+                     the DB, NOT including the current user_input. A leading
+                     "summary" entry carries the session's running summary, a
+                     trailing "recalled" one earlier exchanges relevant to
+                     user_input.
 
         Returns:
             {
-                "content":     str   — full LLM response (prose + code blocks),
-                "code_blocks": list  — parsed [{language, filename, code}],
-                "token_count": int   — approximate token count of the response,
+                "content":       str  — full LLM response (prose + code blocks),
+                "code_blocks":   list — parsed [{language, filename, code}],
+                "token_count":   int  — approximate token count of the response,
+                "prompt_tokens": int  — provider-reported input tokens (0 if not called),
+                "cached_prompt_tokens": int — of those, served from the provider's prompt cache,
+                "cached":        bool — served from the response cache,
             }
         """
-        trimmed = trim_history(history)
+        inputs, cache_key, tokens = self._prepare(user_input, history)
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+
+        while True:
+            leads, pending = inflight_generations.join(cache_key)
+            if leads:
+                break
+            try:
+                return inflight_generations.follow(pending)
+            except LeaderCancelled:
+                continue
+
+        try:
+            with stage("generate"):
+                response = get_limiter(self.MODEL_NAME).call(lambda: self._runnable(self._model.sync).invoke(inputs), tokens)
+            result = self._build_result(response.content, response.usage_metadata)
+        except BaseException as exc:
+            inflight_generations.finish(cache_key, pending, error=exc)
+            raise
+        store_response(cache_key, result)
+        inflight_generations.finish(cache_key, pending, result=result)
+        return result
+
+    async def ainvoke(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+    ) -> Dict[str, Any]:
+        """Async variant of `invoke()`; same arguments and result shape."""
+        inputs, cache_key, tokens = self._prepare(user_input, history)
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+
+        while True:
+            leads, pending = inflight_generations.join(cache_key)
+            if leads:
+                break
+            try:
+                return await inflight_generations.afollow(pending)
+            except LeaderCancelled:
+                continue
+
+        try:
+            with stage("generate"):
+                response = await get_limiter(self.MODEL_NAME).acall(
+                    lambda: self._runnable(self._model.for_running_loop()).ainvoke(inputs), tokens
+                )
+            result = self._build_result(response.content, response.usage_metadata)
+        except BaseException as exc:
+            inflight_generations.finish(cache_key, pending, error=exc)
+            raise
+        store_response(cache_key, result)
+        inflight_generations.finish(cache_key, pending, result=result)
+        return result
+
+    async def astream(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the chain, yielding events as tokens arrive from the model.
+
+        Yields:
+            {"type": "token",      "text": str}   — raw content delta
+            {"type": "code_block", "block": dict} — a fenced block that just closed
+            {"type": "done",       "result": dict} — same shape as `invoke()`
+
+        A cache hit, or the result of an identical generation already in
+        flight, is replayed as one "token" event carrying the whole content.
+        """
+        inputs, cache_key, tokens = self._prepare(user_input, history)
+        cached = get_cached_response(cache_key)
+        while cached is None:
+            leads, pending = inflight_generations.join(cache_key)
+            if leads:
+                break
+            try:
+                cached = await inflight_generations.afollow(pending)
+            except LeaderCancelled:
+                continue
+
+        if cached is not None:
+            yield {"type": "token", "text": cached["content"]}
+            for block in cached["code_blocks"]:
+                yield {"type": "code_block", "block": block}
+            yield {"type": "done", "result": cached}
+            return
+
+        parser = CodeBlockStreamParser()
+        usage = None
+
+        limiter = get_limiter(self.MODEL_NAME)
+        try:
+            # Timed until the last chunk, including the consumer's time between them
+            with stage("generate"):
+                async with aclosing(limiter.astream(
+                    lambda: self._runnable(self._model.for_running_loop()).astream(inputs), tokens
+                )) as chunks:
+                    async for chunk in chunks:
+                        if chunk.usage_metadata:
+                            usage = chunk.usage_metadata
+                        delta = chunk.content
+                        if not isinstance(delta, str) or not delta:
+                            continue
+                        yield {"type": "token", "text": delta}
+                        for block in parser.feed(delta):
+                            yield {"type": "code_block", "block": block}
+            result = self._build_result(parser.text, usage)
+        except BaseException as exc:
+            inflight_generations.finish(cache_key, pending, error=exc)
+            raise
+
+        store_response(cache_key, result)
+        inflight_generations.finish(cache_key, pending, result=result)
+        yield {"type": "done", "result": result}
+
+    def _prepare(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+    ) -> Tuple[Dict[str, Any], str, int]:
+        """Return the prompt inputs, the response-cache key, and the rate-limiter
+        token estimate (prompt plus the full completion budget) for this turn.
+
+        History is trimmed to whatever the context window has left after the
+        prefix, this input and the completion budget. The running summary and
+        the recalled exchanges are kept whole; only the turns between them are
+        trimmed, oldest first.
+        """
+        with stage("trim"):
+            if settings.AI_COLLAPSE_SUPERSEDED_FILES:
+                history = collapse_superseded_files(history)
+            input_tokens = message_tokens(user_input)
+            summary = [entry for entry in history if entry[0] == SUMMARY_ROLE]
+            recalled = [entry for entry in history if entry[0] == RECALL_ROLE]
+            turns = [entry for entry in history if entry[0] not in (SUMMARY_ROLE, RECALL_ROLE)]
+            pinned_tokens = sum(entry_tokens(entry) for entry in summary + recalled)
+            budget = MAX_PROMPT_TOKENS - self._fixed_tokens - input_tokens - pinned_tokens
+            trimmed = [*summary, *trim_history(turns, max_tokens=max(budget, 0)), *recalled]
 
         lc_history = []
-        for role, content in trimmed:
+        for role, content, *_ in trimmed:
             if role == "user":
                 lc_history.append(HumanMessage(content=content))
+            elif role == SUMMARY_ROLE:
+                lc_history.append(
+                    SystemMessage(content=_SUMMARY_HEADER + content)
+                )
+            elif role == RECALL_ROLE:
+                lc_history.append(SystemMessage(content=_RECALL_HEADER + content))
             else:
                 lc_history.append(AIMessage(content=content))
 
-        response = self._chain.invoke(
-            {"input": user_input, "history": lc_history}
+        inputs = {"input": user_input, "history": lc_history}
+        tokens = (
+            self._fixed_tokens
+            + sum(entry_tokens(entry) for entry in trimmed)
+            + input_tokens
+            + MAX_RESPONSE_TOKENS
         )
+        return inputs, response_cache_key(self.MODEL_NAME, trimmed, user_input), tokens
 
-        content: str = response.content
-        code_blocks = parse_code_blocks(content)
-
-        return {
-            "content": content,
-            "code_blocks": code_blocks,
-            "token_count": count_tokens(content),
-        }
+    @staticmethod
+    def _build_result(content: str, usage: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        with stage("parse"):
+            return {
+                "content": content,
+                "code_blocks": parse_code_blocks(content),
+                "token_count": count_tokens(content),
+                "prompt_tokens": (usage or {}).get("input_tokens", 0),
+                "cached_prompt_tokens": cached_tokens(usage),
+                "cached": False,
+            }
 
     def classify_and_invoke(
         self,
         user_input: str,
-        history: List[Tuple[str, str]],
+        history: List[HistoryEntry],
         ask_rounds_done: int = 0,
+        speculative: Optional[bool] = None,
     ) -> Dict[str, Any]:
         """Classify the request first; ask ONE question if vague, else generate code.
 
+        With `speculative` (default: settings.AI_SPECULATIVE_GENERATION) the
+        generation starts alongside the classifier instead of after it, and is
+        discarded if the classifier answers "ask".
+
+        A first turn close enough to an earlier answered first turn is served
+        from the semantic cache without calling either model.
+
         Returns:
             {
                 "action":      "ask" | "generate",
@@ -101,19 +330,293 @@ class UIGeneratorChain:
                 "questions":   list[str],   # always 0 or 1 item
             }
         """
+        hit = self._first_turn_hit(user_input, history)
+        if hit is not None:
+            return hit
+
+        if self._should_speculate(speculative, ask_rounds_done):
+            result = self._speculative_classify_and_invoke(user_input, history, ask_rounds_done)
+        else:
+            result = self._sequential_classify_and_invoke(user_input, history, ask_rounds_done)
+
+        self._remember_first_turn(user_input, history, result)
+        return result
+
+    def _sequential_classify_and_invoke(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+        ask_rounds_done: int,
+    ) -> Dict[str, Any]:
         classification = classify_request(user_input, history, ask_rounds_done)
 
         if classification["action"] == "ask":
-            question = classification["question"]
-            return {
-                "action": "ask",
-                "content": question,
-                "code_blocks": [],
-                "token_count": 0,
-                "questions": [question],
-            }
+            return self._ask_result(classification["question"])
 
         result = self.invoke(user_input, history)
         result["action"] = "generate"
         result["questions"] = []
         return result
+
+    async def aclassify_and_invoke(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+        ask_rounds_done: int = 0,
+        speculative: Optional[bool] = None,
+    ) -> Dict[str, Any]:
+        """Async variant of `classify_and_invoke`; same arguments and result shape."""
+        hit = self._first_turn_hit(user_input, history)
+        if hit is not None:
+            return hit
+
+        if self._should_speculate(speculative, ask_rounds_done):
+            result = await self._aspeculative_classify_and_invoke(
+                user_input, history, ask_rounds_done
+            )
+        else:
+            result = await self._asequential_classify_and_invoke(
+                user_input, history, ask_rounds_done
+            )
+
+        self._remember_first_turn(user_input, history, result)
+        return result
+
+    async def _asequential_classify_and_invoke(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+        ask_rounds_done: int,
+    ) -> Dict[str, Any]:
+        classification = await aclassify_request(user_input, history, ask_rounds_done)
+
+        if classification["action"] == "ask":
+            return self._ask_result(classification["question"])
+
+        result = await self.ainvoke(user_input, history)
+        result["action"] = "generate"
+        result["questions"] = []
+        return result
+
+    @staticmethod
+    def _first_turn_hit(user_input: str, history: List[HistoryEntry]) -> Optional[Dict[str, Any]]:
+        cache = get_semantic_cache()
+        if history or cache is None:
+            return None
+        hit = cache.lookup(user_input)
+        if hit is not None:
+            hit["action"] = "generate"
+            hit["questions"] = []
+        return hit
+
+    @staticmethod
+    def _remember_first_turn(
+        user_input: str,
+        history: List[HistoryEntry],
+        result: Dict[str, Any],
+    ) -> None:
+        cache = get_semantic_cache()
+        if history or cache is None or result["action"] != "generate":
+            return
+        cache.store(user_input, result)
+
+    @staticmethod
+    def _should_speculate(speculative: Optional[bool], ask_rounds_done: int) -> bool:
+        if speculative is None:
+            speculative = settings.AI_SPECULATIVE_GENERATION
+        # Past MAX_ASK_ROUNDS the classifier answers locally — nothing to overlap
+        return speculative and ask_rounds_done < MAX_ASK_ROUNDS
+
+    def _speculative_classify_and_invoke(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+        ask_rounds_done: int,
+    ) -> Dict[str, Any]:
+        started = time.perf_counter()
+        # Copy the context so the limiter attributes the call to this session
+        generation = _get_speculation_executor().submit(
+            contextvars.copy_context().run, self.invoke, user_input, history
+        )
+
+        classification = classify_request(user_input, history, ask_rounds_done)
+        classify_ms = (time.perf_counter() - started) * 1000
+
+        if classification["action"] == "ask":
+            speculation_stats.record_miss()
+            # A sync HTTP call can't be interrupted; count its tokens once it lands
+            if not generation.cancel():
+                generation.add_done_callback(_record_discarded_generation)
+            return self._ask_result(classification["question"])
+
+        result = generation.result()
+        speculation_stats.record_hit(classify_ms)
+        result["action"] = "generate"
+        result["questions"] = []
+        return result
+
+    async def _aspeculative_classify_and_invoke(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+        ask_rounds_done: int,
+    ) -> Dict[str, Any]:
+        started = time.perf_counter()
+        # Stream rather than invoke so a cancelled generation can report what it cost
+        partial: List[str] = []
+
+        async def generate() -> Dict[str, Any]:
+            async for event in self.astream(user_input, history):
+                if event["type"] == "token":
+                    partial.append(event["text"])
+                elif event["type"] == "done":
+                    return event["result"]
+            raise RuntimeError("generation stream ended without a result")
+
+        generation = asyncio.create_task(generate())
+
+        try:
+            classification = await aclassify_request(user_input, history, ask_rounds_done)
+        except BaseException:
+            generation.cancel()
+            raise
+        classify_ms = (time.perf_counter() - started) * 1000
+
+        if classification["action"] == "ask":
+            generation.cancel()
+            speculation_stats.record_miss()
+            speculation_stats.record_waste(count_tokens("".join(partial)))
+            return self._ask_result(classification["question"])
+
+        result = await generation
+        speculation_stats.record_hit(classify_ms)
+        result["action"] = "generate"
+        result["questions"] = []
+        return result
+
+    async def classify_and_astream(
+        self,
+        user_input: str,
+        history: List[HistoryEntry],
+        ask_rounds_done: int = 0,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Streaming counterpart of `classify_and_invoke`.
+
+        Yields the same events as `astream()`; the final "done" event carries a
+        result in the `classify_and_invoke` shape. An "ask" produces only "done".
+        """
+        hit = self._first_turn_hit(user_input, history)
+        if hit is not None:
+            yield {"type": "token", "text": hit["content"]}
+            for block in hit["code_blocks"]:
+                yield {"type": "code_block", "block": block}
+            yield {"type": "done", "result": hit}
+            return
+
+        classification = await aclassify_request(user_input, history, ask_rounds_done)
+
+        if classification["action"] == "ask":
+            yield {"type": "done", "result": self._ask_result(classification["question"])}
+            return
+
+        # Closed with us, so a consumer that stops early also stops the model call
+        async with aclosing(self.astream(user_input, history)) as events:
+            async for event in events:
+                if event["type"] == "done":
+                    event["result"]["action"] = "generate"
+                    event["result"]["questions"] = []
+                    self._remember_first_turn(user_input, history, event["result"])
+                yield event
+
+    @classmethod
+    def cancelled_result(cls, partial: str) -> Dict[str, Any]:
+        """A `classify_and_invoke`-shaped result for a generation stopped after
+        streaming `partial`; only blocks whose fence closed are parsed out."""
+        result = cls._build_result(partial)
+        result["action"] = "generate"
+        result["questions"] = []
+        return result
+
+    @staticmethod
+    def _ask_result(question: str) -> Dict[str, Any]:
+        return {
+            "action": "ask",
+            "content": question,
+            "code_blocks": [],
+            "token_count": count_tokens(question),
+            "prompt_tokens": 0,
+            "cached_prompt_tokens": 0,
+            "questions": [question],
+        }
+
+
+def _static_prefix() -> List[BaseMessage]:
+    """The system prompt and few-shot turns every gpt-4o prompt starts with.
+
+    Built from constants as message objects, not templates: LangChain won't
+    read the braces in the example code as variables, and the prefix renders
+    byte-for-byte the same on every call, so the provider's prompt cache can
+    serve it. Anything that varies per request (dates, ids, session data)
+    belongs after it, in the history or the input.
+    """
+    messages: List[BaseMessage] = [SystemMessage(content=SYSTEM_PROMPT)]
+    for example in FEW_SHOT_EXAMPLES:
+        messages.append(HumanMessage(content=example["user"]))
+        messages.append(AIMessage(content=example["assistant"]))
+    return messages
+
+
+_lock = threading.Lock()
+_generator_chain: Optional[UIGeneratorChain] = None
+_speculation_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_generator_chain() -> UIGeneratorChain:
+    """Return the process-wide `UIGeneratorChain`, building it on first use."""
+    global _generator_chain
+    if _generator_chain is None:
+        with _lock:
+            if _generator_chain is None:
+                _generator_chain = UIGeneratorChain()
+    return _generator_chain
+
+
+def _get_speculation_executor() -> ThreadPoolExecutor:
+    global _speculation_executor
+    if _speculation_executor is None:
+        with _lock:
+            if _speculation_executor is None:
+                _speculation_executor = ThreadPoolExecutor(
+                    max_workers=settings.AI_SPECULATION_WORKERS,
+                    thread_name_prefix="speculative-generate",
+                )
+    return _speculation_executor
+
+
+def _record_discarded_generation(future: "Future[Dict[str, Any]]") -> None:
+    if future.exception() is None:
+        speculation_stats.record_waste(future.result()["token_count"])
+
+
+def _preconnect() -> None:
+    try:
+        preconnect()
+    except Exception:
+        logger.warning("Pre-connecting to the model endpoint failed", exc_info=True)
+
+
+def warm_up() -> None:
+    """Build the shared chains and open pooled connections before the first request.
+
+    Called from config/wsgi.py and config/asgi.py. Failures are logged, never
+    raised — a cold start is better than a server that refuses to boot.
+    """
+    try:
+        count_tokens("")   # loads the tiktoken BPE ranks
+        get_generator_chain()
+        get_classifier_model().sync
+        if settings.AI_WARM_UP_CONNECT:
+            # In the background: a slow or unreachable endpoint must not hold up boot
+            threading.Thread(target=_preconnect, name="ai-preconnect", daemon=True).start()
+    except Exception:
+        logger.warning("AI pipeline warm-up failed; continuing cold", exc_info=True)
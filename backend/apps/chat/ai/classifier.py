@@ -1,14 +1,38 @@
+import asyncio
 import json
-from typing import List, Tuple, Dict, Any
+import random
+import re
+import threading
+from typing import List, Dict, Any, Optional, Set
 
 from django.conf import settings
-from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage
 from langchain_core.prompts import ChatPromptTemplate
 
+from .clients import PooledChatModel
+from .limiter import get_limiter
+from .metrics import classifier_stats
+from .timing import stage
+from .token_manager import HistoryEntry, count_tokens
+
+CLASSIFIER_MODEL = "gpt-4o-mini"
+CLASSIFIER_MAX_TOKENS = 150
+
 # Maximum clarifying questions to ask before forcing generation
 MAX_ASK_ROUNDS = 2
 
+# A message this long is a detailed spec, never a bare category
+FAST_PATH_MIN_WORDS = 25
+
+# Refinements of the previous generation ("make it bigger", "add a footer")
+_ITERATION_RE = re.compile(
+    r"^\s*(?:(?:please|now|also|ok(?:ay)?|and|then|can you|could you)[\s,]+)*"
+    r"(?:make|change|add|remove|delete|drop|use|set|move|increase|decrease|reduce|"
+    r"turn|put|replace|swap|switch|update|rename|center|align|shrink|enlarge|"
+    r"resize|fix|try|show|hide|include|give it|let it|keep)\b",
+    re.IGNORECASE,
+)
+
 _CLASSIFIER_SYSTEM = """You are a request classifier for a UI code generation assistant.
 
 Look at the conversation history and the latest user message. Decide:
@@ -34,66 +58,202 @@ Look at the conversation history and the latest user message. Decide:
 Return ONLY valid JSON, no markdown:
 {"action": "ask" | "generate", "question": "single question string or empty string"}"""
 
+_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessage(content=_CLASSIFIER_SYSTEM),
+    ("human", "{input}"),
+])
+
+_model: Optional[PooledChatModel] = None
+_model_lock = threading.Lock()
+
+
+def get_classifier_model() -> PooledChatModel:
+    """Return the process-wide gpt-4o-mini model used for classification."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = PooledChatModel(
+                    model=CLASSIFIER_MODEL,
+                    temperature=0,
+                    max_tokens=CLASSIFIER_MAX_TOKENS,
+                )
+    return _model
+
 
 def classify_request(
     user_input: str,
-    history: List[Tuple[str, str]],
+    history: List[HistoryEntry],
     ask_rounds_done: int = 0,
 ) -> Dict[str, Any]:
     """Classify whether one clarifying question is needed before generating code.
 
+    Obvious turns are decided locally by `prefilter_request`; only ambiguous
+    ones cost a gpt-4o-mini round-trip.
+
     Args:
         user_input: Current user message.
-        history: Full conversation history as (role, content) tuples.
+        history: Full conversation history as (role, content[, token_count]) tuples.
         ask_rounds_done: How many "ask" rounds have already happened this session.
 
     Returns:
         {"action": "ask" | "generate", "question": str}
+        plus "rule" when the fast path decided.
     """
     # Force generate if we've already asked the max number of questions
     if ask_rounds_done >= MAX_ASK_ROUNDS:
         return {"action": "generate", "question": ""}
 
-    llm = ChatOpenAI(
-        model="gpt-4o-mini",
-        temperature=0,
-        max_tokens=150,
-        api_key=settings.OPENAI_API_KEY,
-    )
+    local = _fast_path(user_input, history, ask_rounds_done)
+    if local is not None:
+        if _should_shadow():
+            threading.Thread(
+                target=_shadow, args=(user_input, history, local), daemon=True
+            ).start()
+        return local
+
+    classifier_stats.record_model()
+    with stage("classify"):
+        return _classify_with_model(user_input, history)
+
+
+async def aclassify_request(
+    user_input: str,
+    history: List[HistoryEntry],
+    ask_rounds_done: int = 0,
+) -> Dict[str, Any]:
+    """Async variant of `classify_request` — awaits the model without holding a thread."""
+    if ask_rounds_done >= MAX_ASK_ROUNDS:
+        return {"action": "generate", "question": ""}
+
+    local = _fast_path(user_input, history, ask_rounds_done)
+    if local is not None:
+        if _should_shadow():
+            task = asyncio.create_task(_ashadow(user_input, history, local))
+            _shadow_tasks.add(task)
+            task.add_done_callback(_shadow_tasks.discard)
+        return local
+
+    classifier_stats.record_model()
+    with stage("classify"):
+        return await _aclassify_with_model(user_input, history)
+
+
+def prefilter_request(
+    user_input: str,
+    history: List[HistoryEntry],
+    ask_rounds_done: int = 0,
+) -> Optional[str]:
+    """Local pre-classifier for turns whose answer is not in doubt.
 
+    Returns the name of the rule that decided "generate", or None when the
+    turn is ambiguous and needs the model. Never decides "ask" — that takes
+    a model-written question.
+    """
+    assistant_turns = [content for role, content, *_ in history if role == "assistant"]
+
+    # Out of questions, or answering the one just asked (asks carry no code)
+    if ask_rounds_done >= MAX_ASK_ROUNDS or (assistant_turns and "```" not in assistant_turns[-1]):
+        return "reply_to_question"
+
+    if assistant_turns and _ITERATION_RE.match(user_input):
+        return "iteration"
+
+    if len(user_input.split()) >= FAST_PATH_MIN_WORDS:
+        return "detailed_spec"
+
+    return None
+
+
+def _fast_path(
+    user_input: str,
+    history: List[HistoryEntry],
+    ask_rounds_done: int,
+) -> Optional[Dict[str, Any]]:
+    if not settings.AI_FAST_CLASSIFIER_ENABLED:
+        return None
+    rule = prefilter_request(user_input, history, ask_rounds_done)
+    if rule is None:
+        return None
+    classifier_stats.record_local(rule)
+    return {"action": "generate", "question": "", "rule": rule}
+
+
+def _classify_with_model(user_input: str, history: List[HistoryEntry]) -> Dict[str, Any]:
+    chain = _PROMPT | get_classifier_model().sync
+    user_prompt = _build_user_prompt(user_input, history)
+
+    try:
+        response = get_limiter(CLASSIFIER_MODEL).call(
+            lambda: chain.invoke({"input": user_prompt}), _estimate_tokens(user_prompt)
+        )
+        return _parse_classification(response.content)
+    except Exception:
+        # Never block the user (not even when the limiter is saturated) — fall through to generation
+        return {"action": "generate", "question": ""}
+
+
+async def _aclassify_with_model(user_input: str, history: List[HistoryEntry]) -> Dict[str, Any]:
+    chain = _PROMPT | get_classifier_model().for_running_loop()
+    user_prompt = _build_user_prompt(user_input, history)
+
+    try:
+        response = await get_limiter(CLASSIFIER_MODEL).acall(
+            lambda: chain.ainvoke({"input": user_prompt}), _estimate_tokens(user_prompt)
+        )
+        return _parse_classification(response.content)
+    except Exception:
+        return {"action": "generate", "question": ""}
+
+
+def _estimate_tokens(user_prompt: str) -> int:
+    return count_tokens(_CLASSIFIER_SYSTEM) + count_tokens(user_prompt) + CLASSIFIER_MAX_TOKENS
+
+
+# Keeps fire-and-forget shadow checks alive until they finish
+_shadow_tasks: Set["asyncio.Task[None]"] = set()
+
+
+def _should_shadow() -> bool:
+    return random.random() < settings.AI_FAST_CLASSIFIER_SHADOW_RATE
+
+
+def _shadow(user_input: str, history: List[HistoryEntry], local: Dict[str, Any]) -> None:
+    """Re-run a locally decided turn through the model, off the request path."""
+    model = _classify_with_model(user_input, history)
+    classifier_stats.record_shadow(local["rule"], local["action"], model["action"])
+
+
+async def _ashadow(user_input: str, history: List[HistoryEntry], local: Dict[str, Any]) -> None:
+    model = await _aclassify_with_model(user_input, history)
+    classifier_stats.record_shadow(local["rule"], local["action"], model["action"])
+
+
+def _build_user_prompt(user_input: str, history: List[HistoryEntry]) -> str:
     # Build context string from recent history (last 6 turns, truncated)
     history_lines = []
-    for role, content in history[-6:]:
+    for role, content, *_ in history[-6:]:
         history_lines.append(f"{role.upper()}: {content[:300]}")
     history_text = "\n".join(history_lines) if history_lines else "(no prior messages)"
 
-    user_prompt = (
+    return (
         f"Conversation so far:\n{history_text}\n\n"
         f"Latest user message:\n{user_input}"
     )
 
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessage(content=_CLASSIFIER_SYSTEM),
-        ("human", "{input}"),
-    ])
 
-    try:
-        response = (prompt | llm).invoke({"input": user_prompt})
-        raw = response.content
-        if not isinstance(raw, str):
-            return {"action": "generate", "question": ""}
-        result: Dict[str, Any] = json.loads(raw)
-
-        action = result.get("action")
-        question = result.get("question", "")
-
-        if action not in ("ask", "generate"):
-            return {"action": "generate", "question": ""}
-        if action == "ask" and not isinstance(question, str):
-            return {"action": "generate", "question": ""}
+def _parse_classification(raw: Any) -> Dict[str, Any]:
+    """Validate the classifier's JSON reply; anything malformed means "generate"."""
+    if not isinstance(raw, str):
+        return {"action": "generate", "question": ""}
+    result: Dict[str, Any] = json.loads(raw)
 
-        return {"action": action, "question": question}
+    action = result.get("action")
+    question = result.get("question", "")
 
-    except Exception:
-        # Never block the user — fall through to generation
+    if action not in ("ask", "generate"):
+        return {"action": "generate", "question": ""}
+    if action == "ask" and not isinstance(question, str):
         return {"action": "generate", "question": ""}
+
+    return {"action": action, "question": question}
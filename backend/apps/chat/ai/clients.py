@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import weakref
+from typing import Any, Optional, Tuple
+
+import httpx
+from django.conf import settings
+from langchain_openai import ChatOpenAI
+
+_http_client: Optional[httpx.Client] = None
+_lock = threading.Lock()
+
+
+def _pool_limits() -> httpx.Limits:
+    return httpx.Limits(**settings.AI_HTTP_POOL)
+
+
+def get_http_client() -> httpx.Client:
+    """Process-wide keep-alive connection pool for sync calls to the model endpoint."""
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=_pool_limits())
+    return _http_client
+
+
+class PooledChatModel:
+    """One `ChatOpenAI` configuration whose instances reuse pooled connections.
+
+    Sync calls share a single model backed by `get_http_client()`.
+    httpx.AsyncClient connections are bound to the event loop that opened
+    them, so async calls get one model (and pool) per running loop — under
+    an ASGI server that is a single long-lived model as well. Each loop's
+    pool is closed on that loop as it shuts down.
+    """
+
+    def __init__(self, **model_kwargs: Any):
+        self._model_kwargs = model_kwargs
+        self._sync_model: Optional[ChatOpenAI] = None
+        self._loop_models: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[ChatOpenAI, Any]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def sync(self) -> ChatOpenAI:
+        if self._sync_model is None:
+            with self._lock:
+                if self._sync_model is None:
+                    self._sync_model = self._build(http_client=get_http_client())
+        return self._sync_model
+
+    def for_running_loop(self) -> ChatOpenAI:
+        loop = asyncio.get_running_loop()
+        entry = self._loop_models.get(loop)
+        if entry is None:
+            with self._lock:
+                entry = self._loop_models.get(loop)
+                if entry is None:
+                    client = httpx.AsyncClient(limits=_pool_limits())
+                    entry = (self._build(http_async_client=client), _close_with_loop(loop, client))
+                    self._loop_models[loop] = entry
+        return entry[0]
+
+    def _build(self, **client_kwargs: Any) -> ChatOpenAI:
+        return ChatOpenAI(
+            api_key=settings.OPENAI_API_KEY,
+            base_url=settings.OPENAI_BASE_URL or None,
+            # The limiter retries 429s, pausing every caller; the SDK's own
+            # retries would back off per call, unseen by it
+            max_retries=0,
+            **self._model_kwargs,
+            **client_kwargs,
+        )
+
+
+def _close_with_loop(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient) -> Any:
+    """Arrange for `client` to be closed on `loop` when the loop shuts down.
+
+    asyncio.run() (which asgiref and ASGI servers use) finalizes suspended
+    async generators before closing its loop, so a generator parked on the
+    loop gets to await `aclose()` there. Keep the returned generator
+    referenced for as long as the client is in use.
+    """
+    async def hold():
+        try:
+            yield
+        finally:
+            await client.aclose()
+
+    holder = hold()
+
+    async def park():
+        await holder.__anext__()
+
+    loop.create_task(park())
+    return holder
+
+
+def preconnect(base_url: Optional[str] = None) -> None:
+    """Open a keep-alive connection to the model endpoint (DNS + TCP + TLS) ahead of
+    the first real request. Any HTTP status is fine — only the handshake matters."""
+    base_url = base_url or settings.OPENAI_BASE_URL or "https://api.openai.com/v1"
+    get_http_client().head(base_url, timeout=5)
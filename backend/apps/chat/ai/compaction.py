@@ -0,0 +1,130 @@
+import threading
+from typing import List, Optional
+
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+from .clients import PooledChatModel
+from .limiter import get_limiter
+from .output_parser import replace_code_blocks
+from .token_manager import HistoryEntry, count_tokens, entry_tokens
+
+SUMMARIZER_MODEL = "gpt-4o-mini"
+SUMMARIZER_MAX_TOKENS = 600
+
+# History role for the running summary of turns folded out of the working window
+SUMMARY_ROLE = "summary"
+
+# After compacting, the window is refilled to this fraction of its budget, so the
+# summary is rewritten once per batch of turns rather than on every message.
+COMPACT_TARGET_RATIO = 0.5
+
+# Never fold the most recent turns, however large they are
+MIN_KEPT_ENTRIES = 2
+
+_SUMMARIZER_SYSTEM = """You maintain the running summary of a conversation between a user \
+and a React/TypeScript UI code generation assistant.
+
+You receive the current summary (possibly empty) and the next turns that are leaving the \
+assistant's context window. Return an updated summary that merges both.
+
+## Keep
+- Every requirement, constraint and preference the user stated, including ones they later revised
+- Component and file names, props, layout, colors, behavior and design decisions already made
+- Requests that are still open or were answered with a clarifying question
+
+## Drop
+- Code — refer to files by name instead
+- Pleasantries, repetition, and details superseded by later turns
+
+Write plain prose or terse bullets, under 300 words. Return ONLY the summary text."""
+
+_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessage(content=_SUMMARIZER_SYSTEM),
+    ("human", "{input}"),
+])
+
+_model: Optional[PooledChatModel] = None
+_model_lock = threading.Lock()
+
+
+def get_summarizer_model() -> PooledChatModel:
+    """Return the process-wide gpt-4o-mini model used for rolling summaries."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = PooledChatModel(
+                    model=SUMMARIZER_MODEL,
+                    temperature=0,
+                    max_tokens=SUMMARIZER_MAX_TOKENS,
+                )
+    return _model
+
+
+def plan_compaction(history: List[HistoryEntry], window_tokens: int) -> int:
+    """Return how many of the oldest entries to fold into the summary (0 if none).
+
+    Nothing is folded while the history fits in `window_tokens`. Once it
+    overflows, the oldest entries are folded until the rest fits within
+    COMPACT_TARGET_RATIO of the window.
+    """
+    costs = [entry_tokens(entry) for entry in history]
+    total = sum(costs)
+    if total <= window_tokens:
+        return 0
+
+    target = window_tokens * COMPACT_TARGET_RATIO
+    folded = 0
+    while folded < len(history) - MIN_KEPT_ENTRIES and total > target:
+        total -= costs[folded]
+        folded += 1
+    return folded
+
+
+def summarize(summary: str, turns: List[HistoryEntry]) -> str:
+    """Fold `turns` into `summary` with one gpt-4o-mini call."""
+    chain = _PROMPT | get_summarizer_model().sync
+    user_prompt = _build_user_prompt(summary, turns)
+    response = get_limiter(SUMMARIZER_MODEL).call(
+        lambda: chain.invoke({"input": user_prompt}), _estimate_tokens(user_prompt)
+    )
+    return str(response.content).strip()
+
+
+async def asummarize(summary: str, turns: List[HistoryEntry]) -> str:
+    """Async variant of `summarize`."""
+    chain = _PROMPT | get_summarizer_model().for_running_loop()
+    user_prompt = _build_user_prompt(summary, turns)
+    response = await get_limiter(SUMMARIZER_MODEL).acall(
+        lambda: chain.ainvoke({"input": user_prompt}), _estimate_tokens(user_prompt)
+    )
+    return str(response.content).strip()
+
+
+def _estimate_tokens(user_prompt: str) -> int:
+    return count_tokens(_SUMMARIZER_SYSTEM) + count_tokens(user_prompt) + SUMMARIZER_MAX_TOKENS
+
+
+def with_summary(
+    summary: str,
+    summary_tokens: int,
+    history: List[HistoryEntry],
+) -> List[HistoryEntry]:
+    """Prepend the running summary (if any) to the working-window history."""
+    if not summary:
+        return history
+    return [(SUMMARY_ROLE, summary, summary_tokens), *history]
+
+
+def _build_user_prompt(summary: str, turns: List[HistoryEntry]) -> str:
+    lines = []
+    for role, content, *_ in turns:
+        # Code is the bulk of assistant turns and adds nothing a filename can't say
+        prose = replace_code_blocks(content, lambda block: f"[code: {block['filename']}]")
+        lines.append(f"{role.upper()}: {prose}")
+
+    return (
+        f"Current summary:\n{summary or '(empty)'}\n\n"
+        f"Turns to fold in:\n" + "\n\n".join(lines)
+    )
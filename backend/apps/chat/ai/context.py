@@ -0,0 +1,48 @@
+from typing import Dict, List, Optional, Set
+
+from .output_parser import replace_code_blocks
+from .token_manager import HistoryEntry
+
+
+def collapse_superseded_files(history: List[HistoryEntry]) -> List[HistoryEntry]:
+    """Keep only the newest version of each generated file in full.
+
+    In refinement threads every assistant turn re-emits the whole component,
+    so the model would otherwise read N near-identical copies of the same
+    file. Older code blocks whose filename is generated again later in the
+    history are replaced by a one-line placeholder; the surrounding prose
+    (design notes, "what changed") is kept.
+
+    A collapsed entry's stored token count is scaled by how much text was
+    removed, so trimming stays encode-free.
+    """
+    newer_files: Set[str] = set()
+    collapsed: List[HistoryEntry] = []
+
+    for entry in reversed(history):
+        role, content = entry[0], entry[1]
+        if role != "assistant" or "```" not in content:
+            collapsed.append(entry)
+            continue
+
+        files_here: Set[str] = set()
+
+        def _collapse(block: Dict[str, str]) -> Optional[str]:
+            files_here.add(block["filename"])
+            if block["filename"] not in newer_files:
+                return None
+            return f"[Earlier version of `{block['filename']}` omitted — superseded by a later revision.]"
+
+        new_content = replace_code_blocks(content, _collapse)
+        newer_files |= files_here
+
+        if new_content == content:
+            collapsed.append(entry)
+            continue
+
+        stored = entry[2] if len(entry) > 2 else 0
+        scaled = round(stored * len(new_content) / len(content))
+        collapsed.append((role, new_content, scaled))
+
+    collapsed.reverse()
+    return collapsed
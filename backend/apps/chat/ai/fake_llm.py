@@ -0,0 +1,250 @@
+"""A local stand-in for the OpenAI chat-completions endpoint.
+
+Used by `manage.py bench_chat` (and handy for load tests) so the send-message
+path can be exercised without network access or spend. Point the app at it
+with OPENAI_BASE_URL. It answers like the real models closely enough for the
+pipeline: classifier calls get a "generate" verdict, summarizer calls a short
+summary, and generator calls a reply with one fenced TSX block — after a
+configurable time to first token and at a configurable token rate, streamed
+or not. Like the real endpoint, it reports prompt tokens served from a prefix
+cache: 128-token blocks of a prompt of at least 1024 tokens whose prefix it
+has seen before.
+"""
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+_CLASSIFIER_REPLY = '{"action": "generate", "question": ""}'
+_SUMMARY_REPLY = (
+    "The user is building a React component with Tailwind and has asked for "
+    "several layout and styling refinements."
+)
+_COMPONENT_LINES = [
+    'import React, { useState } from "react";',
+    "",
+    "export default function Generated() {",
+    '  const [open, setOpen] = useState(false);',
+    "  return (",
+    '    <div className="flex flex-col gap-4 p-6 rounded-xl border bg-card shadow-sm">',
+    '      <button className="h-10 px-4 rounded-md bg-primary text-primary-foreground" onClick={() => setOpen(!open)}>',
+    "        Toggle details",
+    "      </button>",
+    '      {open && <p className="text-sm text-muted-foreground">Details go here.</p>}',
+    "    </div>",
+    "  );",
+    "}",
+]
+
+
+# Prompt caching granularity, in tokens, and the rough size of a token in characters
+_CACHE_MIN_TOKENS = 1024
+_CACHE_BLOCK_TOKENS = 128
+_CHARS_PER_TOKEN = 4
+
+
+def _generation_pieces(tokens: int) -> List[str]:
+    """About `tokens` content deltas: a line of prose, then a TSX block."""
+    pieces = ["Here ", "is ", "the ", "updated ", "component.\n\n", "```tsx\n", "// filename: Generated.tsx\n"]
+    body: List[str] = []
+    while len(pieces) + len(body) < tokens - 1:
+        for line in _COMPONENT_LINES:
+            words = line.split(" ")
+            body.extend(word + " " for word in words[:-1])
+            body.append(words[-1] + "\n")
+    return pieces + body[: max(tokens - len(pieces) - 1, 0)] + ["```"]
+
+
+def _words(text: str) -> List[str]:
+    words = text.split(" ")
+    return [word + " " for word in words[:-1]] + [words[-1]]
+
+
+class FakeChatCompletions:
+    """An in-process HTTP server speaking enough of `POST /v1/chat/completions`.
+
+    `ttft` is the delay before the first token, `tokens_per_second` the rate
+    after it (0 sends everything at once), and `completion_tokens` the length
+    of generator replies. Use as a context manager, or `start()`/`stop()`.
+    """
+
+    def __init__(
+        self,
+        ttft: float = 0.3,
+        tokens_per_second: float = 100.0,
+        completion_tokens: int = 400,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self._prefixes: set = set()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeChatCompletions":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-llm", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeChatCompletions":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def reply(self, request: Dict[str, Any]) -> Tuple[List[str], int, int]:
+        """Content deltas for `request`, its prompt token count and how many of
+        those were cached."""
+        messages = request.get("messages", [])
+        system = next((str(m.get("content", "")) for m in messages if m.get("role") == "system"), "")
+        prompt = request.get("model", "") + json.dumps(
+            [[m.get("role"), m.get("content")] for m in messages], separators=(",", ":")
+        )
+        prompt_tokens = len(prompt) // _CHARS_PER_TOKEN
+        cached_tokens = self._cache_prompt(prompt)
+
+        if "request classifier" in system:
+            kind, pieces = "classifier", _words(_CLASSIFIER_REPLY)
+        elif "running summary" in system:
+            kind, pieces = "summarizer", _words(_SUMMARY_REPLY)
+        else:
+            kind, pieces = "generator", _generation_pieces(self.completion_tokens)
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+        return pieces, prompt_tokens, cached_tokens
+
+    def _cache_prompt(self, prompt: str) -> int:
+        """Cache `prompt`'s block-aligned prefixes; return the tokens of the
+        longest one already cached."""
+        block = _CACHE_BLOCK_TOKENS * _CHARS_PER_TOKEN
+        digest, hashes, end = hashlib.sha1(), [], 0
+        for boundary in range(_CACHE_MIN_TOKENS * _CHARS_PER_TOKEN, len(prompt) + 1, block):
+            digest.update(prompt[end:boundary].encode())
+            hashes.append((boundary, digest.digest()))
+            end = boundary
+
+        cached = 0
+        with self._lock:
+            for boundary, prefix in hashes:
+                if prefix not in self._prefixes:
+                    break
+                cached = boundary // _CHARS_PER_TOKEN
+            self._prefixes.update(prefix for _, prefix in hashes)
+        return cached
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, like the real endpoint
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        # preconnect() probes the base URL
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"No fake for {self.path}"}})
+            return
+
+        fake: FakeChatCompletions = self.server.fake
+        pieces, prompt_tokens, cached_tokens = fake.reply(request)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(pieces),
+            "total_tokens": prompt_tokens + len(pieces),
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = request.get("model", "")
+
+        time.sleep(fake.ttft)
+        if request.get("stream"):
+            self._stream(fake, completion_id, model, pieces, usage, request)
+            return
+
+        if fake.tokens_per_second:
+            time.sleep(len(pieces) / fake.tokens_per_second)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(pieces)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _stream(self, fake, completion_id, model, pieces, usage, request):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(choices, **extra):
+            self._write_chunk({
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            })
+
+        started = time.perf_counter()
+        for i, piece in enumerate(pieces):
+            if fake.tokens_per_second:
+                # Pace against the start time so sleep overshoot doesn't accumulate
+                delay = started + i / fake.tokens_per_second - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+            chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+        chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (request.get("stream_options") or {}).get("include_usage"):
+            chunk([], usage=usage)
+        self._write_raw(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self._write_raw(b"data: " + json.dumps(data).encode() + b"\n\n")
+
+    def _write_raw(self, payload: bytes):
+        self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,365 @@
+import asyncio
+import itertools
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, TypeVar
+
+from django.conf import settings
+from openai import RateLimitError
+
+from .metrics import prompt_cache_stats
+from .timing import cached_tokens, record_usage, stage
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Session the current request's model calls belong to; queued calls are
+# granted round-robin across sessions so one busy chat can't starve the rest
+_session_key: ContextVar[str] = ContextVar("ai_limiter_session", default="")
+
+# Waiters re-check the token budget this often: it frees up with time, not
+# only when a call finishes
+_POLL_SECONDS = 0.5
+
+
+def set_session_key(key: Any) -> None:
+    """Attribute the model calls made from this context to a chat session."""
+    _session_key.set(str(key))
+
+
+def current_session_key() -> str:
+    """The session set by `set_session_key` in this context, or ""."""
+    return _session_key.get()
+
+
+class ModelBusyError(Exception):
+    """A model call was not admitted: the wait queue was full or the wait timed out."""
+
+    def __init__(self, model: str, reason: str, retry_after: float):
+        super().__init__(f"{model}: {reason}")
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    """One queued call. Granted by whichever thread frees capacity; sync waiters
+    block on an Event, async ones await a future on their own loop."""
+
+    def __init__(self, session: str, tokens: int, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.session = session
+        self.tokens = tokens
+        self.granted = False
+        self.usage: Optional[List[Any]] = None
+        self._loop = loop
+        self._event = threading.Event() if loop is None else None
+        self.future: Optional["asyncio.Future[None]"] = loop.create_future() if loop else None
+
+    def grant(self) -> None:
+        self.granted = True
+        if self._event is not None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(_resolve, self.future)
+
+    def wait(self, timeout: float) -> None:
+        self._event.wait(timeout)
+
+
+def _resolve(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class Lease:
+    """An admitted call. `settle()` replaces the token estimate with actual usage."""
+
+    def __init__(self, limiter: "ModelLimiter", usage: List[Any]):
+        self._limiter = limiter
+        self._usage = usage
+
+    def settle(self, tokens: int) -> None:
+        self._limiter._settle(self._usage, tokens)
+
+
+class ModelLimiter:
+    """Process-wide admission control for one upstream model.
+
+    A call is admitted while fewer than `max_in_flight` are running and its
+    token estimate fits in the rolling one-minute `tokens_per_minute` budget.
+    Otherwise it waits in a bounded queue — at most `max_queue` calls, each for
+    at most `queue_timeout` seconds — and `ModelBusyError` is raised instead of
+    queueing forever. A 429 from the provider pauses admissions for every
+    caller (exponential backoff with jitter) before the call is retried.
+    """
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(
+        self,
+        model: str,
+        max_in_flight: int,
+        tokens_per_minute: int,
+        max_queue: int,
+        queue_timeout: float,
+        retries: int,
+        backoff_seconds: float,
+    ):
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # [admitted_at, tokens, counted] per call admitted within the window
+        self._usage: Deque[List[Any]] = deque()
+        self._used_tokens = 0
+        self._queues: "OrderedDict[str, Deque[_Ticket]]" = OrderedDict()
+        self._waiting = 0
+        self._paused_until = 0.0
+
+    # -- Admission (all under self._lock) ------------------------------------
+
+    def _expire(self, now: float) -> None:
+        while self._usage and self._usage[0][0] <= now - self.WINDOW_SECONDS:
+            entry = self._usage.popleft()
+            entry[2] = False
+            self._used_tokens -= entry[1]
+
+    def _fits(self, tokens: int, now: float) -> bool:
+        if now < self._paused_until or self._in_flight >= self.max_in_flight:
+            return False
+        self._expire(now)
+        # A call bigger than the whole budget still runs, once nothing else is counted
+        return self._used_tokens + tokens <= self.tokens_per_minute or self._used_tokens == 0
+
+    def _admit(self, ticket: _Ticket, now: float) -> None:
+        self._in_flight += 1
+        ticket.usage = [now, ticket.tokens, True]
+        self._usage.append(ticket.usage)
+        self._used_tokens += ticket.tokens
+
+    def _enqueue(self, ticket: _Ticket) -> None:
+        now = time.monotonic()
+        if not self._waiting and self._fits(ticket.tokens, now):
+            self._admit(ticket, now)
+            ticket.granted = True
+            return
+        if self._waiting >= self.max_queue:
+            raise ModelBusyError(self.model, "wait queue is full", self._retry_after(now))
+        self._queues.setdefault(ticket.session, deque()).append(ticket)
+        self._waiting += 1
+
+    def _dispatch(self) -> None:
+        """Grant queued calls, taking sessions in rotation, while capacity lasts."""
+        now = time.monotonic()
+        while self._queues:
+            session, queue = next(iter(self._queues.items()))
+            if not self._fits(queue[0].tokens, now):
+                return
+            ticket = queue.popleft()
+            del self._queues[session]
+            if queue:
+                self._queues[session] = queue   # to the back of the rotation
+            self._waiting -= 1
+            self._admit(ticket, now)
+            ticket.grant()
+
+    def _abandon(self, ticket: _Ticket) -> bool:
+        """Take an ungranted ticket out of the queue; False if it was granted meanwhile."""
+        if ticket.granted:
+            return False
+        queue = self._queues[ticket.session]
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[ticket.session]
+        self._waiting -= 1
+        return True
+
+    def _retry_after(self, now: float) -> float:
+        return max(self._paused_until - now, _POLL_SECONDS)
+
+    def _release(self) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _settle(self, usage: List[Any], tokens: int) -> None:
+        with self._lock:
+            if usage[2]:
+                self._used_tokens += tokens - usage[1]
+                usage[1] = tokens
+
+    def _pause(self, attempt: int) -> float:
+        delay = self.backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.0)
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning("%s rate limited; pausing calls for %.1fs", self.model, delay)
+        return delay
+
+    # -- Leases ---------------------------------------------------------------
+
+    @contextmanager
+    def lease(self, tokens: int) -> Iterator[Lease]:
+        """Block until a call estimated at `tokens` may run; release it on exit."""
+        ticket = _Ticket(_session_key.get(), tokens)
+        deadline = time.monotonic() + self.queue_timeout
+        with self._lock:
+            self._enqueue(ticket)
+
+        if not ticket.granted:
+            with stage("queue"):
+                self._wait(ticket, deadline)
+
+        try:
+            yield Lease(self, ticket.usage)
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def alease(self, tokens: int) -> AsyncIterator[Lease]:
+        """Async variant of `lease`; waits without blocking the event loop."""
+        ticket = _Ticket(_session_key.get(), tokens, loop=asyncio.get_running_loop())
+        deadline = time.monotonic() + self.queue_timeout
+        with self._lock:
+            self._enqueue(ticket)
+
+        try:
+            if not ticket.granted:
+                with stage("queue"):
+                    await self._await(ticket, deadline)
+        except asyncio.CancelledError:
+            with self._lock:
+                abandoned = self._abandon(ticket)
+            if not abandoned:
+                self._release()
+            raise
+
+        try:
+            yield Lease(self, ticket.usage)
+        finally:
+            self._release()
+
+    def _wait(self, ticket: _Ticket, deadline: float) -> None:
+        while not ticket.granted:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    if self._abandon(ticket):
+                        raise ModelBusyError(self.model, "timed out waiting", self._retry_after(time.monotonic()))
+                return
+            ticket.wait(min(remaining, _POLL_SECONDS))
+            with self._lock:
+                self._dispatch()
+
+    async def _await(self, ticket: _Ticket, deadline: float) -> None:
+        while not ticket.granted:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                with self._lock:
+                    if self._abandon(ticket):
+                        raise ModelBusyError(self.model, "timed out waiting", self._retry_after(time.monotonic()))
+                return
+            try:
+                await asyncio.wait_for(asyncio.shield(ticket.future), min(remaining, _POLL_SECONDS))
+            except asyncio.TimeoutError:
+                with self._lock:
+                    self._dispatch()
+
+    # -- Calls ----------------------------------------------------------------
+
+    def call(self, fn: Callable[[], T], tokens: int) -> T:
+        """Run `fn` (one model request) under the limiter, retrying 429s."""
+        for attempt in itertools.count():
+            with self.lease(tokens) as lease:
+                try:
+                    response = fn()
+                except RateLimitError:
+                    # Hold back every caller, even when this one gives up
+                    self._pause(attempt)
+                    if attempt >= self.retries:
+                        raise
+                    continue
+                self._settle_response(lease, response, tokens)
+                return response
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], tokens: int) -> T:
+        """Async variant of `call`."""
+        for attempt in itertools.count():
+            async with self.alease(tokens) as lease:
+                try:
+                    response = await fn()
+                except RateLimitError:
+                    # Hold back every caller, even when this one gives up
+                    self._pause(attempt)
+                    if attempt >= self.retries:
+                        raise
+                    continue
+                self._settle_response(lease, response, tokens)
+                return response
+
+    async def astream(self, fn: Callable[[], AsyncIterator[Any]], tokens: int) -> AsyncIterator[Any]:
+        """Stream chunks from `fn()` under the limiter; the lease is held until
+        the stream ends. A 429 is only retried before the first chunk arrives."""
+        for attempt in itertools.count():
+            async with self.alease(tokens) as lease:
+                started = False
+                try:
+                    async with aclosing(fn()) as chunks:
+                        async for chunk in chunks:
+                            started = True
+                            if getattr(chunk, "usage_metadata", None):
+                                self._settle_response(lease, chunk, tokens)
+                            yield chunk
+                    return
+                except RateLimitError:
+                    if started:
+                        raise
+                    self._pause(attempt)
+                    if attempt >= self.retries:
+                        raise
+
+    def _settle_response(self, lease: Lease, response: Any, estimate: int) -> None:
+        # Every model call passes through here, so its usage is reported here too
+        usage = getattr(response, "usage_metadata", None) or {}
+        lease.settle(usage.get("total_tokens", estimate))
+        record_usage(self.model, usage)
+        if usage:
+            prompt_cache_stats.record(self.model, usage.get("input_tokens", 0), cached_tokens(usage))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "tokens_last_minute": self._used_tokens,
+                "paused_for": max(self._paused_until - time.monotonic(), 0.0),
+            }
+
+
+_limiters: Dict[str, ModelLimiter] = {}
+_lock = threading.Lock()
+
+
+def get_limiter(model: str) -> ModelLimiter:
+    """Return the process-wide limiter for `model` (AI_RATE_LIMITS, then its "default")."""
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(model)
+            if limiter is None:
+                config = {
+                    **settings.AI_RATE_LIMITS["default"],
+                    **settings.AI_RATE_LIMITS.get(model, {}),
+                }
+                limiter = _limiters[model] = ModelLimiter(model, **config)
+    return limiter
@@ -0,0 +1,192 @@
+import logging
+import threading
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class SpeculationStats:
+    """Process-wide counters for speculative classify + generate.
+
+    A "hit" is a speculative run the classifier confirmed ("generate"): the
+    classifier round-trip overlapped the generation instead of preceding it.
+    A "miss" is a run the classifier turned into "ask": the generation was
+    cancelled or discarded and whatever it produced is wasted spend.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.latency_saved_ms = 0.0
+            self.wasted_completion_tokens = 0
+
+    def record_hit(self, latency_saved_ms: float) -> None:
+        with self._lock:
+            self.hits += 1
+            self.latency_saved_ms += latency_saved_ms
+        logger.info("speculation hit: saved %.0f ms", latency_saved_ms)
+
+    def record_miss(self) -> None:
+        with self._lock:
+            self.misses += 1
+        logger.info("speculation miss: generation discarded")
+
+    def record_waste(self, completion_tokens: int) -> None:
+        """Tokens a discarded generation produced (known only once it stops)."""
+        with self._lock:
+            self.wasted_completion_tokens += completion_tokens
+        logger.info("speculation waste: %d completion tokens", completion_tokens)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            runs = self.hits + self.misses
+            return {
+                "runs": runs,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / runs if runs else 0.0,
+                "latency_saved_ms": self.latency_saved_ms,
+                "wasted_completion_tokens": self.wasted_completion_tokens,
+            }
+
+
+speculation_stats = SpeculationStats()
+
+
+class CacheStats:
+    """Process-wide hit/miss counters for one cache layer."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def record(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        logger.info("%s cache %s", self.name, "hit" if hit else "miss")
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "lookups": lookups,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+response_cache_stats = CacheStats("response")
+semantic_cache_stats = CacheStats("semantic")
+# A "hit" is a generation that joined an identical one already in flight
+coalesce_stats = CacheStats("coalesced")
+
+
+class ClassifierStats:
+    """Process-wide counters for the local fast-path classifier.
+
+    `local` counts turns decided without a model call, by rule; `model` counts
+    turns that fell through to gpt-4o-mini. Shadow checks re-run a sample of
+    local decisions through the model to measure agreement.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.local: Dict[str, int] = {}
+            self.model = 0
+            self.shadow_agree = 0
+            self.shadow_disagree = 0
+
+    def record_local(self, rule: str) -> None:
+        with self._lock:
+            self.local[rule] = self.local.get(rule, 0) + 1
+        logger.info("classifier fast path: %s", rule)
+
+    def record_model(self) -> None:
+        with self._lock:
+            self.model += 1
+
+    def record_shadow(self, rule: str, local_action: str, model_action: str) -> None:
+        agree = local_action == model_action
+        with self._lock:
+            if agree:
+                self.shadow_agree += 1
+            else:
+                self.shadow_disagree += 1
+        if not agree:
+            logger.info("classifier fast path disagreement: rule=%s model=%s", rule, model_action)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            local_total = sum(self.local.values())
+            total = local_total + self.model
+            shadowed = self.shadow_agree + self.shadow_disagree
+            return {
+                "turns": total,
+                "local": dict(self.local),
+                "model": self.model,
+                "local_rate": local_total / total if total else 0.0,
+                "shadowed": shadowed,
+                "agreement": self.shadow_agree / shadowed if shadowed else 0.0,
+            }
+
+
+classifier_stats = ClassifierStats()
+
+
+class PromptCacheStats:
+    """Process-wide, per-model share of input tokens served from the provider's
+    prompt cache. Cached tokens are billed at a discount and skip prefill, so a
+    falling ratio shows up as higher cost and time to first token."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.models: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model: str, prompt_tokens: int, cached_tokens: int) -> None:
+        with self._lock:
+            totals = self.models.setdefault(model, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+            totals["calls"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["cached_tokens"] += cached_tokens
+        logger.info(
+            "%s prompt cache: %d of %d input tokens cached (%.0f%%)",
+            model, cached_tokens, prompt_tokens, 100 * cached_tokens / prompt_tokens if prompt_tokens else 0,
+        )
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                model: {
+                    **totals,
+                    "cached_ratio": (
+                        totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+                    ),
+                }
+                for model, totals in self.models.items()
+            }
+
+
+prompt_cache_stats = PromptCacheStats()
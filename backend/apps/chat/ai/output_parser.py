@@ -1,5 +1,5 @@
 import re
-from typing import List, Dict
+from typing import Callable, List, Dict, Optional
 
 
 # Matches fenced code blocks: ```language\n// filename: X\n...code...```
@@ -14,19 +14,31 @@ def parse_code_blocks(text: str) -> List[Dict[str, str]]:
 
     Returns a list of dicts: [{language, filename, code}]
     """
-    blocks = []
-    for match in _CODE_BLOCK_RE.finditer(text):
-        language = match.group(1).strip()
-        filename = match.group(2) or _default_filename(language)
-        code = match.group(3).strip()
-        blocks.append(
-            {
-                "language": language,
-                "filename": filename,
-                "code": code,
-            }
-        )
-    return blocks
+    return [_block_from_match(match) for match in _CODE_BLOCK_RE.finditer(text)]
+
+
+def replace_code_blocks(
+    text: str,
+    replacement: Callable[[Dict[str, str]], Optional[str]],
+) -> str:
+    """Substitute every fenced code block in `text` with `replacement(block)`,
+    where `block` is the same {language, filename, code} dict `parse_code_blocks`
+    returns. A replacement of None leaves that block untouched."""
+
+    def _sub(match: "re.Match[str]") -> str:
+        replaced = replacement(_block_from_match(match))
+        return match.group(0) if replaced is None else replaced
+
+    return _CODE_BLOCK_RE.sub(_sub, text)
+
+
+def _block_from_match(match: "re.Match[str]") -> Dict[str, str]:
+    language = match.group(1).strip()
+    return {
+        "language": language,
+        "filename": match.group(2) or _default_filename(language),
+        "code": match.group(3).strip(),
+    }
 
 
 def _default_filename(language: str) -> str:
@@ -39,3 +51,31 @@ def _default_filename(language: str) -> str:
         "html": "index.html",
     }
     return extension_map.get(language, f"file.{language}")
+
+
+class CodeBlockStreamParser:
+    """Incrementally extract fenced code blocks from a streamed LLM response.
+
+    Feed it content deltas as they arrive; each call returns the code blocks
+    that were completed by that delta, in the same shape as `parse_code_blocks`.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0   # offset just past the last completed block
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def feed(self, delta: str) -> List[Dict[str, str]]:
+        self._text += delta
+        # A block can only close on a backtick — skip the regex scan otherwise
+        if "`" not in delta:
+            return []
+
+        blocks = []
+        for match in _CODE_BLOCK_RE.finditer(self._text, self._pos):
+            blocks.append(_block_from_match(match))
+            self._pos = match.end()
+        return blocks
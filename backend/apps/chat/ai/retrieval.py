@@ -0,0 +1,165 @@
+"""Recall of earlier exchanges relevant to the next request.
+
+Turns folded into a session's running summary keep their requirements but lose
+their code. When a request refers back to one ("go back to the navbar from
+before"), a per-session BM25 index over the folded exchanges finds it, and the
+exchange is replayed in full next to the request, within a small token budget.
+The index lives in the process and is extended as more turns are folded.
+"""
+import heapq
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import Any, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .token_manager import HistoryEntry, count_tokens
+
+# History role for the recalled exchanges (one entry holding all of them)
+RECALL_ROLE = "recalled"
+
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+_CAMEL_RE = re.compile(r"[A-Z]?[a-z0-9]+|[A-Z]+(?![a-z])")
+
+# Words that say nothing about which component a turn was about
+_STOP_WORDS = frozenset(
+    "a an the and or of to in on at for from with by as is are was be it its this that these those "
+    "i me my we us you your please can could would should will create make build generate give write "
+    "want need show add use go back again before earlier previous one like just now then also so "
+    "tsx import export default const return react".split()
+)
+
+# A row handed to `SessionIndex.extend`: (pk, role, content, token_count, created_at)
+IndexRow = Tuple[Any, str, str, int, datetime]
+
+
+def terms(text: str) -> List[str]:
+    """Lowercased words of `text`; camelCase identifiers also yield their parts."""
+    found = []
+    for word in _WORD_RE.findall(text):
+        parts = _CAMEL_RE.findall(word)
+        for term in [word, *parts] if len(parts) > 1 else [word]:
+            term = term.casefold()
+            if term not in _STOP_WORDS:
+                found.append(term)
+    return found
+
+
+class BM25Index:
+    """Okapi BM25 over a growing set of documents, each carrying a payload."""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: List[Tuple[Counter, int, Any]] = []
+        self._df: Counter = Counter()
+        self._total_length = 0
+
+    def add(self, text: str, payload: Any) -> None:
+        found = terms(text)
+        counts = Counter(found)
+        self._docs.append((counts, len(found), payload))
+        self._df.update(counts.keys())
+        self._total_length += len(found)
+
+    def search(self, query: str, limit: int) -> List[Tuple[float, Any]]:
+        """Up to `limit` (score, payload) pairs sharing a term with `query`, best first."""
+        if not self._docs:
+            return []
+        n = len(self._docs)
+        avg_length = self._total_length / n or 1
+        idf = {
+            term: math.log(1 + (n - self._df[term] + 0.5) / (self._df[term] + 0.5))
+            for term in set(terms(query))
+            if term in self._df
+        }
+
+        scored = []
+        for counts, length, payload in self._docs:
+            norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+            score = sum(
+                weight * counts[term] * (self.k1 + 1) / (counts[term] + norm)
+                for term, weight in idf.items()
+                if term in counts
+            )
+            if score > 0:
+                scored.append((score, payload))
+        return heapq.nlargest(limit, scored, key=lambda hit: hit[0])
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+
+class SessionIndex:
+    """BM25 over one session's folded exchanges: a user message and the reply to it.
+
+    Payloads are message pks and token counts, not text; the recalled messages
+    are read back from the database.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bm25 = BM25Index()
+        self._pending: Optional[IndexRow] = None   # a user message whose reply isn't indexed yet
+        self.indexed_until: Optional[datetime] = None
+
+    def extend(self, rows: Iterable[IndexRow]) -> None:
+        """Index rows (oldest first) newer than `indexed_until`; safe to call
+        concurrently with overlapping rows."""
+        with self._lock:
+            for row in rows:
+                pk, role, content, token_count, created_at = row
+                if self.indexed_until is not None and created_at <= self.indexed_until:
+                    continue
+                self.indexed_until = created_at
+                if role == "user":
+                    self._pending = row
+                    continue
+                user = self._pending
+                self._pending = None
+                pks = (user[0], pk) if user else (pk,)
+                tokens = (user[3] if user else 0) + token_count
+                self._bm25.add(f"{user[2]}\n{content}" if user else content, (created_at, pks, tokens))
+
+    def recall(self, query: str, top_k: int, max_tokens: int, min_score: float) -> List[Any]:
+        """Pks of the messages in the (at most `top_k`) best-matching exchanges
+        scoring at least `min_score` that fit in `max_tokens`, oldest first."""
+        with self._lock:
+            hits = self._bm25.search(query, limit=max(top_k * 4, 8))
+
+        chosen, total = [], 0
+        for score, (created_at, pks, tokens) in hits:
+            if score < min_score or len(chosen) == top_k:
+                break
+            if total + tokens <= max_tokens:
+                chosen.append((created_at, pks))
+                total += tokens
+        return [pk for _, pks in sorted(chosen) for pk in pks]
+
+
+def recalled_entry(entries: List[HistoryEntry]) -> HistoryEntry:
+    """One RECALL_ROLE history entry replaying `entries` as a transcript,
+    counted as rendered (role prefixes and separators included)."""
+    text = "\n\n".join(f"{role.upper()}: {content}" for role, content, *_ in entries)
+    return (RECALL_ROLE, text, count_tokens(text))
+
+
+_indexes: "OrderedDict[str, SessionIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_session_index(session_id: Any) -> SessionIndex:
+    """Return the process's index for a session, creating an empty one on first
+    use; the least recently used are dropped past AI_RECALL_MAX_SESSIONS."""
+    key = str(session_id)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = SessionIndex()
+        _indexes.move_to_end(key)
+        while len(_indexes) > settings.AI_RECALL_MAX_SESSIONS:
+            _indexes.popitem(last=False)
+    return index
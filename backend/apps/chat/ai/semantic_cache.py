@@ -0,0 +1,165 @@
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import semantic_cache_stats
+
+# Sparse embedding: {dimension: weight}, L2-normalized so a dot product is the cosine
+SparseVector = Dict[int, float]
+
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Request phrasing that says nothing about the component itself
+_FILLER_WORDS = frozenset(
+    "a an the me my i we us please can could would you create make build "
+    "generate give write want need show design some for".split()
+)
+
+# Words a near-duplicate must repeat exactly: swapping one ("three tiers" for
+# "four tiers", "dark" for "light", "with" for "without") changes the component
+# while moving a long request's embedding by only a few hundredths
+_NUMBER_WORDS = frozenset(
+    "zero one two three four five six seven eight nine ten eleven twelve "
+    "single double triple first second third fourth fifth half".split()
+)
+_COLOUR_WORDS = frozenset(
+    "black white gray grey silver red orange amber yellow lime green emerald teal cyan "
+    "sky blue indigo violet purple fuchsia pink rose brown beige gold navy "
+    "dark light transparent monochrome colorful colourful".split()
+)
+_NEGATION_WORDS = frozenset("no not without never none nor except".split())
+_SPECIFIC_WORDS = _NUMBER_WORDS | _COLOUR_WORDS | _NEGATION_WORDS
+
+
+def specifics(text: str) -> FrozenSet[str]:
+    """The numbers, colours and negations in `text`; cached results are only
+    served to requests with exactly the same set."""
+    words = _WORD_RE.findall(text.casefold().replace("n't", " not"))
+    return frozenset(word for word in words if word.isdigit() or word in _SPECIFIC_WORDS)
+
+
+class HashedNgramEmbedder:
+    """Offline embedder: hashed word unigrams plus character n-grams.
+
+    Cheap and dependency-free; good at "create a login form" vs "make me a
+    login form please", blind to true synonyms. Swap in a model-backed
+    embedder via AI_SEMANTIC_CACHE_EMBEDDER — anything with an
+    `embed(text) -> SparseVector` method (normalized) will do.
+    """
+
+    def __init__(self, ngram: int = 3, dimensions: int = 1 << 18):
+        self.ngram = ngram
+        self.dimensions = dimensions
+
+    def embed(self, text: str) -> SparseVector:
+        words = [w for w in _WORD_RE.findall(text.casefold()) if w not in _FILLER_WORDS]
+
+        vector: SparseVector = {}
+        for word in words:
+            self._add(vector, "w:" + word, 1.0)
+            padded = f" {word} "
+            for i in range(len(padded) - self.ngram + 1):
+                self._add(vector, "c:" + padded[i:i + self.ngram], 0.5)
+
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        if norm == 0:
+            return {}
+        return {dim: weight / norm for dim, weight in vector.items()}
+
+    def _add(self, vector: SparseVector, feature: str, weight: float) -> None:
+        digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+        dim = int.from_bytes(digest, "little") % self.dimensions
+        vector[dim] = vector.get(dim, 0.0) + weight
+
+
+def cosine(a: SparseVector, b: SparseVector) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(dim, 0.0) for dim, weight in a.items())
+
+
+class SemanticCache:
+    """Bounded in-process similarity index of answered first-turn requests.
+
+    A linear scan is fine at this size (a few thousand sparse dot products);
+    the least recently hit entry is evicted once `max_entries` is reached.
+    Only entries with the request's exact `specifics` are candidates.
+    """
+
+    def __init__(self, embedder: Any, threshold: float, max_entries: int):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[SparseVector, FrozenSet[str], Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, user_input: str) -> Optional[Dict[str, Any]]:
+        """Return the cached result of the most similar request above threshold."""
+        query = self.embedder.embed(user_input)
+        required = specifics(user_input)
+        best_key, best_score = None, self.threshold
+
+        with self._lock:
+            for key, (vector, pinned, _) in self._entries.items():
+                if pinned != required:
+                    continue
+                score = cosine(query, vector)
+                if score >= best_score:
+                    best_key, best_score = key, score
+
+            if best_key is None:
+                semantic_cache_stats.record(hit=False)
+                return None
+            self._entries.move_to_end(best_key)
+            result = self._entries[best_key][2]
+
+        semantic_cache_stats.record(hit=True)
+        return {
+            **result,
+            "prompt_tokens": 0,
+            "cached_prompt_tokens": 0,
+            "cached": True,
+            "similarity": round(best_score, 3),
+        }
+
+    def store(self, user_input: str, result: Dict[str, Any]) -> None:
+        vector = self.embedder.embed(user_input)
+        if not vector:
+            return
+        key = " ".join(user_input.split()).casefold()
+        entry = {field: result[field] for field in ("content", "code_blocks", "token_count")}
+
+        with self._lock:
+            self._entries[key] = (vector, specifics(user_input), entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_cache: Optional[SemanticCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """Return the process-wide first-turn similarity cache, or None when disabled."""
+    global _cache
+    if not settings.AI_SEMANTIC_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticCache(
+                    embedder=import_string(settings.AI_SEMANTIC_CACHE_EMBEDDER)(),
+                    threshold=settings.AI_SEMANTIC_CACHE_THRESHOLD,
+                    max_entries=settings.AI_SEMANTIC_CACHE_MAX_ENTRIES,
+                )
+    return _cache
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# The trace of the request being served; copied into worker threads and tasks
+# along with the rest of the context, so their stages land in the same trace
+_current: ContextVar[Optional["Trace"]] = ContextVar("ai_trace", default=None)
+
+
+class Trace:
+    """Wall time per pipeline stage and provider-reported token usage for one turn.
+
+    Stages may overlap (a speculative generation runs alongside the
+    classifier) and repeat (each call adds to its stage's total).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.tokens: Dict[str, Dict[str, int]] = {}
+
+    def add_stage(self, name: str, ms: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def add_usage(self, model: str, usage: Dict[str, Any]) -> None:
+        """Fold in a LangChain `usage_metadata` dict for one call to `model`."""
+        with self._lock:
+            totals = self.tokens.setdefault(model, {"prompt": 0, "completion": 0, "cached": 0})
+            totals["prompt"] += usage.get("input_tokens", 0)
+            totals["completion"] += usage.get("output_tokens", 0)
+            totals["cached"] += cached_tokens(usage)
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000
+
+    def record(self) -> Dict[str, Any]:
+        """Compact form persisted with the assistant message (Message.usage)."""
+        with self._lock:
+            return {
+                "ms": {name: round(ms, 1) for name, ms in self.stages.items()},
+                "tokens": {model: dict(totals) for model, totals in self.tokens.items()},
+            }
+
+    def server_timing(self) -> str:
+        """`Server-Timing` header value: each stage, then the total so far."""
+        with self._lock:
+            entries = [f"{name};dur={ms:.1f}" for name, ms in self.stages.items()]
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+
+def cached_tokens(usage: Optional[Dict[str, Any]]) -> int:
+    """Input tokens a LangChain `usage_metadata` dict reports as prompt-cache hits."""
+    details = (usage or {}).get("input_token_details") or {}
+    return details.get("cache_read", 0) or 0
+
+
+def start_trace(trace: Optional[Trace] = None) -> Tuple[Trace, Token]:
+    """Make `trace` (or a new one) the current context's trace. Returns it and
+    the token to pass to `end_trace` once the turn is done, so a thread that
+    serves requests one after another never times stages into a stale trace."""
+    trace = trace or Trace()
+    return trace, _current.set(trace)
+
+
+def end_trace(token: Token) -> None:
+    """Restore the trace that was current before the matching `start_trace`."""
+    _current.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the enclosed block as `name` in the current trace, if there is one."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_stage(name, (time.perf_counter() - started) * 1000)
+
+
+def record_usage(model: str, usage: Optional[Dict[str, Any]]) -> None:
+    trace = _current.get()
+    if trace is not None and usage:
+        trace.add_usage(model, usage)
+
+
+_sink: Optional[Callable[[Dict[str, Any]], None]] = None
+_sink_lock = threading.Lock()
+
+
+def emit(record: Dict[str, Any]) -> None:
+    """Hand a finished turn's record to AI_TRACE_SINK (a dotted path to a callable),
+    e.g. to export it to a metrics backend. Sink errors, including a path that
+    doesn't import, are logged, never raised."""
+    global _sink
+    if not settings.AI_TRACE_SINK:
+        return
+    try:
+        if _sink is None:
+            with _sink_lock:
+                if _sink is None:
+                    _sink = import_string(settings.AI_TRACE_SINK)
+        _sink(record)
+    except Exception:
+        logger.warning("AI trace sink failed", exc_info=True)
+
+
+def log_sink(record: Dict[str, Any]) -> None:
+    """A sink that logs each record at INFO."""
+    logger.info("ai trace %s", record)
@@ -1,12 +1,21 @@
 import tiktoken
-from typing import List, Tuple
+from typing import List, Tuple, Union
 
 MODEL_NAME = "gpt-4o"
 MAX_CONTEXT_TOKENS = 128_000
 MAX_RESPONSE_TOKENS = 4_096
-# Reserve budget for system prompt + few-shot examples (~2 500 tokens)
-SYSTEM_OVERHEAD = 2_500
-MAX_HISTORY_TOKENS = MAX_CONTEXT_TOKENS - MAX_RESPONSE_TOKENS - SYSTEM_OVERHEAD
+# What's left for the prompt; UIGeneratorChain trims history to this less its
+# measured prefix and the current input
+MAX_PROMPT_TOKENS = MAX_CONTEXT_TOKENS - MAX_RESPONSE_TOKENS
+# Chat formatting per message (role and delimiters), and the priming of the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+# trim_history drops the oldest turns in runs of this many tokens (see there)
+TRIM_CHUNK_TOKENS = 8_192
+
+# A history entry is (role, content), or (role, content, token_count) when the
+# count was stored with the message — trim_history then never re-encodes it.
+HistoryEntry = Union[Tuple[str, str], Tuple[str, str, int]]
 
 _encoder = None
 
@@ -22,25 +31,41 @@ def count_tokens(text: str) -> int:
     return len(_get_encoder().encode(text))
 
 
+def entry_tokens(entry: HistoryEntry) -> int:
+    """Token cost of one history entry, preferring the count stored with it."""
+    stored = entry[2] if len(entry) > 2 else 0
+    return (stored or count_tokens(entry[1])) + MESSAGE_OVERHEAD
+
+
+def message_tokens(text: str) -> int:
+    """Token cost of one chat message with content `text`."""
+    return count_tokens(text) + MESSAGE_OVERHEAD
+
+
 def trim_history(
-    messages: List[Tuple[str, str]],
-    max_tokens: int = MAX_HISTORY_TOKENS,
-) -> List[Tuple[str, str]]:
+    messages: List[HistoryEntry],
+    max_tokens: int = MAX_PROMPT_TOKENS,
+    chunk_tokens: int = TRIM_CHUNK_TOKENS,
+) -> List[HistoryEntry]:
     """Sliding-window trim: keeps the most recent messages that fit within max_tokens.
 
     GPT-4o has a 128K context window, so for most conversations this function
-    returns the full history unchanged.
+    returns the full history unchanged. Entries carrying a stored token count
+    cost a summation, not an encode.
+
+    Once over budget, the oldest messages go in runs of about chunk_tokens,
+    measured from the start of the history. The first kept message then stays
+    put for several turns rather than moving every turn, and so does the
+    prompt prefix the provider caches.
     """
-    total = 0
-    kept: List[Tuple[str, str]] = []
-
-    for role, content in reversed(messages):
-        # tiktoken overhead: ~4 tokens per message for role/formatting markers
-        msg_tokens = count_tokens(content) + 4
-        if total + msg_tokens > max_tokens:
-            break
-        kept.append((role, content))
-        total += msg_tokens
-
-    kept.reverse()
-    return kept
+    costs = [entry_tokens(entry) for entry in messages]
+    excess = sum(costs) - max_tokens
+    if excess <= 0:
+        return list(messages)
+
+    to_drop = -(-excess // chunk_tokens) * chunk_tokens   # rounded up to whole chunks
+    dropped = start = 0
+    while start < len(messages) and dropped < to_drop:
+        dropped += costs[start]
+        start += 1
+    return messages[start:]
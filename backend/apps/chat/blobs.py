@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import zlib
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .models import CodeBlob, Message
+
+logger = logging.getLogger(__name__)
+
+CodeBlocks = List[Dict[str, str]]
+
+
+def store_code_blocks(blocks: CodeBlocks) -> CodeBlocks:
+    """Save each block's code as a CodeBlob and return the blocks with the code
+    replaced by its sha256. Already-stored code costs no extra row."""
+    refs: CodeBlocks = []
+    blobs: Dict[str, CodeBlob] = {}
+    for block in blocks:
+        code = block["code"].encode()
+        digest = hashlib.sha256(code).hexdigest()
+        if digest not in blobs:
+            blobs[digest] = CodeBlob(sha256=digest, data=zlib.compress(code), size=len(code))
+        refs.append({"language": block["language"], "filename": block["filename"], "sha256": digest})
+
+    if blobs:
+        # Re-stored code gets a fresh created_at, which delete_unreferenced_blobs
+        # spares while the message referencing it is still being written
+        CodeBlob.objects.bulk_create(
+            blobs.values(),
+            update_conflicts=True,
+            unique_fields=["sha256"],
+            update_fields=["created_at"],
+        )
+    return refs
+
+
+def resolve_code_blocks(block_lists: Iterable[CodeBlocks]) -> None:
+    """Replace blob references in each list, in place, with the code they point to.
+
+    One query covers every list, so resolve a whole page of messages at once.
+    """
+    block_lists = list(block_lists)
+    digests = _digests(block_lists)
+    if not digests:
+        return
+    rows = CodeBlob.objects.filter(sha256__in=digests).values_list("sha256", "data")
+    _fill(block_lists, {digest: data for digest, data in rows})
+
+
+async def aresolve_code_blocks(block_lists: Iterable[CodeBlocks]) -> None:
+    """Async variant of `resolve_code_blocks`."""
+    block_lists = list(block_lists)
+    digests = _digests(block_lists)
+    if not digests:
+        return
+    rows = CodeBlob.objects.filter(sha256__in=digests).values_list("sha256", "data")
+    _fill(block_lists, {digest: data async for digest, data in rows})
+
+
+def delete_unreferenced_blobs(created_before: datetime, batch_size: int = 1000) -> Tuple[int, int]:
+    """Delete CodeBlobs created before `created_before` that no message's
+    code_blocks reference. Returns (blobs deleted, uncompressed bytes freed).
+
+    The cutoff spares blobs whose message is still being written: storing a
+    message (re)stamps its blobs just before it. The reference check is an
+    anti-join in the database, matched on the digest in the JSON text, and the
+    delete applies it again with the cutoff, so a blob re-stored meanwhile stays.
+    """
+    referencing = Message.objects.filter(code_blocks__icontains=OuterRef("sha256"))
+    orphans = CodeBlob.objects.filter(created_at__lt=created_before).exclude(Exists(referencing))
+
+    deleted = freed = 0
+    while True:
+        with transaction.atomic():
+            batch = list(orphans.select_for_update().values_list("sha256", "size")[:batch_size])
+            if not batch:
+                return deleted, freed
+            count, _ = orphans.filter(sha256__in=[digest for digest, _ in batch]).delete()
+        deleted += count
+        freed += sum(size for _, size in batch)
+
+
+def _digests(block_lists: List[CodeBlocks]) -> set:
+    return {block["sha256"] for blocks in block_lists for block in blocks if "sha256" in block}
+
+
+def _fill(block_lists: List[CodeBlocks], data_by_digest: Dict[str, bytes]) -> None:
+    for blocks in block_lists:
+        for i, block in enumerate(blocks):
+            if "sha256" in block:
+                data = data_by_digest.get(block["sha256"])
+                if data is None:
+                    # Serve the rest of the message rather than fail the page
+                    logger.warning("Code blob %s is missing", block["sha256"])
+                blocks[i] = {
+                    "language": block["language"],
+                    "filename": block["filename"],
+                    "code": zlib.decompress(data).decode() if data is not None else "",
+                }
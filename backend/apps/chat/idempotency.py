@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .models import GenerationJob, IdempotencyKey, Message, Session
+
+logger = logging.getLogger(__name__)
+
+# A duplicate waiting on the first request re-reads its row this often
+_POLL_SECONDS = 0.2
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = "This Idempotency-Key was already used for a different message."
+    default_code = "idempotency_key_reused"
+
+
+class IdempotencyKeyInProgress(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "A request with this Idempotency-Key is still being processed."
+    default_code = "idempotency_key_in_progress"
+
+
+def claim_idempotency_key(
+    session: Session,
+    key: str,
+    content: str,
+    **options: Any,
+) -> Tuple[IdempotencyKey, bool]:
+    """Return (record, owned) for `key` in `session`.
+
+    `options` are the rest of what shapes the reply (e.g. respond_async,
+    content_format); reusing the key with different content or options is
+    rejected with IdempotencyKeyReused.
+
+    When `owned`, the caller does the work, then calls `complete_idempotency_key`
+    (or `release_idempotency_key` if it fails). Otherwise `record` is a completed
+    earlier request to replay. While another request holds the key this waits
+    for it — up to CHAT_IDEMPOTENCY_WAIT seconds, then IdempotencyKeyInProgress —
+    and takes the key over if that request fails.
+    """
+    request = json.dumps([content, options], sort_keys=True, ensure_ascii=False)
+    request_hash = hashlib.sha256(request.encode()).hexdigest()
+    deadline = time.monotonic() + settings.CHAT_IDEMPOTENCY_WAIT
+    _purge_expired()
+
+    while True:
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    session=session, key=key, request_hash=request_hash
+                )
+            return record, True
+        except IntegrityError:
+            pass
+
+        while True:
+            record = (
+                IdempotencyKey.objects.filter(session=session, key=key)
+                .select_related("assistant_message", "job__assistant_message")
+                .first()
+            )
+            if record is None:
+                break   # the first request failed and released the key
+            if record.request_hash != request_hash:
+                raise IdempotencyKeyReused()
+            if record.completed:
+                return record, False
+            if time.monotonic() >= deadline:
+                raise IdempotencyKeyInProgress()
+            time.sleep(_POLL_SECONDS)
+
+
+def complete_idempotency_key(
+    record: IdempotencyKey,
+    assistant_message: Optional[Message] = None,
+    job: Optional[GenerationJob] = None,
+) -> None:
+    """Attach the outcome, releasing any duplicates waiting on the key.
+
+    Should the key have been purged meanwhile (its request outlived
+    AI_GENERATION_MAX_SECONDS), it is recorded again so later retries replay
+    this outcome, unless a retry has already taken the key over.
+    """
+    updated = IdempotencyKey.objects.filter(pk=record.pk).update(
+        assistant_message=assistant_message, job=job
+    )
+    if updated:
+        return
+    logger.warning("Idempotency-Key %r expired before its request finished", record.key)
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                session_id=record.session_id,
+                key=record.key,
+                request_hash=record.request_hash,
+                assistant_message=assistant_message,
+                job=job,
+            )
+    except IntegrityError:
+        pass   # a retry holds the key now and answers for itself
+
+
+def release_idempotency_key(record: IdempotencyKey) -> None:
+    """Forget a key whose request failed, so a retry runs it again."""
+    IdempotencyKey.objects.filter(pk=record.pk).delete()
+
+
+def _purge_expired() -> None:
+    now = timezone.now()
+    IdempotencyKey.objects.filter(
+        Q(created_at__lt=now - timedelta(seconds=settings.CHAT_IDEMPOTENCY_TTL))
+        # Still in progress after the longest a turn can take: its process died mid-request
+        | Q(
+            assistant_message=None,
+            job=None,
+            created_at__lt=now - timedelta(seconds=settings.AI_GENERATION_MAX_SECONDS),
+        )
+    ).delete()
@@ -0,0 +1,127 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import GenerationJob, Message, Session
+from .services import load_context, record_assistant_message
+from .ai.chain import get_generator_chain
+from .ai.limiter import set_session_key
+from .ai.timing import end_trace, start_trace
+
+logger = logging.getLogger(__name__)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Process-wide worker pool; its size caps concurrent background generations."""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.AI_JOB_WORKERS,
+                    thread_name_prefix="generation-job",
+                )
+    return _executor
+
+
+def enqueue_generation(session: Session, user_msg: Message) -> GenerationJob:
+    """Queue the assistant reply to `user_msg` and return its job.
+
+    The job row is the queue entry: it is handed to the worker pool once the
+    surrounding transaction commits, and picked up again by
+    `resume_queued_jobs` if the process dies first.
+    """
+    job = GenerationJob.objects.create(session=session, user_message=user_msg)
+    transaction.on_commit(lambda: _submit(job.pk))
+    return job
+
+
+def _submit(job_id) -> None:
+    _get_executor().submit(_run_in_worker, job_id)
+
+
+def _run_in_worker(job_id) -> None:
+    # Worker threads outlive requests; manage their DB connections like one
+    close_old_connections()
+    try:
+        run_job(job_id)
+    finally:
+        close_old_connections()
+
+
+def run_job(job_id) -> None:
+    """Generate and store the reply for one queued job.
+
+    The queued → running transition is a conditional UPDATE, so a job
+    submitted twice (e.g. resumed by two processes) only runs once. Once
+    claimed, the job always ends SUCCEEDED or FAILED.
+    """
+    claimed = GenerationJob.objects.filter(
+        pk=job_id, status=GenerationJob.Status.QUEUED
+    ).update(status=GenerationJob.Status.RUNNING, started_at=timezone.now())
+    if not claimed:
+        return
+
+    _, trace_token = start_trace()
+    outcome = {"status": GenerationJob.Status.FAILED, "error": "Generation failed."}
+    try:
+        job = GenerationJob.objects.select_related("session", "user_message").get(pk=job_id)
+        session, user_msg = job.session, job.user_message
+        set_session_key(session.pk)
+        history = load_context(session, exclude=user_msg)
+        chain = get_generator_chain()
+        result = chain.classify_and_invoke(user_msg.content, history, session.ask_rounds)
+        outcome = {
+            "status": GenerationJob.Status.SUCCEEDED,
+            "error": "",
+            "assistant_message": record_assistant_message(session, result),
+        }
+    except Exception:
+        logger.exception("Generation job %s failed", job_id)
+    finally:
+        GenerationJob.objects.filter(pk=job_id).update(finished_at=timezone.now(), **outcome)
+        # Pool threads run one job after another
+        end_trace(trace_token)
+
+
+def resume_queued_jobs() -> None:
+    """Hand jobs still queued from a previous run of the process to the pool.
+
+    Jobs still running AI_GENERATION_MAX_SECONDS after they started lost their
+    process mid-generation; they are failed rather than rerun, since a live
+    process may yet finish one and a rerun would reply twice.
+    """
+    now = timezone.now()
+    try:
+        stale = GenerationJob.objects.filter(
+            status=GenerationJob.Status.RUNNING,
+            started_at__lt=now - timedelta(seconds=settings.AI_GENERATION_MAX_SECONDS),
+        ).update(
+            status=GenerationJob.Status.FAILED,
+            error="Generation was interrupted.",
+            finished_at=now,
+        )
+        job_ids = list(
+            GenerationJob.objects.filter(status=GenerationJob.Status.QUEUED)
+            .order_by("created_at")
+            .values_list("pk", flat=True)
+        )
+    except Exception:
+        logger.warning("Could not resume queued generation jobs", exc_info=True)
+        return
+
+    if stale:
+        logger.warning("Failed %d generation jobs left running by a previous process", stale)
+    for job_id in job_ids:
+        _submit(job_id)
+    if job_ids:
+        logger.info("Resumed %d queued generation jobs", len(job_ids))
@@ -0,0 +1,308 @@
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timezone as dt_timezone
+from pathlib import Path
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import override_settings, setup_databases, setup_test_environment, teardown_databases
+from rest_framework.test import APIClient
+
+from apps.chat import services
+from apps.chat.ai import chain as chain_module, classifier, compaction, token_manager
+from apps.chat.ai.fake_llm import FakeChatCompletions
+from apps.chat.models import Session
+from apps.chat.renderers import ORJSONRenderer
+from apps.chat.serializers import MessageSerializer
+
+_FIRST_TURN = (
+    "Build a pricing section with three tiers, a highlighted middle plan, "
+    "a monthly/yearly toggle and a feature list per tier (session {session})"
+)
+_FOLLOW_UPS = [
+    "make the buttons wider and add a hover state",
+    "add a footer with links to terms and privacy",
+    "switch to a dark theme with a subtle border",
+    "show a 'most popular' badge on the middle plan",
+    "reduce the padding on mobile",
+]
+
+# Where the non-model time goes. Stages nest: "trim" includes the tokenizing
+# it does for entries without a stored count.
+_STAGES = {
+    "trim": [(chain_module, "trim_history")],
+    "tokenize": [
+        (token_manager, "count_tokens"),
+        (chain_module, "count_tokens"),
+        (services, "count_tokens"),
+        (classifier, "count_tokens"),
+        (compaction, "count_tokens"),
+    ],
+    "parse": [(chain_module, "parse_code_blocks")],
+    "serialize": [(MessageSerializer, "to_representation"), (ORJSONRenderer, "render")],
+}
+
+_local = threading.local()
+
+
+def _timed(stage, fn):
+    """Wrap `fn` to add its thread CPU time to the current request's `stage`."""
+    def wrapper(*args, **kwargs):
+        started = time.thread_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stages = getattr(_local, "stages", None)
+            if stages is not None:
+                stages[stage] = stages.get(stage, 0.0) + time.thread_time() - started
+    return wrapper
+
+
+def _percentiles(values):
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {"p50": value, "p95": value, "p99": value, "mean": value, "max": value}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": round(cuts[49], 2), "p95": round(cuts[94], 2), "p99": round(cuts[98], 2),
+        "mean": round(statistics.fmean(values), 2), "max": round(max(values), 2),
+    }
+
+
+def _server_timing(header):
+    """{stage: ms} from a Server-Timing header value."""
+    stages = {}
+    for entry in filter(None, (part.strip() for part in header.split(","))):
+        name, _, params = entry.partition(";")
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "dur":
+                stages[name] = float(value)
+    return stages
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=settings.BASE_DIR, timeout=5, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive POST /api/sessions/:id/messages/ against a local fake model endpoint and "
+        "report latency percentiles, throughput, DB queries and per-stage CPU as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=16, help="Sessions to simulate (default: 16)")
+        parser.add_argument("--turns", type=int, default=6, help="Messages sent per session (default: 6)")
+        parser.add_argument("--concurrency", type=int, default=8, help="Sessions in flight at once (default: 8)")
+        parser.add_argument("--ttft", type=float, default=0.3, help="Fake model time to first token, seconds (default: 0.3)")
+        parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Fake model output rate; 0 = instant (default: 200)")
+        parser.add_argument("--completion-tokens", type=int, default=400, help="Tokens per generated reply (default: 400)")
+        parser.add_argument("--output", help="Write the JSON report here (default: bench_chat-<timestamp>.json)")
+        parser.add_argument("--baseline", help="An earlier report to compare against")
+
+    def handle(self, *args, **options):
+        if options["sessions"] < 1 or options["turns"] < 1 or options["concurrency"] < 1:
+            raise CommandError("--sessions, --turns and --concurrency must be at least 1")
+        baseline = None
+        if options["baseline"]:
+            try:
+                baseline = json.loads(Path(options["baseline"]).read_text())
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Can't read baseline: {exc}")
+
+        fake = FakeChatCompletions(
+            ttft=options["ttft"],
+            tokens_per_second=options["tokens_per_second"],
+            completion_tokens=options["completion_tokens"],
+        )
+        with ExitStack() as stack:
+            stack.enter_context(fake)
+            stack.enter_context(override_settings(
+                OPENAI_BASE_URL=fake.base_url,
+                OPENAI_API_KEY=settings.OPENAI_API_KEY or "bench",
+            ))
+            for stage, targets in _STAGES.items():
+                for owner, name in targets:
+                    stack.enter_context(mock.patch.object(owner, name, _timed(stage, getattr(owner, name))))
+            stack.callback(self._teardown_db, self._setup_db(stack))
+            results = self._run(options)
+
+        results["upstream_requests"] = fake.requests
+        report = {
+            "meta": {
+                "created_at": datetime.now(dt_timezone.utc).isoformat(timespec="seconds"),
+                "git_revision": _git_revision(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+            },
+            "config": {key: options[key] for key in (
+                "sessions", "turns", "concurrency", "ttft", "tokens_per_second", "completion_tokens",
+            )},
+            "results": results,
+        }
+
+        output = Path(options["output"] or f"bench_chat-{datetime.now():%Y%m%dT%H%M%S}.json")
+        output.write_text(json.dumps(report, indent=2) + "\n")
+        self._print_summary(report, baseline)
+        self.stdout.write(f"\nReport written to {output}")
+
+    # -- Database ---------------------------------------------------------------
+
+    def _setup_db(self, stack):
+        """A throwaway test database, so the benchmark never touches real data.
+        SQLite gets a file rather than the usual in-memory database: concurrent
+        requests write from several threads."""
+        setup_test_environment()
+        if connection.vendor == "sqlite":
+            tmp = stack.enter_context(tempfile.TemporaryDirectory())
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = str(Path(tmp) / "bench.sqlite3")
+        return setup_databases(verbosity=0, interactive=False)
+
+    def _teardown_db(self, old_config):
+        teardown_databases(old_config, verbosity=0)
+
+    # -- Load -------------------------------------------------------------------
+
+    def _run(self, options):
+        sessions = [Session.objects.create() for _ in range(options["sessions"])]
+        samples, errors = [], []
+        lock = threading.Lock()
+
+        def run_session(index, session):
+            client = APIClient()
+            url = f"/api/sessions/{session.pk}/messages/"
+            try:
+                for turn in range(options["turns"]):
+                    content = (
+                        _FIRST_TURN.format(session=index) if turn == 0
+                        else f"{_FOLLOW_UPS[(turn - 1) % len(_FOLLOW_UPS)]} (turn {turn})"
+                    )
+                    sample = self._send(client, url, content)
+                    sample["turn"] = turn
+                    with lock:
+                        (samples if sample["status"] == 201 else errors).append(sample)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            for future in [pool.submit(run_session, i, s) for i, s in enumerate(sessions)]:
+                future.result()
+        duration = time.perf_counter() - started
+
+        by_turn = {}
+        for sample in samples:
+            by_turn.setdefault(sample["turn"], []).append(sample["latency_ms"])
+        tokens = Session.objects.filter(pk__in=[s.pk for s in sessions]).aggregate(
+            prompt=Sum("prompt_tokens"), cached=Sum("cached_prompt_tokens")
+        )
+        return {
+            "requests": len(samples) + len(errors),
+            "errors": len(errors),
+            "error_statuses": sorted({sample["status"] for sample in errors}),
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(len(samples) / duration, 2),
+            "latency_ms": _percentiles([s["latency_ms"] for s in samples]),
+            "latency_p50_ms_by_turn": [
+                round(statistics.median(by_turn[turn]), 2) for turn in sorted(by_turn)
+            ],
+            # Share of gpt-4o input tokens served from the provider's prompt cache
+            "prompt_cached_ratio": round((tokens["cached"] or 0) / tokens["prompt"], 3) if tokens["prompt"] else 0,
+            "queries_per_request": {
+                "mean": round(statistics.fmean([s["queries"] for s in samples]), 2) if samples else 0,
+                "max": max((s["queries"] for s in samples), default=0),
+            },
+            "cpu_ms_per_request": {
+                stage: round(statistics.fmean([s["cpu_ms"].get(stage, 0.0) for s in samples]), 3) if samples else 0
+                for stage in ["total", *_STAGES]
+            },
+            # Wall time per stage, as the app reports it in Server-Timing
+            "stage_ms_per_request": {
+                stage: round(statistics.fmean([s["stage_ms"].get(stage, 0.0) for s in samples]), 2)
+                for stage in dict.fromkeys(name for s in samples for name in s["stage_ms"])
+            },
+        }
+
+    def _send(self, client, url, content):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        _local.stages = {}
+        cpu_started, started = time.thread_time(), time.perf_counter()
+        with connection.execute_wrapper(count):
+            response = client.post(url, {"content": content}, format="json")
+        latency = time.perf_counter() - started
+        cpu = {"total": time.thread_time() - cpu_started, **_local.stages}
+        _local.stages = None
+
+        return {
+            "status": response.status_code,
+            "latency_ms": latency * 1000,
+            "queries": queries,
+            "cpu_ms": {stage: seconds * 1000 for stage, seconds in cpu.items()},
+            "stage_ms": _server_timing(response.get("Server-Timing", "")),
+        }
+
+    # -- Output -----------------------------------------------------------------
+
+    def _print_summary(self, report, baseline):
+        rows = [
+            ("latency p50 ms", ("latency_ms", "p50")),
+            ("latency p95 ms", ("latency_ms", "p95")),
+            ("latency p99 ms", ("latency_ms", "p99")),
+            ("throughput rps", ("throughput_rps",)),
+            ("prompt cached ratio", ("prompt_cached_ratio",)),
+            ("queries / request", ("queries_per_request", "mean")),
+            *((f"cpu {stage} ms", ("cpu_ms_per_request", stage)) for stage in ["total", *_STAGES]),
+            *((f"wall {stage} ms", ("stage_ms_per_request", stage))
+              for stage in report["results"]["stage_ms_per_request"]),
+        ]
+
+        def lookup(results, path):
+            for key in path:
+                results = (results or {}).get(key)
+            return results
+
+        results = report["results"]
+        self.stdout.write(
+            f"{results['requests']} requests, {results['errors']} errors in {results['duration_s']}s "
+            f"(upstream: {results['upstream_requests']})\n"
+        )
+        header = f"{'metric':<20} {'current':>10}"
+        if baseline:
+            header += f" {'baseline':>10} {'change':>8}"
+        self.stdout.write(header)
+        self.stdout.write("-" * len(header))
+        for label, path in rows:
+            current = lookup(results, path)
+            line = f"{label:<20} {current:>10.2f}"
+            if baseline:
+                before = lookup(baseline.get("results"), path)
+                if before:
+                    line += f" {before:>10.2f} {(current - before) / before:>+8.1%}"
+                else:
+                    line += f" {'-':>10} {'-':>8}"
+            self.stdout.write(line)
@@ -0,0 +1,128 @@
+import io
+import statistics
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from apps.chat.models import Session, Message
+from apps.chat.parsers import ORJSONParser
+from apps.chat.renderers import ORJSONRenderer, orjson
+from apps.chat.serializers import SessionSerializer, MessageSerializer
+from apps.chat.storage import render_code_block
+
+_COMPONENT_LINES = [
+    'import React, {{ useState }} from "react";',
+    "",
+    "interface {name}Props {{",
+    '  variant?: "primary" | "secondary";',
+    "  onSubmit: (value: string) => void;",
+    "}}",
+    "",
+    "export default function {name}({{ variant = \"primary\", onSubmit }}: {name}Props) {{",
+    '  const [value, setValue] = useState("");',
+    "  return (",
+    '    <form className="flex flex-col gap-4 p-6 rounded-xl border bg-card" onSubmit={{(e) => {{ e.preventDefault(); onSubmit(value); }}}}>',
+    '      <label htmlFor="field-{i}" className="text-sm font-medium text-muted-foreground">Field {i} — “label”</label>',
+    '      <input id="field-{i}" value={{value}} onChange={{(e) => setValue(e.target.value)}} className="h-10 px-3 rounded-md border" />',
+    "    </form>",
+    "  );",
+    "}}",
+]
+
+
+def _component(name: str, lines: int) -> str:
+    out = []
+    while len(out) < lines:
+        out.extend(line.format(name=name, i=len(out)) for line in _COMPONENT_LINES)
+    return "\n".join(out[:lines])
+
+
+def build_payloads(messages: int, lines: int):
+    """Serializer output for a session and one full page of its messages,
+    built from unsaved model instances so no database is needed."""
+    now = timezone.now()
+    session = Session(
+        id=uuid.uuid4(), title="Login form", created_at=now, updated_at=now,
+        message_count=messages, last_message_at=now,
+    )
+
+    instances = []
+    for i in range(messages):
+        created_at = now - timedelta(seconds=messages - i)
+        if i % 2 == 0:
+            instances.append(Message(
+                id=uuid.uuid4(), session=session, role=Message.Role.USER,
+                content=f"Make the submit button wider and add a loading state (turn {i})",
+                created_at=created_at,
+            ))
+            continue
+        block = {"language": "tsx", "filename": "LoginForm.tsx", "code": _component("LoginForm", lines)}
+        instances.append(Message(
+            id=uuid.uuid4(), session=session, role=Message.Role.ASSISTANT,
+            content=f"Here is the updated form.\n\n{render_code_block(block)}\n\n"
+                    "The button now spans the card and shows a spinner while submitting.",
+            code_blocks=[block], created_at=created_at,
+        ))
+
+    page = {
+        "next": "http://testserver/api/sessions/x/messages/?cursor=cD0yMDI2",
+        "previous": None,
+        "results": MessageSerializer(reversed(instances), many=True).data,
+    }
+    return {"session detail": SessionSerializer(session).data, "message page": page}
+
+
+def _median_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = "Compare the stock DRF JSON renderer/parser with the orjson-backed ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=200, help="Messages per page (default: 200, the max page size)")
+        parser.add_argument("--lines", type=int, default=150, help="Lines per generated component (default: 150)")
+        parser.add_argument("--repeat", type=int, default=50, help="Timed runs per measurement (default: 50)")
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            self.stdout.write(self.style.WARNING(
+                "orjson is not installed; the ORJSON classes fall back to stdlib json."
+            ))
+
+        repeat = options["repeat"]
+        stock_renderer, fast_renderer = JSONRenderer(), ORJSONRenderer()
+        stock_parser, fast_parser = JSONParser(), ORJSONParser()
+
+        header = f"{'payload':<15} {'size':>10} {'op':<7} {'stdlib ms':>10} {'orjson ms':>10} {'speedup':>8}"
+        self.stdout.write(header)
+        self.stdout.write("-" * len(header))
+
+        for name, data in build_payloads(options["messages"], options["lines"]).items():
+            body = stock_renderer.render(data)
+            if fast_parser.parse(io.BytesIO(fast_renderer.render(data))) != stock_parser.parse(io.BytesIO(body)):
+                raise CommandError(f"{name}: the two renderers produced different documents")
+
+            rows = [
+                ("render",
+                 _median_ms(lambda: stock_renderer.render(data), repeat),
+                 _median_ms(lambda: fast_renderer.render(data), repeat)),
+                ("parse",
+                 _median_ms(lambda: stock_parser.parse(io.BytesIO(body)), repeat),
+                 _median_ms(lambda: fast_parser.parse(io.BytesIO(body)), repeat)),
+            ]
+            for op, stock_ms, fast_ms in rows:
+                speedup = stock_ms / fast_ms if fast_ms else float("inf")
+                self.stdout.write(
+                    f"{name:<15} {len(body) / 1024:>8.1f}KB {op:<7} {stock_ms:>10.3f} {fast_ms:>10.3f} {speedup:>7.1f}x"
+                )
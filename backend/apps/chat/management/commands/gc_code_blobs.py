@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from apps.chat.blobs import delete_unreferenced_blobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete CodeBlob rows no message references any more, e.g. after sessions "
+        "were deleted. Blobs are shared across sessions, so deleting a message never "
+        "removes them itself."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age", type=int, default=3600,
+            help="Only delete blobs at least this many seconds old (default: 3600)",
+        )
+
+    def handle(self, *args, **options):
+        if options["min_age"] < 0:
+            raise CommandError("--min-age must not be negative")
+        deleted, freed = delete_unreferenced_blobs(
+            timezone.now() - timedelta(seconds=options["min_age"])
+        )
+        self.stdout.write(f"Deleted {deleted} unreferenced code blobs ({freed} bytes of code).")
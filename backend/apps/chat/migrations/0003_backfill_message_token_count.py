@@ -0,0 +1,38 @@
+from django.db import migrations
+
+BATCH_SIZE = 500
+
+
+def backfill_token_counts(apps, schema_editor):
+    """Count tokens once for rows saved before every message stored its count
+    (user messages and clarifying questions were left at 0)."""
+    Message = apps.get_model("chat", "Message")
+
+    pending = Message.objects.filter(token_count=0).exclude(content="")
+    if not pending.exists():
+        return   # a fresh database: nothing to count, no tokenizer to load
+
+    # The tokenizer as of this migration, not whatever app code does later
+    import tiktoken
+
+    encoder = tiktoken.encoding_for_model("gpt-4o")
+    batch = []
+    for message in pending.only("id", "content").iterator(chunk_size=BATCH_SIZE):
+        message.token_count = len(encoder.encode(message.content))
+        batch.append(message)
+        if len(batch) >= BATCH_SIZE:
+            Message.objects.bulk_update(batch, ["token_count"])
+            batch = []
+    if batch:
+        Message.objects.bulk_update(batch, ["token_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_action_message_questions'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_token_counts, migrations.RunPython.noop),
+    ]
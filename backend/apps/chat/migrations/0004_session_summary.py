@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_backfill_message_token_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='summarized_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='summary_token_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
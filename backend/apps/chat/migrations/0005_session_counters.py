@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:13
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Q, Sum
+
+
+def backfill_session_counters(apps, schema_editor):
+    """Aggregate once per session; prompt tokens were never recorded, so they start at 0."""
+    Session = apps.get_model("chat", "Session")
+
+    sessions = Session.objects.annotate(
+        n_messages=Count("messages"),
+        n_asks=Count("messages", filter=Q(messages__role="assistant", messages__action="ask")),
+        n_completion=Sum("messages__token_count", filter=Q(messages__role="assistant")),
+        last_at=Max("messages__created_at"),
+    )
+    for session in sessions.iterator(chunk_size=500):
+        Session.objects.filter(pk=session.pk).update(
+            message_count=session.n_messages,
+            ask_rounds=session.n_asks,
+            completion_tokens=session.n_completion or 0,
+            last_message_at=session.last_at,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_session_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='ask_rounds',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='completion_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='message_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='session',
+            name='prompt_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_session_counters, migrations.RunPython.noop),
+    ]
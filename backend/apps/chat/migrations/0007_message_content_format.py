@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_session_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='content_format',
+            field=models.CharField(choices=[('markdown', 'Markdown'), ('compact', 'Compact')], default='markdown', max_length=10),
+        ),
+    ]
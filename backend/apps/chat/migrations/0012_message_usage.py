@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='usage',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
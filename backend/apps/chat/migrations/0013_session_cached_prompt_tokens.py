@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0012_message_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='cached_prompt_tokens',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -1,16 +1,36 @@
 import uuid
+import zlib
 from django.db import models
 
+from .storage import expand_content
+
 
 class Session(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255, blank=True, default="New Chat")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Running summary of the turns folded out of the working window (apps/chat/ai/compaction.py)
+    summary = models.TextField(blank=True, default="")
+    summary_token_count = models.IntegerField(default=0)
+    summarized_until = models.DateTimeField(null=True, blank=True)
+    # Counters maintained alongside every message insert (apps/chat/services.py),
+    # so neither the send path nor the session list aggregates over messages
+    message_count = models.IntegerField(default=0)
+    ask_rounds = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    # Of prompt_tokens, those the provider served from its prompt cache
+    cached_prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
     # Future: user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.CASCADE)
 
     class Meta:
         ordering = ["-updated_at"]
+        indexes = [
+            # Session list: ORDER BY updated_at DESC
+            models.Index(fields=["-updated_at"], name="chat_session_updated_idx"),
+        ]
 
     def __str__(self):
         return f"Session {self.id} — {self.title}"
@@ -25,6 +45,17 @@ class Message(models.Model):
         ASK = "ask", "Ask"
         GENERATE = "generate", "Generate"
 
+    class ContentFormat(models.TextChoices):
+        # Full markdown, code blocks included
+        MARKDOWN = "markdown", "Markdown"
+        # Prose with <!-- block:N --> placeholders standing in for code_blocks[N]
+        COMPACT = "compact", "Compact"
+
+    class Status(models.TextChoices):
+        COMPLETE = "complete", "Complete"
+        # Generation stopped when the client disconnected; content is what had streamed
+        CANCELLED = "cancelled", "Cancelled"
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name="messages")
     role = models.CharField(max_length=10, choices=Role.choices)
@@ -33,10 +64,125 @@ class Message(models.Model):
     action = models.CharField(max_length=10, choices=Action.choices, default=Action.GENERATE)
     questions = models.JSONField(default=list, blank=True)
     token_count = models.IntegerField(default=0)
+    content_format = models.CharField(
+        max_length=10, choices=ContentFormat.choices, default=ContentFormat.MARKDOWN
+    )
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.COMPLETE)
+    # Assistant messages: ms per pipeline stage and provider-reported tokens per
+    # model, {"ms": {...}, "tokens": {model: {prompt, completion, cached}}}
+    usage = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            # History load and message listing: WHERE session_id = ? [AND created_at > ?]
+            # ORDER BY created_at
+            models.Index(fields=["session", "created_at"], name="chat_msg_session_created_idx"),
+        ]
 
     def __str__(self):
         return f"[{self.role}] {self.content[:60]}"
+
+    @property
+    def markdown(self) -> str:
+        """The full markdown content, whichever format it is stored in."""
+        if self.content_format == self.ContentFormat.COMPACT:
+            return expand_content(self.content, self.code_blocks)
+        return self.content
+
+
+class CodeBlob(models.Model):
+    """A generated file's code, stored once however many messages contain it.
+
+    Keyed by the SHA-256 of the code and zlib-compressed; messages reference it
+    from their code_blocks as {language, filename, sha256} (apps/chat/blobs.py).
+    Blobs are shared across sessions, so deleting a message leaves them in place;
+    the gc_code_blobs command deletes unreferenced ones.
+    """
+
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.IntegerField()  # uncompressed bytes
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+    @property
+    def code(self) -> str:
+        return zlib.decompress(self.data).decode()
+
+
+class GenerationJob(models.Model):
+    """An assistant reply generated in the background (apps/chat/jobs.py).
+
+    Created by `POST /messages/` with `Prefer: respond-async`; clients poll
+    `GET /api/jobs/:id/` until it has succeeded or failed.
+    """
+
+    class Status(models.TextChoices):
+        QUEUED = "queued", "Queued"
+        RUNNING = "running", "Running"
+        SUCCEEDED = "succeeded", "Succeeded"
+        FAILED = "failed", "Failed"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name="jobs")
+    user_message = models.OneToOneField(Message, on_delete=models.CASCADE, related_name="+")
+    assistant_message = models.OneToOneField(
+        Message, null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.QUEUED)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            # Resuming queued jobs after a restart
+            models.Index(fields=["status", "created_at"], name="chat_job_status_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} — {self.status}"
+
+
+class IdempotencyKey(models.Model):
+    """The outcome of a `POST /messages/` sent with an `Idempotency-Key` header
+    (apps/chat/idempotency.py).
+
+    Created before any work is done, so concurrent duplicates find it and wait;
+    the reply (or background job) is attached once the first request completes.
+    A request that fails deletes its row, leaving the key free to retry.
+    """
+
+    session = models.ForeignKey(Session, on_delete=models.CASCADE, related_name="+")
+    key = models.CharField(max_length=255)
+    # SHA-256 of the request body: a key reused for a different message is rejected
+    request_hash = models.CharField(max_length=64)
+    assistant_message = models.ForeignKey(
+        Message, null=True, blank=True, on_delete=models.CASCADE, related_name="+"
+    )
+    job = models.ForeignKey(
+        GenerationJob, null=True, blank=True, on_delete=models.CASCADE, related_name="+"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["session", "key"], name="chat_idem_session_key_uniq"),
+        ]
+        indexes = [
+            # Purging expired keys
+            models.Index(fields=["created_at"], name="chat_idem_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.key} — {'done' if self.completed else 'in progress'}"
+
+    @property
+    def completed(self) -> bool:
+        return self.assistant_message_id is not None or self.job_id is not None
@@ -0,0 +1,27 @@
+from rest_framework.pagination import CursorPagination
+
+
+class SessionCursorPagination(CursorPagination):
+    """Keyset pages of the session list, most recently active first.
+
+    Served by chat_session_updated_idx; the cursor encodes the last seen
+    `updated_at`, so page N costs the same as page 1.
+    """
+
+    ordering = "-updated_at"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class MessageCursorPagination(CursorPagination):
+    """Keyset pages of a session's messages, newest first.
+
+    The first page is the tail of the conversation; `next` walks back into
+    older history. Served by chat_msg_session_created_idx.
+    """
+
+    ordering = "-created_at"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
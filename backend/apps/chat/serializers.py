@@ -1,29 +1,82 @@
 from rest_framework import serializers
-from .models import Session, Message
+from .models import Session, Message, GenerationJob
+from .storage import split_code_blocks
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    """Pass `context={"content_format": "compact"}` to send assistant content as
+    prose with block placeholders, each block going over the wire once (in
+    code_blocks). The default "markdown" sends the full content as before."""
+
     class Meta:
         model = Message
-        fields = ["id", "role", "content", "code_blocks", "action", "questions", "created_at"]
-        read_only_fields = ["id", "role", "code_blocks", "action", "questions", "created_at"]
+        fields = [
+            "id", "role", "content", "content_format", "code_blocks", "action", "questions",
+            "status", "created_at",
+        ]
+        read_only_fields = [
+            "id", "role", "content_format", "code_blocks", "action", "questions",
+            "status", "created_at",
+        ]
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        wanted = self.context.get("content_format", Message.ContentFormat.MARKDOWN)
+        if wanted == instance.content_format:
+            return data
+
+        if wanted == Message.ContentFormat.MARKDOWN:
+            data["content"] = instance.markdown
+        elif instance.code_blocks:
+            data["content"], _ = split_code_blocks(instance.content)
+        else:
+            # Nothing to factor out (user messages, clarifying questions)
+            return data
+        data["content_format"] = wanted
+        return data
 
-class SessionSerializer(serializers.ModelSerializer):
-    messages = MessageSerializer(many=True, read_only=True)
 
+# Maintained by apps/chat/services.py on every message insert
+SESSION_COUNTER_FIELDS = [
+    "message_count",
+    "ask_rounds",
+    "prompt_tokens",
+    "cached_prompt_tokens",
+    "completion_tokens",
+    "last_message_at",
+]
+
+
+class SessionSerializer(serializers.ModelSerializer):
+    # Messages are not inlined; page through them via GET /sessions/:id/messages/
     class Meta:
         model = Session
-        fields = ["id", "title", "created_at", "updated_at", "messages"]
-        read_only_fields = ["id", "created_at", "updated_at"]
+        fields = ["id", "title", "created_at", "updated_at", *SESSION_COUNTER_FIELDS]
+        read_only_fields = ["id", "created_at", "updated_at", *SESSION_COUNTER_FIELDS]
 
 
-class SessionListSerializer(serializers.ModelSerializer):
+class GenerationJobSerializer(serializers.ModelSerializer):
+    assistant_message = MessageSerializer(read_only=True)
+
     class Meta:
-        model = Session
-        fields = ["id", "title", "created_at", "updated_at"]
-        read_only_fields = ["id", "created_at", "updated_at"]
+        model = GenerationJob
+        fields = [
+            "id", "session", "user_message", "status", "assistant_message", "error",
+            "created_at", "started_at", "finished_at",
+        ]
+        read_only_fields = fields
 
 
 class SendMessageSerializer(serializers.Serializer):
     content = serializers.CharField(max_length=10000)
+
+
+class ContentFormatQuerySerializer(serializers.Serializer):
+    content_format = serializers.ChoiceField(
+        choices=Message.ContentFormat.choices, default=Message.ContentFormat.MARKDOWN
+    )
+
+
+class MessageListQuerySerializer(ContentFormatQuerySerializer):
+    # Only return messages created after this one (e.g. the last one the client has)
+    since = serializers.UUIDField(required=False)
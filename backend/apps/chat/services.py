@@ -0,0 +1,311 @@
+import logging
+from typing import List, Dict, Any
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, JSONField, Value, When
+
+from .models import Session, Message
+from .storage import split_code_blocks, expand_content
+from .blobs import store_code_blocks, resolve_code_blocks, aresolve_code_blocks
+from .ai.compaction import plan_compaction, summarize, asummarize, with_summary
+from .ai.retrieval import get_session_index, recalled_entry
+from .ai.timing import current_trace, emit, stage
+from .ai.token_manager import HistoryEntry, count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def record_user_message(session: Session, content: str) -> Message:
+    """Persist a user message and auto-title the session from the first one."""
+    with transaction.atomic():
+        user_msg = Message.objects.create(
+            session=session,
+            role=Message.Role.USER,
+            content=content,
+            token_count=count_tokens(content),
+        )
+        _bump_counters(session, user_msg)
+
+        if session.title == "New Chat":
+            session.title = content[:60]
+            session.save(update_fields=["title", "updated_at"])
+
+    return user_msg
+
+
+async def arecord_user_message(session: Session, content: str) -> Message:
+    """Async variant of `record_user_message`; the transaction runs in one thread hop."""
+    return await sync_to_async(record_user_message)(session, content)
+
+
+def _history_rows(session: Session, exclude: Message):
+    """Messages not yet folded into the session summary, oldest first.
+    Cancelled replies are left out: the model never finished them."""
+    rows = (
+        session.messages.exclude(pk=exclude.pk)
+        .exclude(status=Message.Status.CANCELLED)
+        .order_by("created_at")
+    )
+    if session.summarized_until is not None:
+        rows = rows.filter(created_at__gt=session.summarized_until)
+    return _with_blocks(rows).values_list("role", "content", "token_count", "created_at", "blocks")
+
+
+def _folded_rows(session: Session, after):
+    """Messages folded into the summary since `after` (all if None), oldest first,
+    with their pks: what the recall index hasn't seen yet."""
+    rows = (
+        session.messages.filter(created_at__lte=session.summarized_until)
+        .exclude(status=Message.Status.CANCELLED)
+        .order_by("created_at")
+    )
+    if after is not None:
+        rows = rows.filter(created_at__gt=after)
+    return _with_blocks(rows).values_list("pk", "role", "content", "token_count", "created_at", "blocks")
+
+
+def _recalled_rows(session: Session, pks):
+    return _with_blocks(session.messages.filter(pk__in=pks).order_by("created_at")).values_list(
+        "role", "content", "token_count", "created_at", "blocks"
+    )
+
+
+def _with_blocks(rows):
+    # code_blocks are only needed to expand compact rows; don't load them twice otherwise
+    blocks = Case(
+        When(content_format=Message.ContentFormat.COMPACT, then=F("code_blocks")),
+        default=Value(None),
+        output_field=JSONField(),
+    )
+    return rows.annotate(blocks=blocks)
+
+
+def _history_entries(rows) -> List[HistoryEntry]:
+    return [
+        (role, content if blocks is None else expand_content(content, blocks), token_count)
+        for role, content, token_count, _, blocks in rows
+    ]
+
+
+def _index_rows(rows):
+    return [
+        (pk, role, content if blocks is None else expand_content(content, blocks), token_count, created_at)
+        for pk, role, content, token_count, created_at, blocks in rows
+    ]
+
+
+def _recall_params() -> Dict[str, Any]:
+    return {
+        "top_k": settings.AI_RECALL_TOP_K,
+        "max_tokens": settings.AI_RECALL_TOKENS,
+        "min_score": settings.AI_RECALL_MIN_SCORE,
+    }
+
+
+def recall_turns(session: Session, query: str) -> List[HistoryEntry]:
+    """The exchanges folded into the summary that best match `query`, as at most
+    one RECALL_ROLE entry (apps/chat/ai/retrieval.py)."""
+    if not settings.AI_RECALL_ENABLED or session.summarized_until is None:
+        return []
+    with stage("recall"):
+        index = get_session_index(session.pk)
+        rows = list(_folded_rows(session, index.indexed_until))
+        resolve_code_blocks(row[5] for row in rows if row[5])
+        index.extend(_index_rows(rows))
+
+        pks = index.recall(query, **_recall_params())
+        if not pks:
+            return []
+        rows = list(_recalled_rows(session, pks))
+        resolve_code_blocks(row[4] for row in rows if row[4])
+        return [recalled_entry(_history_entries(rows))]
+
+
+async def arecall_turns(session: Session, query: str) -> List[HistoryEntry]:
+    """Async variant of `recall_turns`."""
+    if not settings.AI_RECALL_ENABLED or session.summarized_until is None:
+        return []
+    with stage("recall"):
+        index = get_session_index(session.pk)
+        rows = [row async for row in _folded_rows(session, index.indexed_until)]
+        await aresolve_code_blocks(row[5] for row in rows if row[5])
+        index.extend(_index_rows(rows))
+
+        pks = index.recall(query, **_recall_params())
+        if not pks:
+            return []
+        rows = [row async for row in _recalled_rows(session, pks)]
+        await aresolve_code_blocks(row[4] for row in rows if row[4])
+        return [recalled_entry(_history_entries(rows))]
+
+
+def load_context(session: Session, exclude: Message) -> List[HistoryEntry]:
+    """Return the history to send with the next turn: the session's running summary
+    followed by the working window of (role, content, token_count) entries, minus
+    `exclude`. Stored counts spare trim_history from re-encoding.
+
+    When the window outgrows AI_HISTORY_WINDOW_TOKENS, its oldest turns are first
+    folded into the summary, which is persisted so they are never loaded again.
+    Folded exchanges relevant to `exclude` (the new request) are recalled in
+    full after the window, where they leave the cached prompt prefix alone.
+    """
+    rows = list(_history_rows(session, exclude))
+    resolve_code_blocks(row[4] for row in rows if row[4])
+    history = _history_entries(rows)
+
+    folded = plan_compaction(history, settings.AI_HISTORY_WINDOW_TOKENS)
+    if folded:
+        try:
+            with stage("summarize"):
+                summary = summarize(session.summary, history[:folded])
+        except Exception:
+            # Keep the unfolded history; trim_history still bounds the prompt
+            logger.warning("History compaction failed for session %s", session.pk, exc_info=True)
+        else:
+            if _save_summary(session, summary, rows[folded - 1][3]):
+                history = history[folded:]
+
+    history = with_summary(session.summary, session.summary_token_count, history)
+    return [*history, *recall_turns(session, exclude.content)]
+
+
+async def aload_context(session: Session, exclude: Message) -> List[HistoryEntry]:
+    """Async variant of `load_context`."""
+    rows = [row async for row in _history_rows(session, exclude)]
+    await aresolve_code_blocks(row[4] for row in rows if row[4])
+    history = _history_entries(rows)
+
+    folded = plan_compaction(history, settings.AI_HISTORY_WINDOW_TOKENS)
+    if folded:
+        try:
+            with stage("summarize"):
+                summary = await asummarize(session.summary, history[:folded])
+        except Exception:
+            logger.warning("History compaction failed for session %s", session.pk, exc_info=True)
+        else:
+            if await sync_to_async(_save_summary)(session, summary, rows[folded - 1][3]):
+                history = history[folded:]
+
+    history = with_summary(session.summary, session.summary_token_count, history)
+    return [*history, *await arecall_turns(session, exclude.content)]
+
+
+def _save_summary(session: Session, summary: str, summarized_until) -> bool:
+    """Persist a summary folding the turns up to `summarized_until`, unless a
+    concurrent send already moved the session's summary on from the value the
+    history was read with. Returns whether the summary was saved; if not, the
+    caller keeps its unfolded history (still bounded by trim_history).
+
+    Deliberately leaves "updated_at" alone: compaction is not user activity.
+    """
+    summary_token_count = count_tokens(summary)
+    saved = Session.objects.filter(
+        pk=session.pk, summarized_until=session.summarized_until,
+    ).update(
+        summary=summary,
+        summary_token_count=summary_token_count,
+        summarized_until=summarized_until,
+    )
+    if not saved:
+        logger.info("Dropped a stale summary for session %s", session.pk)
+        return False
+    session.summary = summary
+    session.summary_token_count = summary_token_count
+    session.summarized_until = summarized_until
+    return True
+
+
+def _assistant_fields(result: Dict[str, Any], status: str) -> Dict[str, Any]:
+    fields = {
+        "role": Message.Role.ASSISTANT,
+        "status": status,
+        "content": result["content"],
+        "code_blocks": result["code_blocks"],
+        "action": result["action"],
+        "questions": result["questions"],
+        "token_count": result["token_count"],
+    }
+    if settings.CHAT_COMPACT_STORAGE and result["code_blocks"]:
+        fields["content"], fields["code_blocks"] = split_code_blocks(result["content"])
+        fields["content_format"] = Message.ContentFormat.COMPACT
+    return fields
+
+
+def record_assistant_message(
+    session: Session,
+    result: Dict[str, Any],
+    status: str = Message.Status.COMPLETE,
+) -> Message:
+    """Persist the result of `UIGeneratorChain.classify_and_invoke` as an assistant message.
+
+    A generation cut short by a client disconnect is recorded with
+    status=CANCELLED and whatever content it had produced. The current trace's
+    timings and token usage are stored with it and passed to AI_TRACE_SINK.
+    """
+    fields = _assistant_fields(result, status)
+    trace = current_trace()
+    if trace is not None:
+        fields["usage"] = trace.record()
+    code_blocks = fields["code_blocks"]
+    with transaction.atomic():
+        if settings.CHAT_CODE_BLOB_STORAGE and code_blocks:
+            fields["code_blocks"] = store_code_blocks(code_blocks)
+        assistant_msg = Message.objects.create(session=session, **fields)
+        _bump_counters(
+            session,
+            assistant_msg,
+            prompt_tokens=result.get("prompt_tokens", 0),
+            cached_prompt_tokens=result.get("cached_prompt_tokens", 0),
+        )
+    # Hand callers the resolved blocks, not the stored blob references
+    assistant_msg.code_blocks = code_blocks
+    if trace is not None:
+        emit({"session": str(session.pk), "message": str(assistant_msg.pk), **fields["usage"]})
+    return assistant_msg
+
+
+async def arecord_assistant_message(
+    session: Session,
+    result: Dict[str, Any],
+    status: str = Message.Status.COMPLETE,
+) -> Message:
+    """Async variant of `record_assistant_message`."""
+    return await sync_to_async(record_assistant_message)(session, result, status)
+
+
+def _bump_counters(
+    session: Session,
+    message: Message,
+    prompt_tokens: int = 0,
+    cached_prompt_tokens: int = 0,
+) -> None:
+    """Fold one new message into the session's counters, in the caller's transaction.
+
+    F() expressions keep concurrent inserts from losing updates; the in-memory
+    instance is advanced too so callers can keep using it. `.update()` skips
+    auto_now, so "updated_at" is set here to keep the session list ordered by
+    activity.
+    """
+    is_assistant = message.role == Message.Role.ASSISTANT
+    asks = int(is_assistant and message.action == Message.Action.ASK)
+    completion_tokens = message.token_count if is_assistant else 0
+
+    Session.objects.filter(pk=session.pk).update(
+        message_count=F("message_count") + 1,
+        ask_rounds=F("ask_rounds") + asks,
+        prompt_tokens=F("prompt_tokens") + prompt_tokens,
+        cached_prompt_tokens=F("cached_prompt_tokens") + cached_prompt_tokens,
+        completion_tokens=F("completion_tokens") + completion_tokens,
+        last_message_at=message.created_at,
+        updated_at=message.created_at,
+    )
+
+    session.message_count += 1
+    session.ask_rounds += asks
+    session.prompt_tokens += prompt_tokens
+    session.cached_prompt_tokens += cached_prompt_tokens
+    session.completion_tokens += completion_tokens
+    session.last_message_at = message.created_at
+    session.updated_at = message.created_at
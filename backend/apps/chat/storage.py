@@ -0,0 +1,44 @@
+import re
+from typing import Any, Dict, List, Tuple
+
+from .ai.output_parser import replace_code_blocks
+
+# Stands in for code_blocks[N] in compact content
+BLOCK_PLACEHOLDER = "<!-- block:{} -->"
+_PLACEHOLDER_RE = re.compile(r"<!-- block:(\d+) -->")
+
+
+def split_code_blocks(content: str) -> Tuple[str, List[Dict[str, str]]]:
+    """Split markdown into prose with block placeholders and the blocks themselves.
+
+    Placeholder N refers to blocks[N], in the same order `parse_code_blocks`
+    returns them, so the blocks can double as the message's `code_blocks`.
+    """
+    blocks: List[Dict[str, str]] = []
+
+    def _placeholder(block: Dict[str, str]) -> str:
+        blocks.append(block)
+        return BLOCK_PLACEHOLDER.format(len(blocks) - 1)
+
+    return replace_code_blocks(content, _placeholder), blocks
+
+
+def render_code_block(block: Dict[str, str]) -> str:
+    """A code block as the fenced markdown the generator emits."""
+    return f"```{block['language']}\n// filename: {block['filename']}\n{block['code']}\n```"
+
+
+def expand_content(content: str, code_blocks: List[Dict[str, Any]]) -> str:
+    """Rebuild the full markdown of compact content.
+
+    Blocks come back in canonical fence form (language, filename comment, code),
+    which is what the system prompt asks the model to produce anyway.
+    """
+
+    def _block(match: "re.Match[str]") -> str:
+        index = int(match.group(1))
+        if index >= len(code_blocks):
+            return match.group(0)
+        return render_code_block(code_blocks[index])
+
+    return _PLACEHOLDER_RE.sub(_block, content)
@@ -1,3 +1,1159 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.testing import ApplicationCommunicator
+
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connection
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from openai import RateLimitError
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .idempotency import claim_idempotency_key, complete_idempotency_key
+from .models import Session, Message, CodeBlob, GenerationJob, IdempotencyKey
+from .parsers import ORJSONParser
+from .renderers import ORJSONRenderer
+from .serializers import MessageSerializer
+from . import jobs
+from .blobs import delete_unreferenced_blobs, resolve_code_blocks, store_code_blocks
+from .services import _history_rows, load_context, record_assistant_message
+from .ai import classifier
+from .ai.cache import (
+    LeaderCancelled,
+    InflightGenerations,
+    get_cached_response,
+    response_cache_key,
+    store_response,
+)
+from .ai.chain import UIGeneratorChain, get_generator_chain
+from .ai.classifier import MAX_ASK_ROUNDS, prefilter_request
+from .ai.compaction import MIN_KEPT_ENTRIES, plan_compaction
+from .ai.context import collapse_superseded_files
+from .ai.clients import PooledChatModel
+from .ai.fake_llm import FakeChatCompletions
+from .ai.output_parser import CodeBlockStreamParser, parse_code_blocks
+from .ai.metrics import speculation_stats
+from .ai.limiter import ModelBusyError, ModelLimiter, set_session_key
+from .ai.retrieval import RECALL_ROLE
+from .ai.semantic_cache import HashedNgramEmbedder, SemanticCache, specifics
+from .ai.timing import current_trace, emit, end_trace, stage, start_trace
+from .ai.token_manager import MAX_CONTEXT_TOKENS, TRIM_CHUNK_TOKENS, trim_history
+
+
+def _fake_count_tokens(text):
+    return len(text.split()) + 1
+
+
+def _generation_result(content="Here you go.\n\n```tsx\n// filename: A.tsx\nexport {};\n```"):
+    return {
+        "action": "generate",
+        "content": content,
+        "code_blocks": [{"language": "tsx", "filename": "A.tsx", "code": "export {};"}],
+        "token_count": 12,
+        "prompt_tokens": 340,
+        "questions": [],
+        "cached": False,
+    }
+
+
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+class SendMessageQueryTests(TestCase):
+    """Pins the number of queries on the hot paths, so a new per-message
+    aggregate or N+1 shows up as a failing test rather than in production."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.session = Session.objects.create(title="Existing")
+        chain = mock.Mock()
+        chain.classify_and_invoke.return_value = _generation_result()
+        patcher = mock.patch("apps.chat.views.get_generator_chain", return_value=chain)
+        self.get_chain = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _send(self, content="make it wider"):
+        return self.client.post(
+            f"/api/sessions/{self.session.pk}/messages/", {"content": content}, format="json"
+        )
+
+    def test_send_message_query_count(self):
+        for i in range(20):
+            self._send(f"turn {i}")
+
+        # session lookup, history load, and one (savepoint, insert, counter
+        # update, release) group per stored message — independent of history length
+        with self.assertNumQueries(10):
+            response = self._send()
+
+        self.assertEqual(response.status_code, 201)
+
+    def test_send_message_maintains_counters(self):
+        self._send()
+        self._send()
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.message_count, 4)
+        self.assertEqual(self.session.ask_rounds, 0)
+        self.assertEqual(self.session.prompt_tokens, 680)
+        self.assertEqual(self.session.completion_tokens, 24)
+        self.assertEqual(self.session.last_message_at, Message.objects.latest("created_at").created_at)
+
+    def test_ask_rounds_are_counted_and_passed_to_the_chain(self):
+        chain = self.get_chain()
+        chain.classify_and_invoke.return_value = {
+            **_generation_result(), "action": "ask", "content": "Which colours?",
+            "code_blocks": [], "questions": ["Which colours?"],
+        }
+        self._send("a card")
+        chain.classify_and_invoke.return_value = _generation_result()
+        self._send("blue")
+
+        self.assertEqual(chain.classify_and_invoke.call_args.args[2], 1)
+        listed = self.client.get("/api/sessions/").json()["results"][0]
+        self.assertEqual((listed["message_count"], listed["ask_rounds"]), (4, 1))
+        self.assertEqual(listed["completion_tokens"], 24)
+
+    def test_session_list_query_count(self):
+        for _ in range(5):
+            Session.objects.create()
+
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/sessions/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("message_count", response.json()["results"][0])
+
+    def test_session_list_orders_by_activity(self):
+        newer = Session.objects.create(title="Newer")
+        self._send()
+
+        listed = self.client.get("/api/sessions/").json()["results"]
+        self.assertEqual([s["id"] for s in listed], [str(self.session.pk), str(newer.pk)])
+
+    def test_message_list_pages_and_since(self):
+        for i in range(3):
+            self._send(f"turn {i}")
+        url = f"/api/sessions/{self.session.pk}/messages/"
+
+        first = self.client.get(url, {"page_size": 4}).json()
+        older = self.client.get(first["next"]).json()
+        self.assertEqual(len(first["results"]), 4)
+        self.assertEqual(len(older["results"]), 2)
+        self.assertIsNone(older["next"])
+
+        # Newest first; `since` the second-newest returns only the newest
+        newest, anchor = first["results"][:2]
+        since = self.client.get(url, {"since": anchor["id"]}).json()
+        self.assertEqual([m["id"] for m in since["results"]], [newest["id"]])
+
+        missing = self.client.get(url, {"since": "00000000-0000-0000-0000-000000000000"})
+        self.assertEqual(missing.status_code, 400)
+
+    @override_settings(CHAT_COMPACT_STORAGE=True)
+    def test_compact_storage_round_trip(self):
+        full = self._send().json()
+        stored = Message.objects.get(pk=full["id"])
+        self.assertEqual(stored.content, "Here you go.\n\n<!-- block:0 -->")
+        self.assertEqual(stored.markdown, _generation_result()["content"])
+        self.assertEqual(full["content"], _generation_result()["content"])
+
+        url = f"/api/sessions/{self.session.pk}/messages/"
+        compact = self.client.get(url, {"content_format": "compact"}).json()["results"][0]
+        self.assertEqual(compact["content"], stored.content)
+        self.assertEqual(compact["content_format"], "compact")
+
+        # History sent to the model is the full markdown
+        self._send()
+        history = self.get_chain().classify_and_invoke.call_args.args[1]
+        self.assertEqual(history[1][1], _generation_result()["content"])
+
+    @override_settings(CHAT_COMPACT_STORAGE=True, CHAT_CODE_BLOB_STORAGE=True)
+    def test_code_blob_storage_dedupes_and_resolves(self):
+        first = self._send().json()
+        self._send()
+
+        self.assertEqual(CodeBlob.objects.count(), 1)
+        stored = Message.objects.get(pk=first["id"])
+        self.assertEqual(set(stored.code_blocks[0]), {"language", "filename", "sha256"})
+        self.assertEqual(first["code_blocks"], _generation_result()["code_blocks"])
+
+        url = f"/api/sessions/{self.session.pk}/messages/"
+        listed = self.client.get(url).json()["results"]
+        self.assertEqual(listed[0]["code_blocks"], _generation_result()["code_blocks"])
+        self.assertEqual(listed[0]["content"], _generation_result()["content"])
+
+        history = self.get_chain().classify_and_invoke.call_args.args[1]
+        self.assertEqual(history[1][1], _generation_result()["content"])
+
+    def test_respond_async_enqueues_job(self):
+        url = f"/api/sessions/{self.session.pk}/messages/"
+        with mock.patch("apps.chat.jobs._submit") as submit, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                url, {"content": "make it wider"}, format="json", HTTP_PREFER="respond-async"
+            )
+
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["id"]
+        self.assertEqual(response.json()["status"], "queued")
+        self.assertTrue(response["Location"].endswith(f"/api/jobs/{job_id}/"))
+        submit.assert_called_once()
+
+        with mock.patch("apps.chat.jobs.get_generator_chain", self.get_chain):
+            jobs.run_job(job_id)
+            jobs.run_job(job_id)  # already claimed: no second reply
+
+        job = self.client.get(f"/api/jobs/{job_id}/").json()
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(job["assistant_message"]["content"], _generation_result()["content"])
+        self.assertEqual(self.session.messages.count(), 2)
+        self.assertEqual(GenerationJob.objects.get().assistant_message.role, "assistant")
+
+    def _job(self, **fields):
+        user_msg = Message.objects.create(session=self.session, role="user", content="hi", token_count=2)
+        return GenerationJob.objects.create(session=self.session, user_message=user_msg, **fields)
+
+    def test_claimed_job_always_finishes(self):
+        job = self._job()
+        with mock.patch("apps.chat.jobs.set_session_key", side_effect=RuntimeError), \
+                self.assertLogs("apps.chat.jobs", "ERROR"):
+            jobs.run_job(job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, GenerationJob.Status.FAILED)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_resume_fails_stale_running_jobs_and_requeues_queued_ones(self):
+        now = timezone.now()
+        lost = now - timedelta(seconds=settings.AI_GENERATION_MAX_SECONDS + 1)
+        stale = self._job(status="running", started_at=lost)
+        live = self._job(status="running", started_at=now)
+        queued = self._job()
+        with mock.patch("apps.chat.jobs._submit") as submit, self.assertLogs("apps.chat.jobs"):
+            jobs.resume_queued_jobs()
+
+        submit.assert_called_once_with(queued.pk)
+        statuses = dict(GenerationJob.objects.values_list("pk", "status"))
+        self.assertEqual(statuses[stale.pk], "failed")
+        self.assertEqual(statuses[live.pk], "running")
+
+
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+class AsyncSendMessageTests(TransactionTestCase):
+
+    async def test_async_view_awaits_the_chain_and_saves_the_reply(self):
+        session = await Session.objects.acreate(title="Existing")
+        chain = mock.Mock(aclassify_and_invoke=mock.AsyncMock(return_value=_generation_result()))
+        with mock.patch("apps.chat.views.get_generator_chain", return_value=chain):
+            response = await self.async_client.post(
+                f"/api/sessions/{session.pk}/messages/async/",
+                {"content": "make it wider"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["content"], _generation_result()["content"])
+        chain.aclassify_and_invoke.assert_awaited_once()
+        self.assertEqual(await session.messages.acount(), 2)
+
+        missing = await self.async_client.post(
+            "/api/sessions/00000000-0000-0000-0000-000000000000/messages/async/",
+            {"content": "hi"}, content_type="application/json",
+        )
+        self.assertEqual(missing.status_code, 404)
+
+    async def test_async_view_honours_the_sync_views_contract(self):
+        session = await Session.objects.acreate(title="Existing")
+        url = f"/api/sessions/{session.pk}/messages/async/"
+        busy = ModelBusyError("gpt-4o", "wait queue is full", 1.2)
+        chain = mock.Mock(aclassify_and_invoke=mock.AsyncMock(side_effect=[busy, _generation_result()]))
+
+        async def post(content="make it wider", **headers):
+            return await self.async_client.post(
+                url, {"content": content}, content_type="application/json", headers=headers
+            )
+
+        with mock.patch("apps.chat.views.get_generator_chain", return_value=chain):
+            throttled = await post(**{"Idempotency-Key": "key-1"})
+            first = await post(**{"Idempotency-Key": "key-1"})
+            replayed = await post(**{"Idempotency-Key": "key-1"})
+            reused = await post("something else", **{"Idempotency-Key": "key-1"})
+            with mock.patch("apps.chat.jobs._submit"):
+                accepted = await post(Prefer="respond-async")
+
+        self.assertEqual((throttled.status_code, throttled["Retry-After"]), (429, "2"))
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(replayed["Idempotent-Replayed"], "true")
+        self.assertEqual(replayed.json()["id"], first.json()["id"])
+        self.assertEqual(reused.status_code, 422)
+        self.assertEqual(chain.aclassify_and_invoke.await_count, 2)
+
+        self.assertEqual(accepted.status_code, 202)
+        self.assertEqual(accepted["Preference-Applied"], "respond-async")
+        self.assertTrue(accepted["Location"].endswith(f"/api/jobs/{accepted.json()['id']}/"))
+        self.assertEqual(accepted.json()["status"], "queued")
+
+
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.chain.count_tokens", _fake_count_tokens)
+class ClientDisconnectTests(TransactionTestCase):
+    # Committed data: the ASGI handler runs the view on a thread of its own
+
+    async def test_stream_disconnect_cancels_generation(self):
+        session = await Session.objects.acreate(title="Existing")
+        upstream_closed = asyncio.Event()
+
+        async def classify_and_astream(*args):
+            try:
+                yield {"type": "token", "text": "Here is the form.\n\n```tsx\nexport"}
+                await asyncio.Event().wait()   # the model never finishes
+            finally:
+                upstream_closed.set()
+
+        chain = mock.Mock(
+            classify_and_astream=classify_and_astream,
+            cancelled_result=UIGeneratorChain.cancelled_result,
+        )
+        body = json.dumps({"content": "make a login form"}).encode()
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "POST", "scheme": "http", "server": ("testserver", 80),
+            "path": f"/api/sessions/{session.pk}/messages/stream/", "query_string": b"",
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"accept", b"text/event-stream"),
+            ],
+        }
+        with mock.patch("apps.chat.views.get_generator_chain", return_value=chain):
+            app = ApplicationCommunicator(ASGIHandler(), scope)
+            await app.send_input({"type": "http.request", "body": body})
+            self.assertEqual((await app.receive_output(5))["status"], 200)
+            self.assertIn(b"event: token", (await app.receive_output(5))["body"])
+
+            await app.send_input({"type": "http.disconnect"})
+            await app.wait(5)
+
+        self.assertTrue(upstream_closed.is_set())
+        reply = await session.messages.filter(role="assistant").aget()
+        self.assertEqual(reply.status, Message.Status.CANCELLED)
+        self.assertEqual(reply.content, "Here is the form.\n\n```tsx\nexport")
+        self.assertEqual(reply.code_blocks, [])
+
+
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+class StreamMessageTests(TransactionTestCase):
+
+    async def test_stream_emits_tokens_blocks_then_the_saved_message(self):
+        session = await Session.objects.acreate(title="Existing")
+        result = _generation_result()
+        block = result["code_blocks"][0]
+
+        async def classify_and_astream(*args):
+            yield {"type": "token", "text": "Here you go.\n\n```tsx\n"}
+            yield {"type": "token", "text": "// filename: A.tsx\nexport {};\n```"}
+            yield {"type": "code_block", "block": block}
+            yield {"type": "done", "result": result}
+
+        chain = mock.Mock(classify_and_astream=classify_and_astream)
+        with mock.patch("apps.chat.views.get_generator_chain", return_value=chain):
+            response = await self.async_client.post(
+                f"/api/sessions/{session.pk}/messages/stream/",
+                {"content": "make a card"}, content_type="application/json",
+                headers={"Accept": "text/event-stream"},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+        events = []
+        for frame in body.strip().split("\n\n"):
+            event, data = frame.split("\n")
+            events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+
+        self.assertEqual([event for event, _ in events], ["token", "token", "code_block", "message"])
+        self.assertEqual("".join(data["text"] for event, data in events if event == "token"), result["content"])
+        self.assertEqual(events[2][1], block)
+
+        reply = await session.messages.filter(role="assistant").aget()
+        message = events[-1][1]
+        self.assertEqual(message["id"], str(reply.pk))
+        self.assertEqual(message["content"], reply.content)
+        self.assertEqual(reply.content, result["content"])
+        self.assertEqual(reply.code_blocks, [block])
+        self.assertEqual(reply.status, Message.Status.COMPLETE)
+
+
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+class IdempotencyKeyTests(TransactionTestCase):
+    # Committed data: duplicates run on threads with their own connections
+
+    def setUp(self):
+        self.session = Session.objects.create(title="Existing")
+        self.url = f"/api/sessions/{self.session.pk}/messages/"
+        self.started, self.release = threading.Event(), threading.Event()
+
+        def classify_and_invoke(*args):
+            self.started.set()
+            self.release.wait(5)
+            return _generation_result()
+
+        self.chain = mock.Mock(classify_and_invoke=mock.Mock(side_effect=classify_and_invoke))
+        patcher = mock.patch("apps.chat.views.get_generator_chain", return_value=self.chain)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, content="make it wider", key="key-1", url=None, **headers):
+        return APIClient().post(
+            url or self.url, {"content": content}, format="json", HTTP_IDEMPOTENCY_KEY=key, **headers
+        )
+
+    def test_concurrent_duplicate_waits_for_first_reply(self):
+        responses = {}
+
+        def send(name):
+            responses[name] = self.post()
+            connection.close()
+
+        first = threading.Thread(target=send, args=("first",))
+        first.start()
+        self.assertTrue(self.started.wait(5))
+        duplicate = threading.Thread(target=send, args=("duplicate",))
+        duplicate.start()
+        time.sleep(0.3)
+        self.release.set()
+        first.join()
+        duplicate.join()
+
+        self.assertEqual(self.chain.classify_and_invoke.call_count, 1)
+        self.assertEqual(responses["first"].status_code, 201)
+        self.assertEqual(responses["duplicate"].status_code, 201)
+        self.assertEqual(responses["duplicate"]["Idempotent-Replayed"], "true")
+        self.assertEqual(responses["duplicate"].json()["id"], responses["first"].json()["id"])
+        self.assertEqual(Message.objects.filter(session=self.session).count(), 2)
+
+    def test_key_reused_for_other_content_is_rejected(self):
+        self.release.set()
+        self.assertEqual(self.post().status_code, 201)
+        self.assertEqual(self.post(content="something else").status_code, 422)
+        self.assertEqual(self.post(url=self.url + "?content_format=compact").status_code, 422)
+        self.assertEqual(self.post(HTTP_PREFER="respond-async").status_code, 422)
+        self.assertEqual(self.post(key="key-2").status_code, 201)
+        self.assertEqual(self.chain.classify_and_invoke.call_count, 2)
+
+    def test_a_purged_key_is_recorded_again_when_its_request_finishes(self):
+        record, owned = claim_idempotency_key(self.session, "key-1", "make it wider")
+        self.assertTrue(owned)
+        # Still running within the longest a turn can take: not abandoned yet
+        waited_out = timezone.now() - timedelta(seconds=settings.CHAT_IDEMPOTENCY_WAIT + 1)
+        IdempotencyKey.objects.update(created_at=waited_out)
+        claim_idempotency_key(self.session, "key-2", "make it wider")
+        self.assertTrue(IdempotencyKey.objects.filter(pk=record.pk).exists())
+
+        abandoned = timezone.now() - timedelta(seconds=settings.AI_GENERATION_MAX_SECONDS + 1)
+        IdempotencyKey.objects.filter(pk=record.pk).update(created_at=abandoned)
+        claim_idempotency_key(self.session, "key-3", "make it wider")
+        self.assertFalse(IdempotencyKey.objects.filter(pk=record.pk).exists())
+
+        reply = Message.objects.create(session=self.session, role="assistant", content="Done.", token_count=2)
+        with self.assertLogs("apps.chat.idempotency", "WARNING"):
+            complete_idempotency_key(record, assistant_message=reply)
+        replayed, owned = claim_idempotency_key(self.session, "key-1", "make it wider")
+        self.assertFalse(owned)
+        self.assertEqual(replayed.assistant_message, reply)
+
+    def test_failed_request_releases_key(self):
+        self.release.set()
+        self.chain.classify_and_invoke.side_effect = ModelBusyError("gpt-4o", "wait queue is full", 1)
+        self.assertEqual(self.post().status_code, 429)
+        self.chain.classify_and_invoke.side_effect = None
+        self.chain.classify_and_invoke.return_value = _generation_result()
+        self.assertEqual(self.post().status_code, 201)
+        self.assertTrue(self.post().has_header("Idempotent-Replayed"))
+
+
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.chain.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.classifier.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.token_manager.count_tokens", _fake_count_tokens)
+class FakeModelServerTests(TestCase):
+    """The real chain, end to end, against the local fake model endpoint."""
+
+    def test_send_message_through_fake_endpoint(self):
+        session = Session.objects.create()
+        with FakeChatCompletions(ttft=0, tokens_per_second=0, completion_tokens=60) as fake, \
+                override_settings(OPENAI_BASE_URL=fake.base_url, OPENAI_API_KEY="test",
+                                  AI_FAST_CLASSIFIER_SHADOW_RATE=0), \
+                mock.patch.object(classifier, "_model", None), \
+                mock.patch("apps.chat.views.get_generator_chain", return_value=UIGeneratorChain()):
+            url = f"/api/sessions/{session.pk}/messages/"
+            response = APIClient().post(url, {"content": "a pricing card"}, format="json")
+            follow_up = APIClient().post(url, {"content": "make the buttons wider"}, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["code_blocks"][0]["filename"], "Generated.tsx")
+        self.assertEqual(fake.requests, {"classifier": 1, "generator": 2})
+
+        stages = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        for name in ["save", "history", "trim", "classify", "generate", "parse", "serialize", "total"]:
+            self.assertIn(name, stages)
+        usage = Message.objects.get(pk=response.json()["id"]).usage
+        self.assertEqual(usage["tokens"]["gpt-4o"]["completion"], 60)
+        self.assertEqual(set(usage["tokens"]), {"gpt-4o", "gpt-4o-mini"})
+        self.assertIn("generate", usage["ms"])
+
+        # The second prompt extends the first, so its prefix is served from the cache
+        self.assertEqual(follow_up.status_code, 201)
+        first = usage["tokens"]["gpt-4o"]
+        second = Message.objects.get(pk=follow_up.json()["id"]).usage["tokens"]["gpt-4o"]
+        self.assertEqual(first["cached"], 0)
+        self.assertGreater(second["cached"], first["prompt"] - 128)
+        session.refresh_from_db()
+        self.assertEqual(session.cached_prompt_tokens, second["cached"])
+
+
+@override_settings(CHAT_COMPACT_STORAGE=True, CHAT_CODE_BLOB_STORAGE=True)
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+class GcCodeBlobsTests(TestCase):
+
+    def test_deletes_only_old_unreferenced_blobs(self):
+        kept, dropped = Session.objects.create(), Session.objects.create()
+        shared = _generation_result()
+        for session, content in ((kept, shared["content"]), (dropped, shared["content"] + "\n```css\n.a {}\n```")):
+            record_assistant_message(session, {**shared, "content": content, "code_blocks": parse_code_blocks(content)})
+        self.assertEqual(CodeBlob.objects.count(), 2)
+
+        dropped.delete()
+        out = io.StringIO()
+        call_command("gc_code_blobs", min_age=60, stdout=out)
+        self.assertEqual(CodeBlob.objects.count(), 2)   # too new to collect
+
+        call_command("gc_code_blobs", min_age=0, stdout=out)
+        self.assertEqual(list(CodeBlob.objects.values_list("size", flat=True)), [len("export {};")])
+        self.assertIn("Deleted 1 unreferenced code blobs (5 bytes of code)", out.getvalue())
+        message = kept.messages.get()
+        resolve_code_blocks([message.code_blocks])
+        self.assertEqual(message.code_blocks[0]["code"], "export {};")
+
+    def test_keeps_blobs_restored_after_the_cutoff(self):
+        cutoff = timezone.now()
+        refs = store_code_blocks([{"language": "css", "filename": "a.css", "code": ".a {}"}])
+        CodeBlob.objects.update(created_at=cutoff - timedelta(hours=1))
+
+        # Re-stored for a message still being written: unreferenced, but fresh
+        store_code_blocks([{"language": "css", "filename": "b.css", "code": ".a {}"}])
+        self.assertEqual(delete_unreferenced_blobs(cutoff), (0, 0))
+        self.assertTrue(CodeBlob.objects.filter(sha256=refs[0]["sha256"]).exists())
+
+    def test_missing_blob_resolves_to_empty_code(self):
+        session = Session.objects.create()
+        shared = _generation_result()
+        message = record_assistant_message(session, shared)
+        CodeBlob.objects.all().delete()
+
+        blocks = Message.objects.get(pk=message.pk).code_blocks
+        with self.assertLogs("apps.chat.blobs", "WARNING"):
+            resolve_code_blocks([blocks])
+        self.assertEqual(blocks[0]["code"], "")
+        self.assertEqual(blocks[0]["filename"], shared["code_blocks"][0]["filename"])
+
+
+@override_settings(AI_HISTORY_WINDOW_TOKENS=100, AI_RECALL_ENABLED=False)
+@mock.patch("apps.chat.services.count_tokens", _fake_count_tokens)
+class CompactionTests(TestCase):
+
+    def setUp(self):
+        self.session = Session.objects.create()
+        for i in range(6):
+            Message.objects.create(session=self.session, role="user", content=f"turn {i}", token_count=20)
+        self.request = Message.objects.create(session=self.session, role="user", content="next", token_count=2)
+
+    def test_plan_compaction(self):
+        history = [("user", f"turn {i}", 20) for i in range(6)]
+        # 24 tokens an entry, with the per-message overhead
+        self.assertEqual(plan_compaction(history, window_tokens=144), 0)
+        # Folds until the rest fits in half the window
+        self.assertEqual(plan_compaction(history, window_tokens=100), 4)
+        # ...but never the most recent turns
+        self.assertEqual(plan_compaction(history, window_tokens=10), len(history) - MIN_KEPT_ENTRIES)
+
+    def test_summarize_failure_keeps_the_unfolded_history(self):
+        with mock.patch("apps.chat.services.summarize", side_effect=RuntimeError("down")), \
+                self.assertLogs("apps.chat.services", "WARNING"):
+            history = load_context(self.session, exclude=self.request)
+
+        self.assertEqual([content for _, content, _ in history], [f"turn {i}" for i in range(6)])
+        self.session.refresh_from_db()
+        self.assertIsNone(self.session.summarized_until)
+
+    def test_summary_is_saved_and_the_folded_turns_dropped(self):
+        with mock.patch("apps.chat.services.summarize", return_value="Turns 0-3.") as summarize:
+            history = load_context(self.session, exclude=self.request)
+
+        self.assertEqual(len(summarize.call_args.args[1]), 4)
+        self.assertEqual([content for _, content, _ in history], ["Turns 0-3.", "turn 4", "turn 5"])
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, "Turns 0-3.")
+        self.assertEqual(self.session.summarized_until, Message.objects.get(content="turn 3").created_at)
+
+    def test_a_concurrent_summary_wins(self):
+        stale = Session.objects.get(pk=self.session.pk)
+        with mock.patch("apps.chat.services.summarize", return_value="Turns 0-3."):
+            load_context(self.session, exclude=self.request)
+
+        # `stale` was read before the first summary was saved; its result is dropped
+        with mock.patch("apps.chat.services.summarize", return_value="Stale.") as summarize:
+            history = load_context(stale, exclude=self.request)
+
+        summarize.assert_called_once()
+        self.assertEqual(len(history), 6)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, "Turns 0-3.")
+
+
+@mock.patch("apps.chat.ai.retrieval.count_tokens", _fake_count_tokens)
+class RecallTests(TestCase):
+
+    def test_back_reference_recalls_the_folded_exchange(self):
+        session = Session.objects.create()
+        for user, filename in [
+            ("add a navbar with a logo and three links", "Navbar"),
+            ("now a pricing section with three tiers", "PricingTable"),
+            ("add a footer with social icons", "Footer"),
+        ]:
+            Message.objects.create(session=session, role="user", content=user, token_count=10)
+            folded = Message.objects.create(
+                session=session, role="assistant", token_count=20,
+                content=f"```tsx\n// filename: {filename}.tsx\nexport default function {filename}() {{}}\n```",
+            )
+        session.summary, session.summary_token_count = "A landing page: navbar, pricing, footer.", 8
+        session.summarized_until = folded.created_at
+        session.save()
+
+        request = Message.objects.create(
+            session=session, role="user", content="go back to the navbar from before", token_count=8
+        )
+        history = load_context(session, exclude=request)
+        self.assertEqual([entry[0] for entry in history], ["summary", RECALL_ROLE])
+        self.assertIn("USER: add a navbar", history[-1][1])
+        self.assertIn("Navbar.tsx", history[-1][1])
+        self.assertNotIn("Footer.tsx", history[-1][1])
+        # Counted as sent, not as the sum of the two messages' stored counts
+        self.assertEqual(history[-1][2], _fake_count_tokens(history[-1][1]))
+
+        unrelated = Message.objects.create(session=session, role="user", content="make it wider", token_count=4)
+        self.assertNotIn(RECALL_ROLE, [entry[0] for entry in load_context(session, exclude=unrelated)])
+
+
+class QueryPlanTests(TestCase):
+    """EXPLAIN the hot-path queries and check they use the composite indexes."""
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # Tiny test tables would otherwise always be sequentially scanned
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+        self.session = Session.objects.create()
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, f"{index_name} not used:\n{plan}")
+
+    def assertRequestUsesIndex(self, url, table, index_name):
+        """EXPLAIN the paginated SELECT from `table` that GET `url` runs."""
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(APIClient().get(url).status_code, 200)
+        sql = next(
+            query["sql"] for query in queries
+            if query["sql"].startswith("SELECT") and f'FROM "{table}"' in query["sql"]
+            and "ORDER BY" in query["sql"]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}")
+            plan = "\n".join(" ".join(map(str, row)) for row in cursor.fetchall())
+        self.assertIn(index_name, plan, f"{index_name} not used:\n{sql}\n{plan}")
+
+    def test_history_load_uses_session_created_index(self):
+        user_msg = Message.objects.create(session=self.session, role="user", content="hi", token_count=2)
+        self.assertUsesIndex(_history_rows(self.session, user_msg), "chat_msg_session_created_idx")
+
+    def test_message_list_uses_session_created_index(self):
+        Message.objects.create(session=self.session, role="user", content="hi", token_count=2)
+        self.assertRequestUsesIndex(
+            f"/api/sessions/{self.session.pk}/messages/", "chat_message", "chat_msg_session_created_idx"
+        )
+
+    def test_session_list_uses_updated_index(self):
+        self.assertRequestUsesIndex("/api/sessions/", "chat_session", "chat_session_updated_idx")
+
+
+class ModelLimiterTests(SimpleTestCase):
+
+    def test_queue_is_bounded_and_served_round_robin(self):
+        limiter = ModelLimiter(
+            "test-model", max_in_flight=1, tokens_per_minute=1_000, max_queue=3,
+            queue_timeout=5, retries=0, backoff_seconds=0,
+        )
+        release, order = threading.Event(), []
+
+        def call(session, fn):
+            set_session_key(session)
+            limiter.call(fn, 10)
+
+        holder = threading.Thread(target=call, args=("a", release.wait))
+        holder.start()
+        while not limiter.snapshot()["in_flight"]:
+            time.sleep(0.001)
+
+        waiters = []
+        for session in ("a", "a", "b"):
+            waiters.append(threading.Thread(target=call, args=(session, lambda s=session: order.append(s))))
+            waiters[-1].start()
+            while limiter.snapshot()["waiting"] < len(waiters):
+                time.sleep(0.001)
+
+        with self.assertRaises(ModelBusyError):
+            limiter.call(lambda: None, 10)
+
+        release.set()
+        for thread in [holder, *waiters]:
+            thread.join()
+        self.assertEqual(order, ["a", "b", "a"])
+
+    def test_rate_limit_pauses_admissions_and_is_retried(self):
+        limiter = ModelLimiter(
+            "test-model", max_in_flight=4, tokens_per_minute=1_000, max_queue=4,
+            queue_timeout=5, retries=2, backoff_seconds=0.05,
+        )
+        response = httpx.Response(429, request=httpx.Request("POST", "http://model.test/"))
+        calls, paused = [], []
+
+        def rate_limited():
+            calls.append(time.monotonic())
+            paused.append(limiter.snapshot()["paused_for"])
+            raise RateLimitError("slow down", response=response, body=None)
+
+        with self.assertLogs("apps.chat.ai.limiter", "WARNING") as logs, self.assertRaises(RateLimitError):
+            limiter.call(rate_limited, 10)
+
+        self.assertEqual(len(calls), 3)   # the first try and `retries` retries
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(paused[0], 0)
+        # Each retry waited out the pause the previous 429 set: 0.05s, then 0.1s, at half jitter or more
+        self.assertGreaterEqual(calls[1] - calls[0], 0.025)
+        self.assertGreaterEqual(calls[2] - calls[1], 0.05)
+        # ...and so did any other caller arriving meanwhile
+        self.assertGreater(limiter.snapshot()["paused_for"], 0)
+        started = time.monotonic()
+        limiter.call(lambda: None, 10)
+        self.assertGreater(time.monotonic() - started, 0.01)
+
+
+class InflightGenerationsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.inflight = InflightGenerations()
+
+    def test_followers_get_the_leaders_result(self):
+        leads, pending = self.inflight.join("key")
+        follows, shared = self.inflight.join("key")
+        self.assertTrue(leads)
+        self.assertFalse(follows)
+        self.assertIs(shared, pending)
+
+        self.inflight.finish("key", pending, result=_generation_result())
+        result = self.inflight.follow(shared)
+        self.assertEqual(result["content"], _generation_result()["content"])
+        self.assertEqual((result["prompt_tokens"], result["cached"]), (0, True))
+        # Finished: the next identical request leads a call of its own
+        self.assertTrue(self.inflight.join("key")[0])
+
+    def test_followers_see_the_leaders_error(self):
+        _, pending = self.inflight.join("key")
+        _, shared = self.inflight.join("key")
+        self.inflight.finish("key", pending, error=ValueError("upstream"))
+        with self.assertRaises(ValueError):
+            self.inflight.follow(shared)
+
+    def test_a_cancelled_leader_lets_followers_retry(self):
+        _, pending = self.inflight.join("key")
+        _, shared = self.inflight.join("key")
+        self.inflight.finish("key", pending, error=asyncio.CancelledError())
+
+        async def follow():
+            with self.assertRaises(LeaderCancelled):
+                await self.inflight.afollow(shared)
+            return self.inflight.join("key")[0]
+
+        self.assertTrue(asyncio.run(follow()))
+
+
+class TraceTests(SimpleTestCase):
+
+    def test_end_trace_restores_the_previous_trace(self):
+        self.assertIsNone(current_trace())
+        trace, token = start_trace()
+        with stage("generate"):
+            pass
+        end_trace(token)
+        self.assertIsNone(current_trace())
+        with stage("generate"):
+            pass
+        self.assertEqual(list(trace.stages), ["generate"])
+
+    @override_settings(AI_TRACE_SINK="apps.chat.ai.timing.no_such_sink")
+    @mock.patch("apps.chat.ai.timing._sink", None)
+    def test_a_sink_that_does_not_import_is_logged(self):
+        with self.assertLogs("apps.chat.ai.timing", "WARNING"):
+            emit({"ms": {}})
+
+
+class TrimHistoryTests(SimpleTestCase):
+
+    def test_stored_counts_are_used_without_encoding(self):
+        history = [("user", "make it wider", 4), ("assistant", "Done.", 3)]
+        with mock.patch("apps.chat.ai.token_manager.count_tokens") as count_tokens:
+            self.assertEqual(trim_history(history, max_tokens=15), history)
+            self.assertEqual(trim_history(history, max_tokens=14, chunk_tokens=1), history[1:])
+        count_tokens.assert_not_called()
+
+        with mock.patch("apps.chat.ai.token_manager.count_tokens", return_value=9) as count_tokens:
+            self.assertEqual(trim_history([("user", "legacy row", 0)], max_tokens=13), [("user", "legacy row", 0)])
+        count_tokens.assert_called_once_with("legacy row")
+
+    def test_trims_in_chunks_so_the_prefix_stays_put(self):
+        history = [("user", f"turn {i}", 96) for i in range(40)]   # 100 tokens an entry
+        kept = [trim_history(history[:n], max_tokens=2_000, chunk_tokens=500) for n in range(21, 26)]
+
+        # Each turn past the budget would move the window; chunking holds the first entry
+        self.assertEqual({entries[0] for entries in kept}, {history[5]})
+        self.assertTrue(all(len(entries) * 100 <= 2_000 for entries in kept))
+        self.assertEqual(trim_history(history[:26], max_tokens=2_000, chunk_tokens=500)[0], history[10])
+
+
+@mock.patch("apps.chat.ai.chain.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.token_manager.count_tokens", _fake_count_tokens)
+class PromptBudgetTests(SimpleTestCase):
+
+    def test_history_fills_what_the_prefix_and_input_leave(self):
+        chain = UIGeneratorChain()
+        history = [("user", "earlier turn", 5_000)] * 40
+        _, _, tokens = chain._prepare("word " * 9_000, history)
+
+        # The estimate covers the measured prefix, the input and the full completion budget
+        self.assertLessEqual(tokens, MAX_CONTEXT_TOKENS)
+        self.assertGreater(tokens, MAX_CONTEXT_TOKENS - TRIM_CHUNK_TOKENS - 5_004)
+
+    def test_summary_and_recalled_turns_are_never_trimmed(self):
+        chain = UIGeneratorChain()
+        history = [
+            ("summary", "A landing page with a navbar.", 300),
+            *[("user", f"turn {i}", 5_000) for i in range(40)],
+            (RECALL_ROLE, "USER: the navbar", 2_000),
+        ]
+        inputs, _, _ = chain._prepare("make it wider", history)
+
+        sent = [message.content for message in inputs["history"]]
+        self.assertTrue(sent[0].endswith("A landing page with a navbar."))
+        self.assertTrue(sent[-1].endswith("USER: the navbar"))
+        # The oldest turns went instead
+        self.assertNotIn("turn 0", sent)
+        self.assertIn("turn 39", sent)
+
+
+class CodeBlockStreamParserTests(SimpleTestCase):
+
+    def test_blocks_split_across_deltas_match_the_batch_parse(self):
+        text = (
+            "Here it is.\n\n```tsx\n// filename: Card.tsx\nexport default function Card() {}\n```\n"
+            "And the styles:\n```css\n.card { padding: 4px; }\n```\nDone."
+        )
+        for size in (1, 2, 3, 7, len(text)):
+            parser, streamed = CodeBlockStreamParser(), []
+            for start in range(0, len(text), size):
+                streamed.extend(parser.feed(text[start:start + size]))
+            self.assertEqual(streamed, parse_code_blocks(text), f"chunk size {size}")
+            self.assertEqual(parser.text, text)
+
+    def test_block_is_emitted_once_when_its_fence_closes(self):
+        parser = CodeBlockStreamParser()
+        self.assertEqual(parser.feed("```tsx\n// filename: A.tsx\nx\n``"), [])
+        self.assertEqual(parser.feed("`"), [{"language": "tsx", "filename": "A.tsx", "code": "x"}])
+        self.assertEqual(parser.feed(" more `text`"), [])
+
+
+class ResponseCacheTests(SimpleTestCase):
+
+    def test_key_ignores_case_and_spacing_only(self):
+        history = [("user", "a navbar", 3), ("assistant", "Done.", 2)]
+        key = response_cache_key("gpt-4o", history, "Make it  Sticky")
+        self.assertEqual(key, response_cache_key("gpt-4o", history, "make it sticky"))
+        # Stored token counts are not part of the prompt
+        uncounted = [("user", "a navbar", 0), ("assistant", "Done.", 0)]
+        self.assertEqual(key, response_cache_key("gpt-4o", uncounted, "make it sticky"))
+        self.assertNotEqual(key, response_cache_key("gpt-4o-mini", history, "make it sticky"))
+        self.assertNotEqual(key, response_cache_key("gpt-4o", history[:1], "make it sticky"))
+        self.assertNotEqual(key, response_cache_key("gpt-4o", history, "make it fixed"))
+
+    def test_hit_replays_the_stored_generation(self):
+        key = response_cache_key("gpt-4o", [], "a pricing table")
+        with override_settings(AI_RESPONSE_CACHE_ENABLED=False):
+            store_response(key, _generation_result())
+            self.assertIsNone(get_cached_response(key))
+
+        with override_settings(AI_RESPONSE_CACHE_ENABLED=True):
+            self.assertIsNone(get_cached_response(key))
+            store_response(key, _generation_result())
+            hit = get_cached_response(key)
+
+        self.assertEqual(hit["content"], _generation_result()["content"])
+        self.assertEqual(hit["code_blocks"], _generation_result()["code_blocks"])
+        self.assertEqual((hit["prompt_tokens"], hit["cached"]), (0, True))
+
+
+class PrefilterRequestTests(SimpleTestCase):
+
+    GENERATED = ("assistant", "Here it is.\n```tsx\n// filename: Navbar.tsx\nexport {};\n```")
+    ASKED = ("assistant", "Which links should the navbar have?")
+
+    def test_reply_to_the_question_just_asked(self):
+        history = [("user", "a navbar"), self.ASKED]
+        self.assertEqual(prefilter_request("home and pricing", history, ask_rounds_done=1), "reply_to_question")
+
+    def test_an_earlier_question_does_not_decide_later_turns(self):
+        history = [("user", "a navbar"), self.ASKED, ("user", "home and pricing"), self.GENERATED]
+        self.assertIsNone(prefilter_request("a footer", history, ask_rounds_done=1))
+
+    def test_out_of_questions(self):
+        self.assertEqual(prefilter_request("a footer", [], ask_rounds_done=MAX_ASK_ROUNDS), "reply_to_question")
+
+    def test_iteration_needs_a_generation_to_refine(self):
+        history = [("user", "a navbar"), self.GENERATED]
+        self.assertEqual(prefilter_request("now make it sticky", history), "iteration")
+        self.assertIsNone(prefilter_request("make it sticky", []))
+
+    def test_detailed_spec(self):
+        spec = "a pricing table with three tiers " * 5
+        self.assertEqual(prefilter_request(spec, []), "detailed_spec")
+        self.assertIsNone(prefilter_request("a landing page", []))
+
+
+class SemanticCacheTests(SimpleTestCase):
+
+    PRICING = ("a pricing table with {} tiers, a highlighted recommended plan, "
+               "monthly and yearly billing switch and a feature comparison list")
+    DASHBOARD = ("a {} themed dashboard layout with a collapsible {}, a top bar with "
+                 "search and avatar, and a grid of stat cards")
+    SETTINGS = "a settings page with profile, notifications and security sections, {} a toggle in the header"
+
+    def setUp(self):
+        self.cache = SemanticCache(
+            HashedNgramEmbedder(), settings.AI_SEMANTIC_CACHE_THRESHOLD, max_entries=10
+        )
+        for request in (self.PRICING.format("three"), self.DASHBOARD.format("dark", "sidebar"),
+                        self.SETTINGS.format("with")):
+            self.cache.store(request, _generation_result(content=request))
+
+    def test_rewordings_hit(self):
+        hit = self.cache.lookup("Please create " + self.PRICING.format("three").upper())
+        self.assertEqual(hit["content"], self.PRICING.format("three"))
+        self.assertTrue(hit["cached"])
+
+    def test_near_misses_miss(self):
+        for request in (
+            self.PRICING.format("four"),
+            self.PRICING.format("3"),
+            self.DASHBOARD.format("light", "sidebar"),
+            self.DASHBOARD.format("dark", "navbar"),
+            self.SETTINGS.format("without"),
+            self.SETTINGS.format("and no"),
+        ):
+            with self.subTest(request):
+                self.assertIsNone(self.cache.lookup(request))
+
+    def test_specifics(self):
+        self.assertEqual(specifics("Two BLUE cards, don't add 3 icons"), {"two", "blue", "not", "3"})
+        self.assertEqual(specifics("make a login form"), frozenset())
+
+
+class JSONRoundTripTests(TestCase):
+    """ORJSONRenderer/ORJSONParser must be interchangeable with DRF's stock pair."""
+
+    def setUp(self):
+        session = Session.objects.create(title="Café ✓")
+        content = _generation_result()["content"] + '\n\n“quoted” \\ \u2028 emoji 🎉'
+        message = Message.objects.create(
+            session=session, role="assistant", content=content, token_count=12,
+            code_blocks=parse_code_blocks(content),
+        )
+        self.data = MessageSerializer(message).data
+
+    def _round_trip(self, renderer, parser, indent=None):
+        rendered = renderer.render(self.data, renderer_context={"indent": indent})
+        return parser.parse(io.BytesIO(rendered))
+
+    def test_matches_the_stock_renderer_and_parser(self):
+        expected = self._round_trip(JSONRenderer(), JSONParser())
+        self.assertEqual(expected["id"], str(self.data["id"]))
+        for indent in (None, 4):
+            with self.subTest(indent=indent):
+                self.assertEqual(self._round_trip(ORJSONRenderer(), ORJSONParser(), indent), expected)
+                self.assertEqual(self._round_trip(ORJSONRenderer(), JSONParser(), indent), expected)
+                self.assertEqual(self._round_trip(JSONRenderer(), ORJSONParser(), indent), expected)
+
+    def test_falls_back_without_orjson(self):
+        expected = self._round_trip(ORJSONRenderer(), ORJSONParser())
+        with mock.patch("apps.chat.renderers.orjson", None), mock.patch("apps.chat.parsers.orjson", None):
+            self.assertEqual(self._round_trip(ORJSONRenderer(), ORJSONParser()), expected)
+
+    def test_malformed_json_is_a_parse_error(self):
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"content": '))
+
+
+class CollapseSupersededFilesTests(SimpleTestCase):
+
+    @staticmethod
+    def _reply(note, *files):
+        code = "export default function Component() {\n" + "  <div className=\"p-4\" />\n" * 10 + "}"
+        blocks = "".join(f"\n```tsx\n// filename: {name}\n{code}\n```" for name in files)
+        return ("assistant", f"{note}{blocks}", 100)
+
+    def test_only_the_newest_version_of_each_file_is_kept(self):
+        history = [
+            ("user", "a navbar and a footer", 6),
+            self._reply("First cut.", "Navbar.tsx", "Footer.tsx"),
+            ("user", "make the navbar sticky", 5),
+            self._reply("Navbar is sticky now.", "Navbar.tsx"),
+        ]
+        collapsed = collapse_superseded_files(history)
+
+        first = collapsed[1][1]
+        self.assertTrue(first.startswith("First cut."))
+        self.assertIn("[Earlier version of `Navbar.tsx` omitted", first)
+        self.assertIn("// filename: Footer.tsx", first)
+        self.assertLess(collapsed[1][2], 100)
+        self.assertEqual(collapsed[2:], history[2:])
+        self.assertEqual(collapsed[0], history[0])
+
+    def test_history_without_repeated_files_is_unchanged(self):
+        history = [
+            self._reply("Navbar.", "Navbar.tsx"),
+            ("user", "```tsx\n// filename: Navbar.tsx\nmine\n```", 6),
+            self._reply("Footer.", "Footer.tsx"),
+        ]
+        self.assertEqual(collapse_superseded_files(history), history)
+
+
+@override_settings(OPENAI_API_KEY="test")
+@mock.patch("apps.chat.ai.chain.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.token_manager.count_tokens", _fake_count_tokens)
+@mock.patch("apps.chat.ai.chain._generator_chain", None)
+class PooledChatModelTests(SimpleTestCase):
+
+    def test_models_are_shared_and_async_pools_close_with_their_loop(self):
+        self.assertIs(get_generator_chain(), get_generator_chain())
+        pooled = PooledChatModel(model="gpt-4o-mini")
+        self.assertIs(pooled.sync, pooled.sync)
+
+        async def use():
+            model = pooled.for_running_loop()
+            self.assertIs(pooled.for_running_loop(), model)
+            await asyncio.sleep(0)
+            return model.http_async_client
+
+        first, second = asyncio.run(use()), asyncio.run(use())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed)
+        self.assertTrue(second.is_closed)
+
+
+@override_settings(OPENAI_API_KEY="test")
+class SpeculativeGenerationTests(SimpleTestCase):
+
+    def setUp(self):
+        for target in ("apps.chat.ai.chain.count_tokens", "apps.chat.ai.token_manager.count_tokens"):
+            patcher = mock.patch(target, _fake_count_tokens)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.chain = UIGeneratorChain()
+        speculation_stats.reset()
+
+    def classify(self, action, after=None):
+        def classify_request(*args):
+            if after is not None:
+                after.wait(5)   # the speculative generation is under way
+            return {"action": action, "question": "Which colours?" if action == "ask" else ""}
+
+        return mock.patch("apps.chat.ai.chain.classify_request", side_effect=classify_request)
+
+    def test_hit_keeps_the_generation_and_miss_discards_it(self):
+        with self.classify("generate"), \
+                mock.patch.object(self.chain, "invoke", return_value=_generation_result()) as invoke:
+            result = self.chain.classify_and_invoke("a pricing card", [], speculative=True)
+        invoke.assert_called_once()
+        self.assertEqual(result["action"], "generate")
+        self.assertEqual(result["content"], _generation_result()["content"])
+
+        started, finish = threading.Event(), threading.Event()
+
+        def slow_invoke(*args):
+            started.set()
+            finish.wait(5)
+            return _generation_result()
+
+        with self.classify("ask", after=started), mock.patch.object(self.chain, "invoke", side_effect=slow_invoke):
+            result = self.chain.classify_and_invoke("a card", [], speculative=True)
+            self.assertEqual(result["action"], "ask")
+            self.assertEqual(result["questions"], ["Which colours?"])
+            finish.set()
+            for _ in range(100):
+                if speculation_stats.snapshot()["wasted_completion_tokens"]:
+                    break
+                time.sleep(0.01)
+
+        stats = speculation_stats.snapshot()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["wasted_completion_tokens"], 12)
+
+    def test_async_miss_cancels_the_generation(self):
+        started, closed = asyncio.Event(), asyncio.Event()
+
+        async def astream(*args):
+            started.set()
+            try:
+                yield {"type": "token", "text": "Here is"}
+                await asyncio.Event().wait()
+            finally:
+                closed.set()
+
+        async def run():
+            result = await self.chain.aclassify_and_invoke("a card", [], speculative=True)
+            await asyncio.wait_for(closed.wait(), 5)
+            return result
+
+        async def aclassify_request(*args):
+            await started.wait()
+            await asyncio.sleep(0)   # let the first token through
+            return {"action": "ask", "question": "Which colours?"}
+
+        with mock.patch("apps.chat.ai.chain.aclassify_request", aclassify_request), \
+                mock.patch.object(self.chain, "astream", astream):
+            result = asyncio.run(run())
+
+        self.assertEqual(result["action"], "ask")
+        stats = speculation_stats.snapshot()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["wasted_completion_tokens"], _fake_count_tokens("Here is"))
@@ -1,7 +1,16 @@
+from django.urls import path
 from rest_framework.routers import DefaultRouter
-from .views import SessionViewSet
+from .views import SessionViewSet, GenerationJobViewSet, send_message_async
 
 router = DefaultRouter()
 router.register(r"sessions", SessionViewSet, basename="session")
+router.register(r"jobs", GenerationJobViewSet, basename="job")
 
-urlpatterns = router.urls
+urlpatterns = [
+    path(
+        "sessions/<uuid:pk>/messages/async/",
+        send_message_async,
+        name="session-messages-async",
+    ),
+    *router.urls,
+]
@@ -1,80 +1,440 @@
-from rest_framework import viewsets, status
+import asyncio
+import json
+import logging
+import math
+from contextlib import aclosing
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse as django_reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from rest_framework import mixins, viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, Throttled, ValidationError
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
+from rest_framework.settings import api_settings
 
-from .models import Session, Message
+from .models import Session, Message, GenerationJob, IdempotencyKey
 from .serializers import (
     SessionSerializer,
-    SessionListSerializer,
     MessageSerializer,
+    GenerationJobSerializer,
     SendMessageSerializer,
+    ContentFormatQuerySerializer,
+    MessageListQuerySerializer,
+)
+from .pagination import SessionCursorPagination, MessageCursorPagination
+from .blobs import resolve_code_blocks, aresolve_code_blocks
+from .renderers import EventStreamRenderer, format_sse, dumps
+from .services import (
+    record_user_message,
+    arecord_user_message,
+    load_context,
+    aload_context,
+    record_assistant_message,
+    arecord_assistant_message,
+)
+from .idempotency import (
+    claim_idempotency_key,
+    complete_idempotency_key,
+    release_idempotency_key,
 )
-from .ai.chain import UIGeneratorChain
+from .jobs import enqueue_generation
+from .ai.chain import get_generator_chain
+from .ai.limiter import ModelBusyError, set_session_key
+from .ai.timing import end_trace, stage, start_trace
+
+logger = logging.getLogger(__name__)
+
+
+def _prefers_async(request) -> bool:
+    """RFC 7240 `Prefer: respond-async`."""
+    prefer = request.headers.get("Prefer", "")
+    return "respond-async" in (token.strip().lower() for token in prefer.split(","))
 
 
 class SessionViewSet(viewsets.ModelViewSet):
     queryset = Session.objects.all()
-
-    def get_serializer_class(self):
-        if self.action == "list":
-            return SessionListSerializer
-        return SessionSerializer
+    serializer_class = SessionSerializer
+    pagination_class = SessionCursorPagination
 
     @action(detail=True, methods=["post", "get"], url_path="messages")
     def messages(self, request, pk=None):
         session = self.get_object()
 
         if request.method == "GET":
-            msgs = session.messages.all()
-            return Response(MessageSerializer(msgs, many=True).data)
+            return self._list_messages(request, session)
 
         # POST — send a user message and get AI response
+        trace, trace_token = start_trace()
+        try:
+            response = self._post_message(request, session)
+        finally:
+            end_trace(trace_token)
+        response["Server-Timing"] = trace.server_timing()
+        return response
+
+    def _post_message(self, request, session):
         serializer = SendMessageSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user_content = serializer.validated_data["content"]
+        content_format = self._content_format(request)
 
-        # Save user message
-        user_msg = Message.objects.create(
-            session=session,
-            role=Message.Role.USER,
-            content=user_content,
-        )
+        key = self._idempotency_key(request)
+        if key is None:
+            return self._send_message(request, session, user_content, content_format)
 
-        # Auto-title the session from the first user message
-        if session.title == "New Chat":
-            session.title = user_content[:60]
-            session.save(update_fields=["title", "updated_at"])
-
-        # Build conversation history (all messages before this one)
-        history = list(
-            session.messages
-            .exclude(pk=user_msg.pk)
-            .order_by("created_at")
-            .values_list("role", "content")
+        # Retries and double submits with the same key get the first request's
+        # reply; if it is still running they wait for it
+        record, owned = claim_idempotency_key(
+            session, key, user_content,
+            respond_async=_prefers_async(request), content_format=content_format,
         )
+        if not owned:
+            response = self._replay(request, record, content_format)
+            response["Idempotent-Replayed"] = "true"
+            return response
+        try:
+            return self._send_message(request, session, user_content, content_format, record)
+        except BaseException:
+            release_idempotency_key(record)
+            raise
 
-        # Count how many times the AI already asked a clarifying question in this session
-        ask_rounds_done = session.messages.filter(
-            role=Message.Role.ASSISTANT,
-            action=Message.Action.ASK,
-        ).count()
+    def _send_message(self, request, session, user_content, content_format, idempotency=None):
+        # Save user message (auto-titles the session from the first one)
+        with stage("save"):
+            user_msg = record_user_message(session, user_content)
+
+        if _prefers_async(request):
+            # Generate in the worker pool; the client polls the job
+            job = enqueue_generation(session, user_msg)
+            if idempotency is not None:
+                complete_idempotency_key(idempotency, job=job)
+            response = self._job_accepted(request, job)
+            response["Preference-Applied"] = "respond-async"
+            return response
+
+        # Build conversation history: running summary + recent turns before this one
+        set_session_key(session.pk)
+        with stage("history"):
+            history = load_context(session, exclude=user_msg)
+        ask_rounds_done = session.ask_rounds
 
         # Invoke the LangChain chain (classify first, then generate or ask)
-        chain = UIGeneratorChain()
-        result = chain.classify_and_invoke(user_content, history, ask_rounds_done)
-
-        # Save assistant message
-        assistant_msg = Message.objects.create(
-            session=session,
-            role=Message.Role.ASSISTANT,
-            content=result["content"],
-            code_blocks=result["code_blocks"],
-            action=result["action"],
-            questions=result["questions"],
-            token_count=result["token_count"],
-        )
+        chain = get_generator_chain()
+        try:
+            result = chain.classify_and_invoke(user_content, history, ask_rounds_done)
+        except ModelBusyError as exc:
+            raise Throttled(wait=exc.retry_after, detail="The model is busy, try again shortly.")
+
+        with stage("save"):
+            assistant_msg = record_assistant_message(session, result)
+            if idempotency is not None:
+                complete_idempotency_key(idempotency, assistant_message=assistant_msg)
 
+        with stage("serialize"):
+            data = MessageSerializer(assistant_msg, context={"content_format": content_format}).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    def _idempotency_key(self, request):
+        key = request.headers.get("Idempotency-Key")
+        if key is not None and not 0 < len(key) <= IdempotencyKey._meta.get_field("key").max_length:
+            raise ValidationError({"Idempotency-Key": ["Must be 1 to 255 characters."]})
+        return key
+
+    def _replay(self, request, record, content_format):
+        """The stored outcome of an earlier request with the same Idempotency-Key."""
+        if record.job is not None:
+            if record.job.assistant_message is not None:
+                resolve_code_blocks([record.job.assistant_message.code_blocks])
+            return self._job_accepted(request, record.job)
+        assistant_msg = record.assistant_message
+        resolve_code_blocks([assistant_msg.code_blocks])
         return Response(
-            MessageSerializer(assistant_msg).data,
+            MessageSerializer(assistant_msg, context={"content_format": content_format}).data,
             status=status.HTTP_201_CREATED,
         )
+
+    def _job_accepted(self, request, job):
+        response = Response(GenerationJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+        response["Location"] = reverse("job-detail", args=[job.pk], request=request)
+        return response
+
+    def _content_format(self, request):
+        """Wire format of returned messages: `?content_format=markdown|compact`."""
+        query = ContentFormatQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        return query.validated_data["content_format"]
+
+    def _list_messages(self, request, session):
+        """Cursor-paginated messages, newest first; `?since=<message id>` limits
+        the listing to messages created after that one."""
+        query = MessageListQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+
+        msgs = session.messages.all()
+        since = query.validated_data.get("since")
+        if since is not None:
+            anchor = session.messages.filter(pk=since).values_list("created_at", flat=True).first()
+            if anchor is None:
+                raise ValidationError({"since": ["No such message in this session."]})
+            msgs = msgs.filter(created_at__gt=anchor)
+
+        paginator = MessageCursorPagination()
+        page = paginator.paginate_queryset(msgs, request, view=self)
+        resolve_code_blocks(msg.code_blocks for msg in page)
+        context = {"content_format": query.validated_data["content_format"]}
+        return paginator.get_paginated_response(MessageSerializer(page, many=True, context=context).data)
+
+    @action(
+        detail=True,
+        methods=["post"],
+        url_path="messages/stream",
+        renderer_classes=[*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer],
+    )
+    def stream_message(self, request, pk=None):
+        """Send a user message and stream the AI response as Server-Sent Events.
+
+        Events: "token" ({text}), "code_block" ({language, filename, code}),
+        then "message" with the saved assistant message — or "error".
+        The body is an async iterator, so tokens are only flushed as they
+        arrive when served through ASGI (config/asgi.py).
+        """
+        session = self.get_object()
+
+        serializer = SendMessageSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_content = serializer.validated_data["content"]
+        content_format = self._content_format(request)
+
+        trace, trace_token = start_trace()
+        try:
+            with stage("save"):
+                user_msg = record_user_message(session, user_content)
+            set_session_key(session.pk)
+            with stage("history"):
+                history = load_context(session, exclude=user_msg)
+        finally:
+            end_trace(trace_token)
+        ask_rounds_done = session.ask_rounds
+
+        chain = get_generator_chain()
+
+        async def event_stream():
+            # The body is iterated outside the view's context; carry its state over
+            set_session_key(session.pk)
+            _, stream_token = start_trace(trace)
+            partial = []
+            events = chain.classify_and_astream(user_content, history, ask_rounds_done)
+            try:
+                async with aclosing(events):
+                    async for event in events:
+                        if event["type"] == "token":
+                            partial.append(event["text"])
+                            yield format_sse("token", {"text": event["text"]})
+                        elif event["type"] == "code_block":
+                            yield format_sse("code_block", event["block"])
+                        else:
+                            assistant_msg = await arecord_assistant_message(
+                                session, event["result"]
+                            )
+                            partial = None   # recorded; nothing left to cancel
+                            data = MessageSerializer(
+                                assistant_msg, context={"content_format": content_format}
+                            ).data
+                            yield format_sse("message", data)
+            except (asyncio.CancelledError, GeneratorExit):
+                # The ASGI handler cancels the response when the client
+                # disconnects: mid-await we see CancelledError, between frames
+                # the stream is closed. Either way closing `events` has stopped
+                # the upstream call and freed its limiter lease; keep what had
+                # been generated.
+                if partial is not None:
+                    await _record_cancelled(session, chain.cancelled_result("".join(partial)))
+                raise
+            except ModelBusyError as exc:
+                yield format_sse("error", {
+                    "detail": "The model is busy, try again shortly.",
+                    "retry_after": round(exc.retry_after, 1),
+                })
+            except Exception:
+                yield format_sse("error", {"detail": "Generation failed."})
+            finally:
+                end_trace(stream_token)
+
+        response = StreamingHttpResponse(
+            event_stream(),
+            content_type=EventStreamRenderer.media_type,
+        )
+        # Disable proxy buffering so each frame reaches the browser immediately
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        # Only the stages before the first byte; the stored message gets the rest
+        response["Server-Timing"] = trace.server_timing()
+        return response
+
+
+class GenerationJobViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """Status of a background generation; `assistant_message` is set once it succeeds."""
+
+    queryset = GenerationJob.objects.select_related("assistant_message")
+    serializer_class = GenerationJobSerializer
+
+    def get_object(self):
+        job = super().get_object()
+        if job.assistant_message is not None:
+            resolve_code_blocks([job.assistant_message.code_blocks])
+        return job
+
+    def get_serializer_context(self):
+        query = ContentFormatQuerySerializer(data=self.request.query_params)
+        query.is_valid(raise_exception=True)
+        return {**super().get_serializer_context(), **query.validated_data}
+
+
+async def _record_cancelled(session, result) -> None:
+    """Record the reply to a turn whose client went away mid-generation."""
+    logger.info("Client disconnected; generation cancelled for session %s", session.pk)
+    # Shielded so the write completes even if the handler cancels us again
+    await asyncio.shield(
+        arecord_assistant_message(session, result, status=Message.Status.CANCELLED)
+    )
+
+
+@csrf_exempt
+@require_POST
+async def send_message_async(request, pk):
+    """Async twin of `SessionViewSet.messages` (POST) for ASGI deployments.
+
+    Same request/response contract — Idempotency-Key, Prefer: respond-async,
+    429 with Retry-After when the model is busy — but ORM and LLM calls are
+    awaited, so a pending generation holds no worker thread while it waits on
+    the model. DRF views are sync-only, hence a plain Django view.
+    """
+    session = await Session.objects.filter(pk=pk).afirst()
+    if session is None:
+        return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse(
+            {"detail": "JSON parse error."}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    serializer = SendMessageSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    user_content = serializer.validated_data["content"]
+
+    query = ContentFormatQuerySerializer(data=request.GET)
+    if not query.is_valid():
+        return JsonResponse(query.errors, status=status.HTTP_400_BAD_REQUEST)
+    content_format = query.validated_data["content_format"]
+
+    trace, trace_token = start_trace()
+    try:
+        response = await _apost_message(request, session, user_content, content_format)
+    finally:
+        end_trace(trace_token)
+    response["Server-Timing"] = trace.server_timing()
+    return response
+
+
+async def _apost_message(request, session, user_content, content_format):
+    key = request.headers.get("Idempotency-Key")
+    if key is None:
+        return await _asend_message(request, session, user_content, content_format)
+    if not 0 < len(key) <= IdempotencyKey._meta.get_field("key").max_length:
+        return JsonResponse(
+            {"Idempotency-Key": ["Must be 1 to 255 characters."]},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    try:
+        # Waiting on a duplicate polls the database; do it off the event loop
+        record, owned = await sync_to_async(claim_idempotency_key)(
+            session, key, user_content,
+            respond_async=_prefers_async(request), content_format=content_format,
+        )
+    except APIException as exc:
+        return JsonResponse({"detail": str(exc.detail)}, status=exc.status_code)
+    if not owned:
+        response = await _areplay(request, record, content_format)
+        response["Idempotent-Replayed"] = "true"
+        return response
+    try:
+        return await _asend_message(request, session, user_content, content_format, record)
+    except BaseException:
+        await asyncio.shield(sync_to_async(release_idempotency_key)(record))
+        raise
+
+
+async def _asend_message(request, session, user_content, content_format, idempotency=None):
+    with stage("save"):
+        user_msg = await arecord_user_message(session, user_content)
+
+    if _prefers_async(request):
+        job = await sync_to_async(enqueue_generation)(session, user_msg)
+        if idempotency is not None:
+            await sync_to_async(complete_idempotency_key)(idempotency, job=job)
+        response = _json_job_accepted(request, job)
+        response["Preference-Applied"] = "respond-async"
+        return response
+
+    set_session_key(session.pk)
+    with stage("history"):
+        history = await aload_context(session, exclude=user_msg)
+    ask_rounds_done = session.ask_rounds
+
+    chain = get_generator_chain()
+    try:
+        result = await chain.aclassify_and_invoke(user_content, history, ask_rounds_done)
+    except asyncio.CancelledError:
+        # Client disconnected; the awaited model request is cancelled with us
+        await _record_cancelled(session, chain.cancelled_result(""))
+        raise
+    except ModelBusyError as exc:
+        response = JsonResponse(
+            {"detail": "The model is busy, try again shortly."},
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+        )
+        response["Retry-After"] = str(math.ceil(exc.retry_after))
+        # A failed request frees its key for a retry, as in the DRF view
+        if idempotency is not None:
+            await sync_to_async(release_idempotency_key)(idempotency)
+        return response
+
+    with stage("save"):
+        assistant_msg = await arecord_assistant_message(session, result)
+        if idempotency is not None:
+            await sync_to_async(complete_idempotency_key)(idempotency, assistant_message=assistant_msg)
+
+    with stage("serialize"):
+        data = MessageSerializer(assistant_msg, context={"content_format": content_format}).data
+        return _json_response(data, status.HTTP_201_CREATED)
+
+
+async def _areplay(request, record, content_format):
+    """Async variant of `SessionViewSet._replay`."""
+    if record.job is not None:
+        if record.job.assistant_message is not None:
+            await aresolve_code_blocks([record.job.assistant_message.code_blocks])
+        return _json_job_accepted(request, record.job)
+    assistant_msg = record.assistant_message
+    await aresolve_code_blocks([assistant_msg.code_blocks])
+    data = MessageSerializer(assistant_msg, context={"content_format": content_format}).data
+    return _json_response(data, status.HTTP_201_CREATED)
+
+
+def _json_job_accepted(request, job):
+    response = _json_response(GenerationJobSerializer(job).data, status.HTTP_202_ACCEPTED)
+    response["Location"] = request.build_absolute_uri(django_reverse("job-detail", args=[job.pk]))
+    return response
+
+
+def _json_response(data, status_code):
+    # Same encoder as the DRF views (orjson when installed)
+    return HttpResponse(dumps(data), content_type="application/json", status=status_code)
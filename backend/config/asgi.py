@@ -14,3 +14,15 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.dev')
 
 application = get_asgi_application()
+
+from django.conf import settings  # noqa: E402
+
+if settings.AI_WARM_UP:
+    from apps.chat.ai.chain import warm_up  # noqa: E402
+
+    warm_up()
+
+# Generation jobs left queued by a previous process
+from apps.chat.jobs import resume_queued_jobs  # noqa: E402
+
+resume_queued_jobs()
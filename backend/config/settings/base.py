@@ -1,4 +1,5 @@
 from pathlib import Path
+from corsheaders.defaults import default_headers
 from dotenv import load_dotenv
 import os
 
@@ -10,6 +11,87 @@ BASE_DIR = Path(__file__).resolve().parent.parent.parent
 SECRET_KEY = os.getenv("DJANGO_SECRET_KEY", "django-insecure-dev-key-change-in-production")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+# Another OpenAI-compatible endpoint, e.g. the local fake used by `manage.py bench_chat`
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "")
+
+# Keep-alive pool shared by every call to the model endpoint (see apps/chat/ai/clients.py)
+AI_HTTP_POOL = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 120,
+}
+# Build the AI chains when the WSGI/ASGI app loads; optionally pre-open a connection too
+# (from a background thread, so boot never waits on the network)
+AI_WARM_UP = os.getenv("AI_WARM_UP", "True") == "True"
+AI_WARM_UP_CONNECT = os.getenv("AI_WARM_UP_CONNECT", "False") == "True"
+# Start gpt-4o generation alongside the classifier; discarded when the classifier says "ask"
+AI_SPECULATIVE_GENERATION = os.getenv("AI_SPECULATIVE_GENERATION", "False") == "True"
+AI_SPECULATION_WORKERS = 16
+# Worker threads for background generations (POST /messages/ with Prefer: respond-async)
+AI_JOB_WORKERS = int(os.getenv("AI_JOB_WORKERS", "4"))
+# Longest one turn can take: admission queues, retries, and the provider's 10-minute
+# request timeout. A background job still running after this was lost with its process.
+AI_GENERATION_MAX_SECONDS = 15 * 60
+# Working-window budget for raw history; older turns are folded into a running summary
+AI_HISTORY_WINDOW_TOKENS = int(os.getenv("AI_HISTORY_WINDOW_TOKENS", "12000"))
+# Recall the folded-out exchanges most relevant to each request (apps/chat/ai/retrieval.py):
+# at most AI_RECALL_TOP_K of them within AI_RECALL_TOKENS, from a BM25 index per session
+# kept in-process for up to AI_RECALL_MAX_SESSIONS sessions
+AI_RECALL_ENABLED = os.getenv("AI_RECALL_ENABLED", "True") == "True"
+AI_RECALL_TOP_K = 2
+AI_RECALL_TOKENS = int(os.getenv("AI_RECALL_TOKENS", "3000"))
+AI_RECALL_MIN_SCORE = 1.0
+AI_RECALL_MAX_SESSIONS = 256
+# Replay only the newest version of each generated file; older copies become placeholders
+AI_COLLAPSE_SUPERSEDED_FILES = True
+# Per-model admission control for upstream calls (apps/chat/ai/limiter.py); set these
+# a little under the account's rate limits. Models not listed use "default".
+AI_RATE_LIMITS = {
+    "default": {
+        "max_in_flight": 32,
+        "tokens_per_minute": 200_000,
+        "max_queue": 200,       # waiting calls beyond this are rejected (HTTP 429)
+        "queue_timeout": 30.0,  # seconds a call may wait for admission
+        "retries": 3,           # provider 429s retried with backoff
+        "backoff_seconds": 1.0,
+    },
+    "gpt-4o": {"max_in_flight": 16, "tokens_per_minute": 450_000},
+    "gpt-4o-mini": {"max_in_flight": 64, "tokens_per_minute": 1_000_000},
+}
+# Send each session's id as OpenAI's prompt_cache_key, so its requests reach the same
+# prompt cache; turn off for OpenAI-compatible endpoints that reject the parameter
+AI_PROMPT_CACHE_KEY = os.getenv("AI_PROMPT_CACHE_KEY", "True") == "True"
+# Identical concurrent generations share one upstream call
+AI_COALESCE_GENERATIONS = True
+# Dotted path to a callable given each turn's stage timings and token usage
+# (apps/chat/ai/timing.py), e.g. "apps.chat.ai.timing.log_sink"; they are also
+# stored on the assistant message either way
+AI_TRACE_SINK = os.getenv("AI_TRACE_SINK", "")
+# Exact-match cache of gpt-4o generations (apps/chat/ai/cache.py). Opt-in: a hit replays
+# a reply generated for whichever session first sent the same history and request
+AI_RESPONSE_CACHE_ENABLED = os.getenv("AI_RESPONSE_CACHE_ENABLED", "False") == "True"
+AI_RESPONSE_CACHE_ALIAS = "ai-responses"
+# In-process similarity cache for near-duplicate first messages (apps/chat/ai/semantic_cache.py)
+AI_SEMANTIC_CACHE_ENABLED = os.getenv("AI_SEMANTIC_CACHE_ENABLED", "False") == "True"
+AI_SEMANTIC_CACHE_EMBEDDER = "apps.chat.ai.semantic_cache.HashedNgramEmbedder"
+# Rewordings score 1.0; one swapped word in a long request ("a sidebar" for "a navbar")
+# still scores 0.93-0.96 with the default embedder, so keep this above that
+AI_SEMANTIC_CACHE_THRESHOLD = 0.97
+AI_SEMANTIC_CACHE_MAX_ENTRIES = 2000
+# Decide obvious classifier turns locally; re-check a sample with the model to measure agreement
+AI_FAST_CLASSIFIER_ENABLED = os.getenv("AI_FAST_CLASSIFIER_ENABLED", "True") == "True"
+AI_FAST_CLASSIFIER_SHADOW_RATE = float(os.getenv("AI_FAST_CLASSIFIER_SHADOW_RATE", "0.05"))
+
+# Store assistant messages as prose with block placeholders plus code_blocks,
+# instead of duplicating every block in content (apps/chat/storage.py)
+CHAT_COMPACT_STORAGE = os.getenv("CHAT_COMPACT_STORAGE", "False") == "True"
+# Store generated code once per distinct file content in CodeBlob rows (apps/chat/blobs.py);
+# pair with CHAT_COMPACT_STORAGE so content doesn't carry another copy
+CHAT_CODE_BLOB_STORAGE = os.getenv("CHAT_CODE_BLOB_STORAGE", "False") == "True"
+# Idempotency-Key on POST /messages/ (apps/chat/idempotency.py): seconds a key's reply is
+# replayed, and seconds a concurrent duplicate waits for the first request to finish
+CHAT_IDEMPOTENCY_TTL = 60 * 60 * 24
+CHAT_IDEMPOTENCY_WAIT = 120
 
 DJANGO_APPS = [
     "django.contrib.admin",
@@ -73,11 +155,34 @@ TIME_ZONE = "UTC"
 USE_I18N = True
 USE_TZ = True
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    # LocMemCache evicts least-recently-used entries past MAX_ENTRIES; point this
+    # at a shared backend (e.g. Redis) to share hits across worker processes.
+    AI_RESPONSE_CACHE_ALIAS: {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "ai-responses",
+        "TIMEOUT": 60 * 60 * 24,
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
+}
+
+# Request headers the frontend sends beyond the defaults
+CORS_ALLOW_HEADERS = (*default_headers, "idempotency-key", "prefer")
+
 STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 REST_FRAMEWORK = {
+    # orjson-backed; both fall back to the stdlib json implementations without orjson
     "DEFAULT_RENDERER_CLASSES": [
-        "rest_framework.renderers.JSONRenderer",
+        "apps.chat.renderers.ORJSONRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "apps.chat.parsers.ORJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
     ],
 }
@@ -7,6 +7,8 @@ import type { Message } from '@/modules/chat/types/chat';
 
 interface ChatWindowProps {
   messages: Message[];
+  hasOlderMessages: boolean;
+  onLoadOlder: () => void;
   loading: boolean;
   error: string | null;
   sessionId: string | null;
@@ -16,6 +18,8 @@ interface ChatWindowProps {
 
 const ChatWindow: React.FC<ChatWindowProps> = ({
   messages,
+  hasOlderMessages,
+  onLoadOlder,
   loading,
   error,
   sessionId,
@@ -39,7 +43,12 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
 
   return (
     <div className="flex-1 flex flex-col overflow-hidden bg-background">
-      <MessageList messages={messages} loading={loading} />
+      <MessageList
+        messages={messages}
+        hasOlderMessages={hasOlderMessages}
+        onLoadOlder={onLoadOlder}
+        loading={loading}
+      />
       {error && (
         <div className="mx-6 mb-2">
           <Alert variant="destructive">
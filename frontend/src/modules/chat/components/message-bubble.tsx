@@ -12,9 +12,11 @@ interface MessageBubbleProps {
 const MessageBubble: React.FC<MessageBubbleProps> = ({ message }) => {
   const isUser = message.role === 'user';
 
-  // Strip fenced code blocks from prose so we render them via CodePreview
+  // Strip fenced code blocks (or their compact placeholders) from prose so we
+  // render them via CodePreview
   const prose = message.content
     .replace(/```[\w]*\n(?:\/\/ filename: \S+\n)?[\s\S]*?```/g, '')
+    .replace(/<!-- block:\d+ -->/g, '')
     .trim();
 
   return (
@@ -47,6 +49,9 @@ const MessageBubble: React.FC<MessageBubbleProps> = ({ message }) => {
             {message.code_blocks.map((block, i) => (
               <CodePreview key={i} block={block} />
             ))}
+            {message.status === 'cancelled' && (
+              <p className="m-0 mt-2 text-xs italic text-muted-foreground">Generation stopped.</p>
+            )}
           </>
         )}
       </div>
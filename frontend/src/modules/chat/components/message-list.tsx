@@ -1,20 +1,30 @@
 import React, { useEffect, useRef } from 'react';
 import { ScrollArea } from '@/core/components/ui/scroll-area';
+import { Button } from '@/core/components/ui/button';
 import { Avatar, AvatarFallback } from '@/core/components/ui/avatar';
 import MessageBubble from './message-bubble';
 import type { Message } from '@/modules/chat/types/chat';
 
 interface MessageListProps {
   messages: Message[];
+  hasOlderMessages: boolean;
+  onLoadOlder: () => void;
   loading: boolean;
 }
 
-const MessageList: React.FC<MessageListProps> = ({ messages, loading }) => {
+const MessageList: React.FC<MessageListProps> = ({
+  messages,
+  hasOlderMessages,
+  onLoadOlder,
+  loading,
+}) => {
   const bottomRef = useRef<HTMLDivElement>(null);
+  const lastMessageId = messages[messages.length - 1]?.id;
 
+  // Follow new messages only; prepending older history keeps the scroll position
   useEffect(() => {
     bottomRef.current?.scrollIntoView({ behavior: 'smooth' });
-  }, [messages, loading]);
+  }, [lastMessageId, loading]);
 
   if (messages.length === 0) {
     return (
@@ -33,6 +43,13 @@ const MessageList: React.FC<MessageListProps> = ({ messages, loading }) => {
     <div className="flex-1 min-h-0">
     <ScrollArea className="h-full">
       <div className="px-6 pt-6 pb-2">
+        {hasOlderMessages && (
+          <div className="flex justify-center mb-5">
+            <Button variant="ghost" size="sm" onClick={onLoadOlder}>
+              Load earlier messages
+            </Button>
+          </div>
+        )}
         {messages.map((msg) => (
           <MessageBubble key={msg.id} message={msg} />
         ))}
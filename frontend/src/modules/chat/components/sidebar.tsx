@@ -7,6 +7,8 @@ import type { SessionSummary } from '@/modules/chat/types/chat';
 
 interface SidebarProps {
   sessions: SessionSummary[];
+  hasMoreSessions: boolean;
+  onLoadMore: () => void;
   currentSessionId: string | null;
   onNewChat: () => void;
   onSelectSession: (id: string) => void;
@@ -15,6 +17,8 @@ interface SidebarProps {
 
 const Sidebar: React.FC<SidebarProps> = ({
   sessions,
+  hasMoreSessions,
+  onLoadMore,
   currentSessionId,
   onNewChat,
   onSelectSession,
@@ -82,6 +86,13 @@ const Sidebar: React.FC<SidebarProps> = ({
               </Button>
             </div>
           ))}
+          {hasMoreSessions && (
+            <div className="flex justify-center mt-1">
+              <Button variant="ghost" size="sm" onClick={onLoadMore}>
+                Load more chats
+              </Button>
+            </div>
+          )}
         </nav>
       </ScrollArea>
     </aside>
@@ -1,46 +1,96 @@
-import { useState, useCallback } from "react";
-import { chatService } from "../service/chat-service";
+import { useState, useCallback, useRef } from "react";
+import { chatService, cursorOf } from "../service/chat-service";
 import type { Message, SessionSummary } from "../types/chat";
 
 export function useChat() {
 	const [sessions, setSessions] = useState<SessionSummary[]>([]);
+	// Cursor for the next page of less recently active sessions
+	const [sessionsCursor, setSessionsCursor] = useState<string | undefined>();
 	const [currentSessionId, setCurrentSessionId] = useState<string | null>(null);
 	const [messages, setMessages] = useState<Message[]>([]);
+	// Cursor for the next page of older messages, if the session has more
+	const [olderCursor, setOlderCursor] = useState<string | undefined>();
 	const [loading, setLoading] = useState(false);
 	const [error, setError] = useState<string | null>(null);
+	// The in-flight send. Leaving its session detaches it rather than aborting:
+	// POST /messages/ runs in a worker thread that cannot see the client go away,
+	// so the reply is generated and saved regardless, and shows when the session
+	// is opened again.
+	const pendingSend = useRef<{ content: string } | null>(null);
+
+	const detachPendingSend = useCallback(() => {
+		pendingSend.current = null;
+		setLoading(false);
+	}, []);
 
 	const loadSessions = useCallback(async () => {
 		try {
 			const { data } = await chatService.getSessions();
-			setSessions(data);
+			setSessions(data.results);
+			setSessionsCursor(cursorOf(data.next));
 		} catch {
 			setError("Failed to load sessions.");
 		}
 	}, []);
 
+	const loadMoreSessions = useCallback(async () => {
+		if (!sessionsCursor) return;
+		try {
+			const { data } = await chatService.getSessions({
+				cursor: sessionsCursor,
+			});
+			// A session active since the first page was fetched can show up twice
+			setSessions((prev) => {
+				const seen = new Set(prev.map((s) => s.id));
+				return [...prev, ...data.results.filter((s) => !seen.has(s.id))];
+			});
+			setSessionsCursor(cursorOf(data.next));
+		} catch {
+			setError("Failed to load sessions.");
+		}
+	}, [sessionsCursor]);
+
 	const createSession = useCallback(async () => {
+		detachPendingSend();
 		try {
 			const { data } = await chatService.createSession();
 			setSessions((prev) => [data, ...prev]);
 			setCurrentSessionId(data.id);
 			setMessages([]);
+			setOlderCursor(undefined);
 			setError(null);
 			return data.id;
 		} catch {
 			setError("Failed to create session.");
 		}
-	}, []);
+	}, [detachPendingSend]);
 
 	const selectSession = useCallback(async (sessionId: string) => {
+		if (sessionId !== currentSessionId) detachPendingSend();
 		setCurrentSessionId(sessionId);
 		setError(null);
 		try {
-			const { data } = await chatService.getSession(sessionId);
-			setMessages(data.messages);
+			// Pages come newest first; the first one is the tail of the conversation
+			const { data } = await chatService.getMessages(sessionId);
+			setMessages([...data.results].reverse());
+			setOlderCursor(cursorOf(data.next));
 		} catch {
 			setError("Failed to load messages.");
 		}
-	}, []);
+	}, [currentSessionId, detachPendingSend]);
+
+	const loadOlderMessages = useCallback(async () => {
+		if (!currentSessionId || !olderCursor) return;
+		try {
+			const { data } = await chatService.getMessages(currentSessionId, {
+				cursor: olderCursor,
+			});
+			setMessages((prev) => [...[...data.results].reverse(), ...prev]);
+			setOlderCursor(cursorOf(data.next));
+		} catch {
+			setError("Failed to load messages.");
+		}
+	}, [currentSessionId, olderCursor]);
 
 	const deleteSession = useCallback(
 		async (sessionId: string) => {
@@ -48,28 +98,34 @@ export function useChat() {
 				await chatService.deleteSession(sessionId);
 				setSessions((prev) => prev.filter((s) => s.id !== sessionId));
 				if (currentSessionId === sessionId) {
+					detachPendingSend();
 					setCurrentSessionId(null);
 					setMessages([]);
+					setOlderCursor(undefined);
 				}
 			} catch {
 				setError("Failed to delete session.");
 			}
 		},
-		[currentSessionId],
+		[currentSessionId, detachPendingSend],
 	);
 
 	const sendMessage = useCallback(
 		async (content: string) => {
 			if (!currentSessionId || !content.trim()) return;
+			// A double submit of the message already on its way
+			if (pendingSend.current?.content === content) return;
 
 			// Optimistic user message
 			const optimisticUserMsg: Message = {
 				id: `temp-${Date.now()}`,
 				role: "user",
 				content,
+				content_format: "markdown",
 				code_blocks: [],
 				action: "generate",
 				questions: [],
+				status: "complete",
 				created_at: new Date().toISOString(),
 			};
 
@@ -77,30 +133,44 @@ export function useChat() {
 			setLoading(true);
 			setError(null);
 
+			const pending = { content };
+			pendingSend.current = pending;
+
 			try {
 				const { data: assistantMsg } = await chatService.sendMessage(
 					currentSessionId,
 					content,
 				);
+				// Update session title in sidebar if it changed, and move the
+				// session to the top as the most recently active
+				setSessions((prev) => {
+					const current = prev.find((s) => s.id === currentSessionId);
+					if (!current) return prev;
+					return [
+						{
+							...current,
+							title: content.slice(0, 60),
+							updated_at: assistantMsg.created_at,
+						},
+						...prev.filter((s) => s.id !== currentSessionId),
+					];
+				});
 
+				// The user moved to another session meanwhile
+				if (pendingSend.current !== pending) return;
 				setMessages((prev) => [...prev, assistantMsg]);
-
-				// Update session title in sidebar if it changed
-				setSessions((prev) =>
-					prev.map((s) =>
-						s.id === currentSessionId
-							? { ...s, title: content.slice(0, 60) }
-							: s,
-					),
-				);
 			} catch {
+				if (pendingSend.current !== pending) return;
 				setError("Something went wrong. Please try again.");
 				// Remove the optimistic message on failure
 				setMessages((prev) =>
 					prev.filter((m) => m.id !== optimisticUserMsg.id),
 				);
 			} finally {
-				setLoading(false);
+				if (pendingSend.current === pending) {
+					pendingSend.current = null;
+					setLoading(false);
+				}
 			}
 		},
 		[currentSessionId],
@@ -108,13 +178,17 @@ export function useChat() {
 
 	return {
 		sessions,
+		hasMoreSessions: sessionsCursor !== undefined,
 		currentSessionId,
 		messages,
+		hasOlderMessages: olderCursor !== undefined,
 		loading,
 		error,
 		loadSessions,
+		loadMoreSessions,
 		createSession,
 		selectSession,
+		loadOlderMessages,
 		deleteSession,
 		sendMessage,
 	};
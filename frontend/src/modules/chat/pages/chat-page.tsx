@@ -6,13 +6,17 @@ import ChatWindow from '../components/chat-window';
 export default function ChatPage() {
   const {
     sessions,
+    hasMoreSessions,
     currentSessionId,
     messages,
+    hasOlderMessages,
     loading,
     error,
     loadSessions,
+    loadMoreSessions,
     createSession,
     selectSession,
+    loadOlderMessages,
     deleteSession,
     sendMessage,
   } = useChat();
@@ -25,6 +29,8 @@ export default function ChatPage() {
     <>
       <Sidebar
         sessions={sessions}
+        hasMoreSessions={hasMoreSessions}
+        onLoadMore={loadMoreSessions}
         currentSessionId={currentSessionId}
         onNewChat={createSession}
         onSelectSession={selectSession}
@@ -32,6 +38,8 @@ export default function ChatPage() {
       />
       <ChatWindow
         messages={messages}
+        hasOlderMessages={hasOlderMessages}
+        onLoadOlder={loadOlderMessages}
         loading={loading}
         error={error}
         sessionId={currentSessionId}
@@ -1,23 +1,43 @@
 import axios from 'axios';
-import type { Session, SessionSummary, Message } from '../types/chat';
+import type { Session, SessionSummary, Message, Page } from '../types/chat';
 
 const api = axios.create({
   baseURL: '/api',
   headers: { 'Content-Type': 'application/json' },
 });
 
+// Assistant code is rendered from code_blocks, so skip its copy inside content
+const COMPACT = { content_format: 'compact' } as const;
+
 export const chatService = {
   createSession: () => api.post<Session>('/sessions/'),
 
-  getSessions: () => api.get<SessionSummary[]>('/sessions/'),
+  getSessions: (params?: { cursor?: string }) =>
+    api.get<Page<SessionSummary>>('/sessions/', { params }),
 
   getSession: (id: string) => api.get<Session>(`/sessions/${id}/`),
 
   deleteSession: (id: string) => api.delete(`/sessions/${id}/`),
 
-  sendMessage: (sessionId: string, content: string) =>
-    api.post<Message>(`/sessions/${sessionId}/messages/`, { content }),
+  sendMessage: async (sessionId: string, content: string) => {
+    // One key per message: the server answers a resend with the first reply
+    // instead of generating another
+    const headers = { 'Idempotency-Key': crypto.randomUUID() };
+    const send = () =>
+      api.post<Message>(`/sessions/${sessionId}/messages/`, { content }, { params: COMPACT, headers });
+    try {
+      return await send();
+    } catch (err) {
+      // Retry once if the connection dropped before any response arrived
+      if (axios.isAxiosError(err) && !err.response) return send();
+      throw err;
+    }
+  },
 
-  getMessages: (sessionId: string) =>
-    api.get<Message[]>(`/sessions/${sessionId}/messages/`),
+  getMessages: (sessionId: string, params?: { cursor?: string; since?: string }) =>
+    api.get<Page<Message>>(`/sessions/${sessionId}/messages/`, { params: { ...COMPACT, ...params } }),
 };
+
+// The cursor query param of a page's `next`/`previous` link
+export const cursorOf = (link: string | null) =>
+  link ? new URL(link, window.location.origin).searchParams.get('cursor') ?? undefined : undefined;
@@ -8,9 +8,13 @@ export interface Message {
   id: string;
   role: 'user' | 'assistant';
   content: string;
+  // "compact": code blocks in content are <!-- block:N --> placeholders for code_blocks[N]
+  content_format: 'markdown' | 'compact';
   code_blocks: CodeBlock[];
   action: 'ask' | 'generate';
   questions: string[];
+  // "cancelled": the client disconnected mid-generation; content is what had streamed
+  status: 'complete' | 'cancelled';
   created_at: string;
 }
 
@@ -19,7 +23,6 @@ export interface Session {
   title: string;
   created_at: string;
   updated_at: string;
-  messages: Message[];
 }
 
 export interface SessionSummary {
@@ -28,3 +31,10 @@ export interface SessionSummary {
   created_at: string;
   updated_at: string;
 }
+
+// Cursor-paginated list response (messages newest first, sessions most recent first)
+export interface Page<T> {
+  next: string | null;
+  previous: string | null;
+  results: T[];
+}